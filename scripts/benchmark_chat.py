@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+Benchmark di carico e latenza delle API di chat della webapp.
+
+Manda richieste a /api/chat e /api/chat/stream con concorrenza configurabile,
+lunghezze di prompt e max_tokens estratte da distribuzioni e un mix di
+esperti preso da models_config.json (con probabilità di cambio esperto tra
+una richiesta e la successiva dello stesso utente virtuale).
+
+Riporta in JSON: TTFT, latenza tra token, latenza end-to-end (p50/p95/p99),
+token/s e tasso di errore, in totale, per endpoint e per esperto.
+
+Con --fake avvia la webapp in locale con il backend di inferenza finto
+(latenza per token configurabile): scheduler, cache e API sono quelli veri,
+così il benchmark gira anche su Linux senza MLX né pesi.
+
+Esempi:
+    python scripts/benchmark_chat.py --url http://localhost:8080 --requests 200 --concurrency 16
+    python scripts/benchmark_chat.py --fake --fake-token-ms 5 --output bench.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Percorsi
+BASE_DIR = Path(__file__).parent.parent
+CONFIG_FILE = BASE_DIR / "models" / "models_config.json"
+WEBAPP_DIR = BASE_DIR / "webapp"
+
+# Domande di partenza, allungate con testo di riempimento fino alla lunghezza estratta
+SEED_QUESTIONS = [
+    "Come si crea una funzione in Python?",
+    "Chi era Giulio Cesare?",
+    "Cos'è la fotosintesi?",
+    "Come si fa la carbonara?",
+    "Quali sono le caratteristiche del segno dell'Ariete?",
+    "Raccontami una breve storia",
+]
+FILLER = (
+    "considera anche il contesto storico gli esempi pratici i dettagli tecnici "
+    "e le possibili eccezioni spiegando passo per passo con parole semplici"
+).split()
+
+
+# ============================================================================
+# DISTRIBUZIONI E CONFIGURAZIONE
+# ============================================================================
+
+def parse_distribution(spec):
+    """
+    Distribuzione di interi da stringa:
+        fixed:N | uniform:MIN:MAX | normal:MEDIA:DEV | lognormal:MU:SIGMA
+    """
+    kind, *params = spec.split(':')
+    values = [float(p) for p in params]
+    if kind == 'fixed' and len(values) == 1:
+        return lambda rng: int(values[0])
+    if kind == 'uniform' and len(values) == 2:
+        return lambda rng: rng.randint(int(values[0]), int(values[1]))
+    if kind == 'normal' and len(values) == 2:
+        return lambda rng: max(1, int(rng.gauss(values[0], values[1])))
+    if kind == 'lognormal' and len(values) == 2:
+        return lambda rng: max(1, int(rng.lognormvariate(values[0], values[1])))
+    raise argparse.ArgumentTypeError(f"Distribuzione non valida: {spec}")
+
+
+def load_model_mix(spec):
+    """
+    Pesi degli esperti: "programming:0.5,history:0.3,base:0.2", oppure tutti
+    gli esperti abilitati di models_config.json con lo stesso peso.
+    """
+    if spec:
+        mix = {}
+        for part in spec.split(','):
+            model_id, _, weight = part.partition(':')
+            mix[model_id.strip()] = float(weight or 1)
+        return mix
+
+    if CONFIG_FILE.exists():
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        models = [m['id'] for m in config['models'] if m.get('enabled', True)]
+        if models:
+            return {model_id: 1.0 for model_id in models}
+    return {'base': 1.0}
+
+
+def build_prompt(rng, words, index, unique):
+    """Domanda di circa `words` parole (con suffisso univoco per evitare la cache delle risposte)"""
+    text = rng.choice(SEED_QUESTIONS).split()
+    while len(text) < words:
+        text.append(rng.choice(FILLER))
+    prompt = ' '.join(text[:max(words, 1)])
+    return f"{prompt} (richiesta {index})" if unique else prompt
+
+
+# ============================================================================
+# CLIENT
+# ============================================================================
+
+def post_json(url, payload, timeout):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def run_chat(base_url, payload, timeout):
+    """/api/chat: TTFT coincide con la latenza end-to-end"""
+    start = time.perf_counter()
+    with post_json(f"{base_url}/api/chat", payload, timeout) as response:
+        data = json.loads(response.read().decode('utf-8'))
+    elapsed = time.perf_counter() - start
+    if 'error' in data:
+        raise RuntimeError(data['error'])
+
+    stats = data.get('stats') or {}
+    tokens = stats.get('generated_tokens') or len(data.get('response', '').split())
+    return {'ttft': elapsed, 'e2e': elapsed, 'itl': [], 'tokens': tokens, 'cached': bool(data.get('cached'))}
+
+
+def run_stream(base_url, payload, timeout):
+    """/api/chat/stream: misura ogni evento SSE"""
+    start = time.perf_counter()
+    ttft = None
+    last = None
+    itl = []
+    events = 0
+    done = {}
+    with post_json(f"{base_url}/api/chat/stream", payload, timeout) as response:
+        for raw in response:
+            line = raw.decode('utf-8').strip()
+            if not line.startswith('data: '):
+                continue
+            event = json.loads(line[6:])
+            now = time.perf_counter()
+            if 'error' in event:
+                raise RuntimeError(event['error'])
+            if 'token' in event:
+                if ttft is None:
+                    ttft = now - start
+                else:
+                    itl.append(now - last)
+                last = now
+                events += 1
+            if event.get('done'):
+                done = event
+                break
+
+    elapsed = time.perf_counter() - start
+    stats = done.get('stats') or {}
+    return {
+        'ttft': ttft if ttft is not None else elapsed,
+        'e2e': elapsed,
+        'itl': itl,
+        'tokens': stats.get('generated_tokens') or events,
+        'cached': bool(done.get('cached'))
+    }
+
+
+# ============================================================================
+# STATISTICHE
+# ============================================================================
+
+def percentile(values, p):
+    """Percentile nearest-rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def summarize_latency(values):
+    ms = [v * 1000 for v in values]
+    if not ms:
+        return None
+    return {
+        'mean_ms': round(sum(ms) / len(ms), 2),
+        'p50_ms': round(percentile(ms, 50), 2),
+        'p95_ms': round(percentile(ms, 95), 2),
+        'p99_ms': round(percentile(ms, 99), 2),
+        'max_ms': round(max(ms), 2)
+    }
+
+
+def summarize(results, wall_time):
+    ok = [r for r in results if r['ok']]
+    errors = {}
+    for r in results:
+        if not r['ok']:
+            errors[r['error']] = errors.get(r['error'], 0) + 1
+
+    tokens = sum(r['tokens'] for r in ok)
+    per_request_tps = [
+        (r['tokens'] - 1) / (r['e2e'] - r['ttft'])
+        for r in ok if r['tokens'] > 1 and r['e2e'] > r['ttft']
+    ]
+    return {
+        'requests': len(results),
+        'succeeded': len(ok),
+        'error_rate': round(1 - len(ok) / len(results), 4) if results else None,
+        'errors': errors,
+        'cache_hits': sum(1 for r in ok if r['cached']),
+        'generated_tokens': tokens,
+        'throughput_tokens_per_sec': round(tokens / wall_time, 2) if wall_time else None,
+        'throughput_requests_per_sec': round(len(ok) / wall_time, 2) if wall_time else None,
+        'decode_tokens_per_sec_mean': (
+            round(sum(per_request_tps) / len(per_request_tps), 2) if per_request_tps else None
+        ),
+        'ttft': summarize_latency([r['ttft'] for r in ok]),
+        'inter_token_latency': summarize_latency([x for r in ok for x in r['itl']]),
+        'e2e': summarize_latency([r['e2e'] for r in ok])
+    }
+
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def run_benchmark(args):
+    prompt_words = parse_distribution(args.prompt_words)
+    max_tokens = parse_distribution(args.max_tokens)
+    mix = load_model_mix(args.models)
+    model_ids = list(mix)
+    weights = [mix[m] for m in model_ids]
+
+    counter = iter(range(args.requests))
+    counter_lock = threading.Lock()
+    results = []
+    results_lock = threading.Lock()
+
+    def next_index():
+        with counter_lock:
+            return next(counter, None)
+
+    def virtual_user(user):
+        # Ogni utente virtuale ha il suo generatore: risultati riproducibili col seed
+        rng = random.Random(args.seed * 1000 + user)
+        model_id = rng.choices(model_ids, weights)[0]
+        while True:
+            index = next_index()
+            if index is None:
+                return
+            if rng.random() < args.switch_prob:
+                model_id = rng.choices(model_ids, weights)[0]
+            stream = rng.random() < args.stream_ratio
+            payload = {
+                'message': build_prompt(rng, prompt_words(rng), index, not args.repeat_prompts),
+                'model_id': model_id,
+                'history': [],
+                'max_tokens': max_tokens(rng),
+                'temperature': args.temperature
+            }
+
+            record = {'endpoint': 'stream' if stream else 'chat', 'model_id': model_id}
+            try:
+                runner = run_stream if stream else run_chat
+                record.update(runner(args.url, payload, args.timeout), ok=True)
+            except urllib.error.HTTPError as e:
+                record.update(ok=False, error=f"HTTP {e.code}")
+            except Exception as e:
+                record.update(ok=False, error=type(e).__name__ if not isinstance(e, RuntimeError) else str(e))
+
+            with results_lock:
+                results.append(record)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for user in range(args.concurrency):
+            pool.submit(virtual_user, user)
+    wall_time = time.perf_counter() - start
+
+    report = {
+        'config': {
+            'url': args.url,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'stream_ratio': args.stream_ratio,
+            'prompt_words': args.prompt_words,
+            'max_tokens': args.max_tokens,
+            'models': mix,
+            'switch_prob': args.switch_prob,
+            'temperature': args.temperature,
+            'seed': args.seed,
+            'fake': args.fake
+        },
+        'wall_time_s': round(wall_time, 3),
+        'overall': summarize(results, wall_time),
+        'by_endpoint': {},
+        'by_model': {}
+    }
+    for endpoint in ('chat', 'stream'):
+        subset = [r for r in results if r['endpoint'] == endpoint]
+        if subset:
+            report['by_endpoint'][endpoint] = summarize(subset, wall_time)
+    for model_id in model_ids:
+        subset = [r for r in results if r['model_id'] == model_id]
+        if subset:
+            report['by_model'][model_id] = summarize(subset, wall_time)
+    return report
+
+
+# ============================================================================
+# WEBAPP CON BACKEND FINTO
+# ============================================================================
+
+def start_fake_server(args):
+    """
+    Avvia la webapp vera (scheduler, prompt cache, cache delle risposte) in
+    questo processo con il backend di inferenza finto, su una porta libera.
+    Ritorna (server, url).
+    """
+    from werkzeug.serving import make_server
+
+    os.environ['INFERENCE_BACKEND'] = 'fake'
+    os.environ['FAKE_TOKEN_MS'] = str(args.fake_token_ms)
+    os.environ['FAKE_PREFILL_MS'] = str(args.fake_prefill_ms)
+    os.environ['FAKE_SWAP_MS'] = str(args.fake_switch_ms)
+    # Cache delle risposte temporanea: ogni run parte da zero
+    os.environ['RESPONSE_CACHE_PATH'] = str(Path(tempfile.mkdtemp(prefix='jarvis-bench-')) / 'responses.sqlite3')
+    sys.path.insert(0, str(WEBAPP_DIR))
+    import app as web
+
+    web.app.config['REQUIRE_AUTH_LOCAL'] = False
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, web.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark di carico e latenza per /api/chat e /api/chat/stream"
+    )
+    parser.add_argument("--url", type=str, default="http://localhost:8080",
+                        help="URL del server (default: http://localhost:8080)")
+    parser.add_argument("--requests", type=int, default=100, help="Numero totale di richieste (default: 100)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Utenti virtuali concorrenti (default: 8)")
+    parser.add_argument("--stream-ratio", type=float, default=0.5,
+                        help="Frazione di richieste su /api/chat/stream (default: 0.5)")
+    parser.add_argument("--prompt-words", type=str, default="lognormal:3.5:0.6",
+                        help="Distribuzione delle parole del prompt (default: lognormal:3.5:0.6)")
+    parser.add_argument("--max-tokens", type=str, default="uniform:64:256",
+                        help="Distribuzione di max_tokens (default: uniform:64:256)")
+    parser.add_argument("--models", type=str, default=None,
+                        help="Mix di esperti, es. programming:0.5,history:0.5 (default: tutti da models_config.json)")
+    parser.add_argument("--switch-prob", type=float, default=0.3,
+                        help="Probabilità di cambiare esperto tra due richieste dello stesso utente (default: 0.3)")
+    parser.add_argument("--temperature", type=float, default=0.7, help="Temperatura (default: 0.7)")
+    parser.add_argument("--repeat-prompts", action="store_true",
+                        help="Non rendere univoci i prompt (misura anche la cache delle risposte)")
+    parser.add_argument("--timeout", type=float, default=300, help="Timeout per richiesta in secondi (default: 300)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed per prompt e mix (default: 0)")
+    parser.add_argument("--output", type=str, default=None, help="File JSON del report (default: stdout)")
+    parser.add_argument("--fake", action="store_true",
+                        help="Avvia e usa la webapp locale con il backend finto (senza MLX)")
+    parser.add_argument("--fake-token-ms", type=float, default=10,
+                        help="Latenza di un passo di decoding del backend finto")
+    parser.add_argument("--fake-prefill-ms", type=float, default=0.2,
+                        help="Latenza di prefill per token del backend finto")
+    parser.add_argument("--fake-switch-ms", type=float, default=5,
+                        help="Costo dello swap dell'adapter nel backend finto")
+
+    args = parser.parse_args()
+    parse_distribution(args.prompt_words)
+    parse_distribution(args.max_tokens)
+
+    server = None
+    if args.fake:
+        server, args.url = start_fake_server(args)
+        print(f"🧪 Webapp con backend finto su {args.url}")
+    args.url = args.url.rstrip('/')
+
+    print(f"🚀 Benchmark: {args.requests} richieste, concorrenza {args.concurrency}")
+    report = run_benchmark(args)
+    if server is not None:
+        server.shutdown()
+
+    overall = report['overall']
+    print(f"✅ Completato in {report['wall_time_s']}s - errori: {overall['error_rate']}, "
+          f"token/s: {overall['throughput_tokens_per_sec']}")
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"💾 Report salvato: {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
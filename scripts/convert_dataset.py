@@ -4,73 +4,226 @@ Script SEMPLICISSIMO per convertire dataset in formato MLX.
 
 Usa un JSON semplice con "domanda" e "risposta", lo converte
 automaticamente in formato MLX per il training.
+
+Il file viene letto in streaming (array JSON letto un elemento alla volta,
+oppure JSONL riga per riga) e ogni esempio viene scritto subito in
+train.jsonl / valid.jsonl: la memoria usata non dipende dalla dimensione
+del dataset, anche con corpora da diversi GB.
 """
 
 import json
 import argparse
+import hashlib
+import time
 from pathlib import Path
 
+# Byte letti dal disco per volta
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Avvisi per formato non riconosciuto mostrati prima di limitarsi a contarli
+MAX_FORMAT_WARNINGS = 5
+
 
-def convert_to_mlx_format(data):
+def iter_json_array(f, chunk_size=READ_CHUNK_SIZE):
     """
-    Converte da formato semplice a formato MLX chat.
+    Legge un array JSON elemento per elemento.
 
-    Input: [{"domanda": "...", "risposta": "..."}]
-    Output: [{"messages": [{"role": "user", "content": "..."}, {"role": "assistant", "content": "..."}]}]
+    In memoria restano solo l'elemento corrente e il blocco letto dal disco.
     """
-    mlx_data = []
-
-    for item in data:
-        # Formato semplice: domanda/risposta
-        if "domanda" in item and "risposta" in item:
-            mlx_item = {
-                "messages": [
-                    {"role": "user", "content": item["domanda"]},
-                    {"role": "assistant", "content": item["risposta"]}
-                ]
-            }
-            mlx_data.append(mlx_item)
-
-        # Formato alternativo: question/answer (inglese)
-        elif "question" in item and "answer" in item:
-            mlx_item = {
-                "messages": [
-                    {"role": "user", "content": item["question"]},
-                    {"role": "assistant", "content": item["answer"]}
-                ]
-            }
-            mlx_data.append(mlx_item)
-
-        # Già in formato MLX: passa direttamente
-        elif "messages" in item:
-            mlx_data.append(item)
+    decoder = json.JSONDecoder()
+    buffer = ''
+    while not buffer:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        buffer = chunk.lstrip()
+    if not buffer.startswith('['):
+        raise ValueError("Il file JSON deve contenere un array di esempi")
+    pos = 1
+    eof = False
+
+    while True:
+        # Salta spazi e virgole tra un elemento e l'altro
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            buffer, pos = f.read(chunk_size), 0
+            eof = not buffer
+
+        if pos >= len(buffer):
+            raise ValueError("Array JSON non terminato")
+        if buffer[pos] == ']':
+            return
+
+        complete = False
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+            if end < len(buffer):
+                # Numeri e letterali possono continuare nel blocco successivo
+                # ("2." + "5e3"): sono completi solo se seguiti da un separatore
+                complete = buffer[pos] in '{["' or buffer[end] in ' \t\r\n,]'
+            else:
+                # Un elemento che arriva a fine blocco potrebbe continuare nel successivo
+                complete = eof
+        except json.JSONDecodeError:
+            if eof:
+                raise
+
+        if complete:
+            yield item
+            pos = end
+        elif eof:
+            raise ValueError(f"Elemento JSON non valido: {buffer[pos:pos + 40]!r}")
+        else:
+            more = f.read(chunk_size)
+            eof = not more
+            buffer, pos = buffer[pos:] + more, 0
+
+
+def iter_jsonl(f):
+    """Legge un file JSONL (un esempio per riga)"""
+    for line_number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Riga {line_number} non valida: {e}") from e
 
+
+def iter_input_items(input_path):
+    """Esempi del file di input: array JSON o JSONL (riconosciuto dal primo carattere)"""
+    with open(input_path, 'r', encoding='utf-8') as f:
+        head = f.read(4096).lstrip()
+        f.seek(0)
+        if head.startswith('['):
+            yield from iter_json_array(f)
         else:
-            print(f"⚠️  Formato non riconosciuto, skippo: {list(item.keys())}")
+            yield from iter_jsonl(f)
 
-    return mlx_data
 
+def convert_item(item):
+    """
+    Converte un esempio da formato semplice a formato MLX chat.
 
-def split_train_valid(data, split_ratio=0.8):
-    """Divide dataset in train e validation."""
-    n = len(data)
-    train_size = int(n * split_ratio)
+    Input: {"domanda": "...", "risposta": "..."}
+    Output: {"messages": [{"role": "user", "content": "..."}, {"role": "assistant", "content": "..."}]}
 
-    train = data[:train_size]
-    valid = data[train_size:]
+    Ritorna None se il formato non è riconosciuto.
+    """
+    # Formato semplice: domanda/risposta
+    if "domanda" in item and "risposta" in item:
+        return {
+            "messages": [
+                {"role": "user", "content": item["domanda"]},
+                {"role": "assistant", "content": item["risposta"]}
+            ]
+        }
+
+    # Formato alternativo: question/answer (inglese)
+    if "question" in item and "answer" in item:
+        return {
+            "messages": [
+                {"role": "user", "content": item["question"]},
+                {"role": "assistant", "content": item["answer"]}
+            ]
+        }
+
+    # Formato degli script da libro: user/assistant
+    if "user" in item and "assistant" in item:
+        return {
+            "messages": [
+                {"role": "user", "content": item["user"]},
+                {"role": "assistant", "content": item["assistant"]}
+            ]
+        }
+
+    # Già in formato MLX: passa direttamente
+    if "messages" in item:
+        return item
+
+    return None
+
+
+def iter_mlx_examples(items, stats=None):
+    """Converte gli esempi uno alla volta, saltando quelli non riconosciuti"""
+    for item in items:
+        converted = convert_item(item) if isinstance(item, dict) else None
+        if converted is None:
+            if stats is not None:
+                stats['skipped'] += 1
+                if stats['skipped'] <= MAX_FORMAT_WARNINGS:
+                    keys = list(item.keys()) if isinstance(item, dict) else type(item).__name__
+                    print(f"⚠️  Formato non riconosciuto, skippo: {keys}")
+            continue
+        yield converted
+
+
+def split_bucket(line, salt=""):
+    """
+    Posizione deterministica in [0, 1) di un esempio (la sua riga JSONL).
 
-    # Se valid è vuoto, usa almeno 1 esempio
-    if not valid and train:
-        valid = [train[-1]]
+    Dipende solo dal contenuto, non dall'ordine del file: aggiungere o
+    riordinare esempi non sposta gli altri da train a valid, e i duplicati
+    finiscono sempre nello stesso split.
+    """
+    digest = hashlib.sha1((salt + line).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
 
-    return train, valid
 
+def write_datasets(examples, train_file, valid_file, valid_ratio=None, salt=""):
+    """
+    Scrive train e valid man mano che arrivano gli esempi.
 
-def save_jsonl(data, filepath):
-    """Salva in formato JSONL."""
-    with open(filepath, 'w', encoding='utf-8') as f:
-        for item in data:
-            f.write(json.dumps(item, ensure_ascii=False) + '\n')
+    Con valid_ratio=None ogni esempio va in entrambi i file (tutto il
+    dataset per train e valid). I file vengono scritti con un nome
+    temporaneo e rinominati alla fine, così un errore a metà non lascia
+    un dataset troncato.
+    """
+    counts = {'train': 0, 'valid': 0}
+    first = last_train = last_valid = None
+    train_tmp = train_file.with_name(train_file.name + '.tmp')
+    valid_tmp = valid_file.with_name(valid_file.name + '.tmp')
+
+    try:
+        with open(train_tmp, 'w', encoding='utf-8') as train, open(valid_tmp, 'w', encoding='utf-8') as valid:
+            for example in examples:
+                line = json.dumps(example, ensure_ascii=False) + '\n'
+                if first is None:
+                    first = example
+
+                if valid_ratio is None:
+                    train.write(line)
+                    valid.write(line)
+                    counts['train'] += 1
+                    counts['valid'] += 1
+                elif split_bucket(line, salt) < valid_ratio:
+                    valid.write(line)
+                    counts['valid'] += 1
+                    last_valid = line
+                else:
+                    train.write(line)
+                    counts['train'] += 1
+                    last_train = line
+
+            # Nessuno dei due split resta vuoto: al più 1 esempio in comune
+            if counts['valid'] == 0 and last_train is not None:
+                valid.write(last_train)
+                counts['valid'] += 1
+            if counts['train'] == 0 and last_valid is not None:
+                train.write(last_valid)
+                counts['train'] += 1
+    except BaseException:
+        train_tmp.unlink(missing_ok=True)
+        valid_tmp.unlink(missing_ok=True)
+        raise
+
+    train_tmp.replace(train_file)
+    valid_tmp.replace(valid_file)
+    return counts, first
 
 
 def main():
@@ -80,7 +233,7 @@ def main():
     parser.add_argument(
         "input_file",
         type=str,
-        help="File JSON di input (es. my_data.json)"
+        help="File JSON (array) o JSONL di input (es. my_data.json)"
     )
     parser.add_argument(
         "--output-dir",
@@ -91,7 +244,48 @@ def main():
     parser.add_argument(
         "--split",
         action="store_true",
-        help="Dividi dataset in 80%% train, 20%% valid (default: usa tutto)"
+        help="Dividi dataset in train e valid (default: usa tutto per entrambi)"
+    )
+    parser.add_argument(
+        "--valid-ratio",
+        type=float,
+        default=0.2,
+        help="Frazione di esempi in valid con --split (default: 0.2)"
+    )
+    parser.add_argument(
+        "--split-salt",
+        type=str,
+        default="",
+        help="Cambia lo split mantenendolo deterministico (default: nessuno)"
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Scarta duplicati e quasi-duplicati (report in <output-dir>/dedup_report.json)"
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=0.8,
+        help="Similarità minima per considerare due esempi duplicati (default: 0.8)"
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Impacchetta più esempi per sequenza in <output-dir>/packed (vedi pack_dataset.py). "
+             "Compromesso: nel training ogni esempio vede quelli precedenti della sequenza come contesto"
+    )
+    parser.add_argument(
+        "--max-seq-length",
+        type=int,
+        default=1536,
+        help="Token per sequenza con --pack, come nel training (default: 1536)"
+    )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        default=None,
+        help="Tokenizer per --pack (default: base_model di models_config.json)"
     )
 
     args = parser.parse_args()
@@ -108,42 +302,48 @@ def main():
         print(f"❌ File non trovato: {input_path}")
         return
 
-    with open(input_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-
-    print(f"   ✓ Caricati {len(data)} esempi")
-
-    # Converti in formato MLX
-    print("\n🔄 Conversione in formato MLX...")
-    mlx_data = convert_to_mlx_format(data)
-    print(f"   ✓ {len(mlx_data)} esempi convertiti")
-
-    if not mlx_data:
-        print("❌ Nessun dato convertito! Controlla il formato.")
-        return
-
-    # Split train/valid
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
+    train_file = output_dir / "train.jsonl"
+    valid_file = output_dir / "valid.jsonl"
 
     if args.split:
-        # Dividi in train e valid
-        print(f"\n✂️  Split dataset (80% train, 20% valid)...")
-        train_data, valid_data = split_train_valid(mlx_data, 0.8)
-        print(f"   Train: {len(train_data)} esempi")
-        print(f"   Valid: {len(valid_data)} esempi")
+        print(f"\n✂️  Conversione e split ({1 - args.valid_ratio:.0%} train, "
+              f"{args.valid_ratio:.0%} valid, per hash del contenuto)...")
+        valid_ratio = args.valid_ratio
     else:
-        # Usa tutto per train e valid (stesso dataset) - DEFAULT
-        print("\n💾 Salvataggio (usa tutto il dataset per train e valid)...")
-        train_data = mlx_data
-        valid_data = mlx_data
-
-    # Salva
-    train_file = output_dir / "train.jsonl"
-    valid_file = output_dir / "valid.jsonl"
+        print("\n🔄 Conversione (usa tutto il dataset per train e valid)...")
+        valid_ratio = None
+
+    # Lettura, conversione e scrittura in streaming
+    stats = {'skipped': 0}
+    start = time.perf_counter()
+    examples = iter_mlx_examples(iter_input_items(input_path), stats)
+    if args.dedup:
+        # Import qui: numpy serve solo per la deduplicazione
+        from dedup_dataset import DuplicateReport, NearDuplicateIndex, dedup_examples
+
+        report = DuplicateReport()
+        examples = dedup_examples(examples, NearDuplicateIndex(args.dedup_threshold), report)
+    counts, first = write_datasets(examples, train_file, valid_file, valid_ratio, args.split_salt)
+    elapsed = time.perf_counter() - start
+
+    if first is None:
+        train_file.unlink(missing_ok=True)
+        valid_file.unlink(missing_ok=True)
+        print("❌ Nessun dato convertito! Controlla il formato.")
+        return
 
-    save_jsonl(train_data, train_file)
-    save_jsonl(valid_data, valid_file)
+    size_mb = input_path.stat().st_size / (1024 * 1024)
+    if stats['skipped']:
+        print(f"   ⚠️  {stats['skipped']} esempi saltati (formato non riconosciuto)")
+    print(f"   ✓ {size_mb:.1f} MB in {elapsed:.1f}s ({size_mb / max(elapsed, 1e-9):.1f} MB/s)")
+    if args.dedup:
+        report.print_summary()
+        report.save(output_dir / "dedup_report.json")
+        print(f"   Report: {output_dir / 'dedup_report.json'}")
+    print(f"   Train: {counts['train']} esempi")
+    print(f"   Valid: {counts['valid']} esempi")
 
     print(f"\n✅ Dataset pronti!")
     print("=" * 70)
@@ -154,11 +354,21 @@ def main():
     # Mostra esempio
     print(f"\n📄 Esempio convertito:")
     print("-" * 70)
-    print(json.dumps(train_data[0], ensure_ascii=False, indent=2))
+    print(json.dumps(first, ensure_ascii=False, indent=2))
     print("-" * 70)
 
+    data_dir = output_dir
+    if args.pack:
+        # Import qui: transformers serve solo per il packing
+        from pack_dataset import pack_dataset_dir, print_pack_summary
+        from token_chunker import load_tokenizer
+
+        print(f"\n📦 Packing (max_seq_length {args.max_seq_length})...")
+        data_dir, manifest = pack_dataset_dir(output_dir, load_tokenizer(args.tokenizer), args.max_seq_length)
+        print_pack_summary(data_dir, manifest)
+
     print("\n💡 Prossimo passo:")
-    print(f"   python -m mlx_lm lora --model <MODEL> --train --data {output_dir}")
+    print(f"   python -m mlx_lm lora --model <MODEL> --train --data {data_dir}")
     print()
 
 
@@ -2,67 +2,48 @@
 """
 Script per creare dataset di training da un libro completo in Markdown.
 Divide il libro in chunks e crea esempi Q&A per training.
+
+I chunk sono misurati in token con il tokenizer del modello base: ogni
+esempio (domanda + chunk + chat template) sta in --max-seq-length.
+
+Accetta più libri. I file vengono mappati in memoria (mmap) e divisi per
+headers senza decodificarli per intero; chunking, tokenizzazione e conteggio
+dei nomi di ogni sezione girano in un pool di processi (--workers). I
+risultati vengono uniti nell'ordine delle sezioni: l'output è identico a
+quello con un solo processo.
 """
 
 import re
+import os
 import json
+import mmap
+import time
 import argparse
+from collections import Counter
+from multiprocessing import Pool
 from pathlib import Path
-from typing import List, Dict
-
-def read_markdown(file_path: str) -> str:
-    """Legge il file markdown"""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return f.read()
-
-def split_by_headers(text: str) -> List[Dict[str, str]]:
-    """Divide il testo per headers markdown (# Titolo)"""
-    sections = []
-
-    # Split by headers
-    pattern = r'^(#{1,3})\s+(.+)$'
-    parts = re.split(pattern, text, flags=re.MULTILINE)
-
-    current_section = {"title": "Introduzione", "content": ""}
-
-    for i in range(0, len(parts)):
-        if i == 0 and parts[i].strip():
-            # Primo pezzo senza header
-            current_section["content"] = parts[i].strip()
-        elif i > 0 and parts[i].startswith('#'):
-            # Salva sezione precedente se ha contenuto
-            if current_section["content"].strip():
-                sections.append(current_section)
+from typing import List, Dict, Tuple
 
-            # Nuova sezione
-            level = parts[i]
-            title = parts[i+1] if i+1 < len(parts) else ""
-            content = parts[i+2] if i+2 < len(parts) else ""
+from convert_dataset import iter_mlx_examples, write_datasets
+from dedup_dataset import DuplicateReport, NearDuplicateIndex, dedup_examples
+from pack_dataset import pack_dataset_dir, print_pack_summary
+from token_chunker import TokenChunker, load_tokenizer, print_token_report, token_length_report
 
-            current_section = {
-                "title": title.strip(),
-                "content": content.strip()
-            }
+# Domande per i chunk di una sezione lunga (a rotazione)
+CHUNK_PROMPTS = [
+    "Parlami di {}",
+    "Continua la storia di {}",
+    "Descrivi la scena di {}",
+    "Cosa succede in {}?",
+]
 
-    # Aggiungi ultima sezione
-    if current_section["content"].strip():
-        sections.append(current_section)
+# Headers markdown (# ## ###), cercati direttamente sui byte del file
+HEADER_PATTERN = re.compile(rb'^(#{1,3})\s+(.+)$', re.MULTILINE)
 
-    return sections
+# Nomi propri (parole con l'iniziale maiuscola)
+NAME_PATTERN = re.compile(r'\b([A-Z][a-z]+)\b')
 
-def split_into_chunks(text: str, chunk_size: int = 800) -> List[str]:
-    """Divide il testo in chunks di parole"""
-    words = text.split()
-    chunks = []
-
-    for i in range(0, len(words), chunk_size):
-        chunk = ' '.join(words[i:i + chunk_size])
-        if chunk.strip():
-            chunks.append(chunk.strip())
-
-    return chunks
-
-def create_training_examples(sections: List[Dict[str, str]]) -> List[Dict[str, str]]:
+def create_training_examples(sections: List[Dict[str, str]], chunker: TokenChunker) -> List[Dict[str, str]]:
     """Crea esempi di training dal libro"""
     examples = []
 
@@ -73,48 +54,113 @@ def create_training_examples(sections: List[Dict[str, str]]) -> List[Dict[str, s
         if not content:
             continue
 
-        # Se la sezione è lunga, dividila in chunks
-        if len(content.split()) > 1000:
-            chunks = split_into_chunks(content, chunk_size=800)
+        prompts = [p.format(title) for p in CHUNK_PROMPTS]
+        short_prompts = [f"Parlami di {title}", f"Descrivi {title}"]
+
+        # Se la sezione non sta in un esempio, dividila in chunks
+        if chunker.count(content) > chunker.budget(short_prompts):
+            chunks = chunker.split(content, chunker.budget(prompts))
 
             for i, chunk in enumerate(chunks):
                 # Vari tipi di prompt
-                prompts = [
-                    f"Parlami di {title}",
-                    f"Continua la storia di {title}",
-                    f"Descrivi la scena di {title}",
-                    f"Cosa succede in {title}?",
-                ]
-
-                prompt = prompts[i % len(prompts)]
-
                 examples.append({
-                    "user": prompt,
+                    "user": prompts[i % len(prompts)],
                     "assistant": chunk
                 })
         else:
             # Sezione breve, usa intera
-            examples.append({
-                "user": f"Parlami di {title}",
-                "assistant": content
-            })
-
-            examples.append({
-                "user": f"Descrivi {title}",
-                "assistant": content
-            })
+            for prompt in short_prompts:
+                examples.append({
+                    "user": prompt,
+                    "assistant": content
+                })
 
     return examples
 
-def add_general_questions(examples: List[Dict[str, str]], book_content: str) -> List[Dict[str, str]]:
-    """Aggiunge domande generali sul libro"""
-
-    # Estrai personaggi principali (nomi propri all'inizio frase)
-    characters = re.findall(r'\b([A-Z][a-z]+)\b', book_content)
-    char_counts = {}
-    for char in characters:
-        if len(char) > 3:  # Ignora parole troppo corte
-            char_counts[char] = char_counts.get(char, 0) + 1
+def count_names(text: str) -> Counter:
+    """Conta i nomi propri (personaggi) di un testo"""
+    # Ignora parole troppo corte
+    return Counter(name for name in NAME_PATTERN.findall(text) if len(name) > 3)
+
+def find_sections(mm, title: str = "Introduzione") -> List[Tuple[str, int, int, int]]:
+    """
+    Sezioni di un file mappato in memoria: (titolo, inizio, inizio contenuto, fine).
+
+    Solo offset in byte: il testo viene decodificato dai worker. Gli
+    intervalli [inizio, fine) coprono tutto il file, headers compresi.
+    """
+    spans = []
+    start = content_start = 0
+    for match in HEADER_PATTERN.finditer(mm):
+        spans.append((title, start, content_start, match.start()))
+        title = match.group(2).decode('utf-8', errors='replace').strip()
+        start, content_start = match.start(), match.end()
+    spans.append((title, start, content_start, len(mm)))
+    return spans
+
+_chunker = None
+
+def _init_worker(tokenizer_name, max_seq_length, overlap):
+    """Un tokenizer per processo, caricato una volta sola"""
+    global _chunker
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    _chunker = TokenChunker(load_tokenizer(tokenizer_name), max_seq_length, overlap)
+
+def _process_section(task):
+    """Esempi, lunghezze in token e nomi di una sezione (eseguito nei worker)"""
+    path, title, start, content_start, end = task
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header = mm[start:content_start].decode('utf-8', errors='replace')
+        content = mm[content_start:end].decode('utf-8', errors='replace')
+
+    section = {"title": title, "content": content.strip()}
+    examples = create_training_examples([section], _chunker) if section["content"] else []
+    lengths = [_chunker.example_tokens(ex["user"], ex["assistant"]) for ex in examples]
+    return examples, lengths, count_names(header + content), end - start
+
+def process_books(book_files: List[str], tokenizer_name, max_seq_length: int, overlap: int, workers: int):
+    """
+    Divide i libri in sezioni e le elabora in parallelo.
+
+    Ritorna esempi, lunghezze in token, conteggio dei nomi e statistiche.
+    """
+    tasks = []
+    for path in book_files:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                tasks.extend((str(path), *span) for span in find_sections(mm))
+
+    examples, lengths, names = [], [], Counter()
+    stats = {'sections': 0, 'bytes': 0}
+    init_args = (tokenizer_name, max_seq_length, overlap)
+
+    if workers <= 1:
+        _init_worker(*init_args)
+        results = map(_process_section, tasks)
+        pool = None
+    else:
+        pool = Pool(workers, initializer=_init_worker, initargs=init_args)
+        # imap restituisce i risultati nell'ordine dei task: unione deterministica
+        results = pool.imap(_process_section, tasks, chunksize=max(1, len(tasks) // (workers * 8)))
+
+    try:
+        for section_examples, section_lengths, section_names, size in results:
+            examples.extend(section_examples)
+            lengths.extend(section_lengths)
+            names.update(section_names)
+            stats['bytes'] += size
+            stats['sections'] += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return examples, lengths, names, stats
+
+def add_general_questions(examples: List[Dict[str, str]], char_counts: Counter) -> List[Dict[str, str]]:
+    """Aggiunge domande generali sul libro (char_counts: nomi propri contati con count_names)"""
 
     # Top 10 personaggi più menzionati
     top_chars = sorted(char_counts.items(), key=lambda x: x[1], reverse=True)[:10]
@@ -151,34 +197,50 @@ def add_general_questions(examples: List[Dict[str, str]], book_content: str) ->
 
 def main():
     parser = argparse.ArgumentParser(description='Crea dataset da libro Markdown')
-    parser.add_argument('book_file', help='File .md del libro')
+    parser.add_argument('book_files', nargs='+', help='File .md del libro (anche più di uno)')
     parser.add_argument('--output-dir', default='data/physophia_expert',
                        help='Directory output (default: data/physophia_expert)')
-    parser.add_argument('--chunk-size', type=int, default=800,
-                       help='Dimensione chunks in parole (default: 800)')
+    parser.add_argument('--max-seq-length', type=int, default=1536,
+                       help='Token massimi per esempio, come nel training (default: 1536)')
+    parser.add_argument('--overlap', type=int, default=0,
+                       help='Token ripetuti tra un chunk e il successivo (default: 0)')
+    parser.add_argument('--tokenizer', default=None,
+                       help='Tokenizer (default: base_model di models_config.json)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                       help='Processi per sezioni e tokenizzazione (default: numero di CPU)')
+    parser.add_argument('--dedup', action='store_true',
+                       help='Scarta gli esempi quasi uguali (es. stessa sezione con domande diverse)')
+    parser.add_argument('--pack', action='store_true',
+                       help='Impacchetta più esempi per sequenza in <output-dir>/packed '
+                            '(nel training ogni esempio vede quelli precedenti della sequenza come contesto)')
 
     args = parser.parse_args()
 
-    # Leggi libro
-    print(f"📖 Lettura libro: {args.book_file}")
-    book_content = read_markdown(args.book_file)
-    word_count = len(book_content.split())
-    print(f"   Parole totali: {word_count:,}")
+    print(f"📖 Lettura libri: {', '.join(args.book_files)}")
+    total_mb = sum(Path(p).stat().st_size for p in args.book_files) / (1024 * 1024)
+    print(f"   Dimensione totale: {total_mb:.1f} MB")
 
-    # Dividi per sezioni
-    print("📑 Divisione in sezioni...")
-    sections = split_by_headers(book_content)
-    print(f"   Sezioni trovate: {len(sections)}")
-
-    # Crea esempi
-    print("🎯 Creazione esempi di training...")
-    examples = create_training_examples(sections)
+    # Sezioni, chunk, token e nomi in parallelo
+    print(f"🎯 Creazione esempi di training ({args.workers} processi)...")
+    start = time.perf_counter()
+    examples, lengths, names, stats = process_books(
+        args.book_files, args.tokenizer, args.max_seq_length, args.overlap, args.workers
+    )
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"   Sezioni: {stats['sections']}")
 
     # Aggiungi domande generali
     print("❓ Aggiunta domande generali...")
-    examples = add_general_questions(examples, book_content)
+    chunker = TokenChunker(load_tokenizer(args.tokenizer), args.max_seq_length, args.overlap)
+    general = add_general_questions([], names)
+    examples += general
+    lengths += [chunker.example_tokens(ex["user"], ex["assistant"]) for ex in general]
 
     print(f"✅ Esempi totali: {len(examples)}")
+    print(f"⚡ {stats['bytes'] / (1024 * 1024) / elapsed:.1f} MB/s, "
+          f"{stats['sections'] / elapsed:.1f} sezioni/s ({elapsed:.1f}s)")
+
+    print_token_report(token_length_report(lengths, args.max_seq_length), args.max_seq_length)
 
     # Crea directory
     output_dir = Path(args.output_dir)
@@ -194,15 +256,26 @@ def main():
 
     # Converti in JSONL
     print("\n🔄 Conversione in JSONL...")
-    from convert_to_jsonl import create_training_data
-
     train_file = output_dir / "train.jsonl"
     valid_file = output_dir / "valid.jsonl"
-
-    create_training_data(str(json_file), str(output_dir))
+    mlx_examples = iter_mlx_examples(examples)
+    if args.dedup:
+        report = DuplicateReport()
+        mlx_examples = dedup_examples(mlx_examples, NearDuplicateIndex(), report)
+    counts, _ = write_datasets(mlx_examples, train_file, valid_file)
+    if args.dedup:
+        report.print_summary()
+        report.save(output_dir / "dedup_report.json")
+        print(f"   Esempi dopo la deduplicazione: {counts['train']}")
 
     print(f"✅ Training set: {train_file}")
     print(f"✅ Validation set: {valid_file}")
+
+    if args.pack:
+        print(f"\n📦 Packing (max_seq_length {args.max_seq_length})...")
+        packed_dir, manifest = pack_dataset_dir(output_dir, chunker.tokenizer, args.max_seq_length)
+        print_pack_summary(packed_dir, manifest)
+
     print("\n🎉 Dataset pronto per training!")
 
 if __name__ == "__main__":
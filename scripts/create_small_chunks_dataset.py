@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 """
-Script per creare dataset di training da book2.md con chunk MOLTO piccoli (200 parole max)
-per evitare OOM durante il training.
+Script per creare dataset di training da book2.md con chunk MOLTO piccoli
+(512 token max per esempio, chat template compreso) per evitare OOM durante
+il training.
 """
 
+import argparse
 import json
 import re
 from pathlib import Path
 from typing import List, Dict
 
+from token_chunker import TokenChunker, load_tokenizer, print_token_report, token_length_report
+
+# Token massimi per esempio: abbastanza piccoli per il training senza OOM
+MAX_SEQ_LENGTH = 512
+
 def read_book(file_path: str) -> str:
     """Legge il file markdown del libro"""
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -64,25 +71,10 @@ def split_by_headers(text: str) -> List[Dict[str, str]]:
 
     return sections
 
-def split_into_small_chunks(text: str, max_words: int = 200) -> List[str]:
-    """
-    Divide il testo in chunk MOLTO piccoli.
-    Ogni chunk è max 200 parole per evitare OOM.
-    """
-    words = text.split()
-    chunks = []
-
-    for i in range(0, len(words), max_words):
-        chunk = ' '.join(words[i:i + max_words])
-        if chunk.strip():
-            chunks.append(chunk.strip())
-
-    return chunks
-
-def create_training_examples(sections: List[Dict[str, str]], max_words: int = 200) -> List[Dict[str, str]]:
+def create_training_examples(sections: List[Dict[str, str]], chunker: TokenChunker) -> List[Dict[str, str]]:
     """
     Crea esempi di training dal libro.
-    Ogni esempio ha MAX 200 parole per gestibilità memoria.
+    Ogni esempio sta in chunker.max_seq_length token per gestibilità memoria.
     """
     examples = []
 
@@ -99,8 +91,9 @@ def create_training_examples(sections: List[Dict[str, str]], max_words: int = 20
         title = section["title"]
         content = section["content"]
 
-        # Sempre dividi in chunk piccoli
-        chunks = split_into_small_chunks(content, max_words=max_words)
+        # Budget per il prompt più lungo (con "parte X" se servono più chunk)
+        budget = chunker.budget([t.format(f"{title} (parte 999)") for t in prompts_templates])
+        chunks = chunker.split(content, budget)
 
         for i, chunk in enumerate(chunks):
             # Varia i prompt
@@ -120,9 +113,22 @@ def create_training_examples(sections: List[Dict[str, str]], max_words: int = 20
     return examples
 
 def main():
+    parser = argparse.ArgumentParser(description='Crea dataset a chunk piccoli da libro Markdown')
+    parser.add_argument('book_file', nargs='?', default=str(Path.home() / "Desktop" / "book2.md"),
+                        help='File .md del libro (default: ~/Desktop/book2.md)')
+    parser.add_argument('--output-dir', default='data/physophia_expert',
+                        help='Directory output (default: data/physophia_expert)')
+    parser.add_argument('--max-seq-length', type=int, default=MAX_SEQ_LENGTH,
+                        help=f'Token massimi per esempio (default: {MAX_SEQ_LENGTH})')
+    parser.add_argument('--overlap', type=int, default=0,
+                        help='Token ripetuti tra un chunk e il successivo (default: 0)')
+    parser.add_argument('--tokenizer', default=None,
+                        help='Tokenizer (default: base_model di models_config.json)')
+    args = parser.parse_args()
+
     # Path del libro
-    book_path = Path.home() / "Desktop" / "book2.md"
-    output_dir = Path("data/physophia_expert")
+    book_path = Path(args.book_file)
+    output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
     print("📖 Leggo il libro...")
@@ -132,20 +138,13 @@ def main():
     sections = split_by_headers(book_text)
     print(f"   Trovate {len(sections)} sezioni")
 
-    print("🔪 Creo chunk MOLTO piccoli (max 200 parole)...")
-    examples = create_training_examples(sections, max_words=200)
+    print(f"🔪 Creo chunk MOLTO piccoli (max {args.max_seq_length} token per esempio)...")
+    chunker = TokenChunker(load_tokenizer(args.tokenizer), args.max_seq_length, args.overlap)
+    examples = create_training_examples(sections, chunker)
 
     # Statistiche
-    word_counts = [len(ex['assistant'].split()) for ex in examples]
-    total_words = sum(word_counts)
-    avg_words = total_words / len(examples) if examples else 0
-    max_words_in_example = max(word_counts) if word_counts else 0
-
-    print(f"\n📊 Statistiche dataset:")
-    print(f"   Esempi totali: {len(examples)}")
-    print(f"   Parole totali: {total_words:,}")
-    print(f"   Media parole per esempio: {avg_words:.1f}")
-    print(f"   Max parole in un esempio: {max_words_in_example}")
+    lengths = [chunker.example_tokens(ex["user"], ex["assistant"]) for ex in examples]
+    print_token_report(token_length_report(lengths, args.max_seq_length), args.max_seq_length)
 
     # Salva dataset completo
     output_file = output_dir / "my_data_small.json"
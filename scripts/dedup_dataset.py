@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Ricerca di duplicati e quasi-duplicati nei dataset (MinHash + LSH).
+
+Ogni esempio (domanda + risposta, normalizzate) diventa un insieme di
+shingle di caratteri; la firma MinHash stima la similarità di Jaccard tra
+due esempi e l'indice LSH a bande trova i candidati senza confrontare tutte
+le coppie. I duplicati esatti vengono riconosciuti prima, con un hash del
+testo normalizzato.
+
+L'indice è incrementale: il primo esempio di ogni gruppo viene tenuto, i
+successivi simili oltre la soglia vengono segnalati (ed eventualmente
+scartati) man mano che arrivano, quindi funziona anche dentro la
+conversione in streaming.
+
+Esempio:
+    python dedup_dataset.py ../data/history_expert/my_data.json ../data/history_expert/my_data_fixed.json
+    python dedup_dataset.py ../data/*_expert/my_data.json --output merged.json
+"""
+
+import argparse
+import hashlib
+import json
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from convert_dataset import convert_item, iter_input_items
+
+# Soglia di similarità (Jaccard stimata) oltre la quale due esempi sono duplicati
+DEFAULT_THRESHOLD = 0.8
+
+NUM_PERM = 128
+BANDS = 32
+SHINGLE_SIZE = 5
+
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WORDS = re.compile(r'\w+')
+
+
+def _messages(example) -> List[Dict]:
+    converted = convert_item(example) if isinstance(example, dict) else None
+    return converted["messages"] if converted else []
+
+
+def example_text(example: Dict) -> str:
+    """Testo confrontato: contenuti di tutti i messaggi, normalizzati"""
+    messages = _messages(example)
+    text = ' '.join(m.get('content', '') for m in messages if m.get('role') != 'system')
+    return ' '.join(_WORDS.findall(text.lower()))
+
+
+class NearDuplicateIndex:
+    """
+    Indice MinHash/LSH incrementale.
+
+    Con `bands` bande da `num_perm / bands` righe, due esempi con
+    similarità s finiscono nello stesso bucket almeno una volta con
+    probabilità 1 - (1 - s^r)^b: con 32x4 un esempio simile al 70% viene
+    trovato nel 99.9% dei casi. I candidati vengono poi verificati sulla
+    firma completa.
+    """
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, num_perm: int = NUM_PERM,
+                 bands: int = BANDS, shingle_size: int = SHINGLE_SIZE, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm deve essere multiplo di bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        # Moltiplicatori dispari a 64 bit per l'hashing multiply-shift
+        self._a = rng.randint(0, 1 << 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.randint(0, 1 << 63, size=num_perm, dtype=np.uint64)
+
+        self.exact: Dict[bytes, int] = {}
+        self.signatures: Dict[int, np.ndarray] = {}
+        self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+
+    def signature(self, text: str) -> np.ndarray:
+        """Firma MinHash degli shingle di caratteri del testo"""
+        k = self.shingle_size
+        codes = np.frombuffer((text or ' ').encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        if len(codes) < k:
+            codes = np.pad(codes, (0, k - len(codes)))
+        # Hash polinomiale di ogni finestra di k caratteri, calcolato su tutto il testo insieme
+        n = len(codes) - k + 1
+        hashes = np.zeros(n, dtype=np.uint64)
+        for j in range(k):
+            hashes = (hashes * np.uint64(1000003) + codes[j:j + n]) & _MAX_HASH
+        hashes = np.unique(hashes)
+        # Una funzione di hash per permutazione: (a*x + b) mod 2^64, 32 bit alti
+        with np.errstate(over='ignore'):
+            permuted = (np.outer(hashes, self._a) + self._b) >> np.uint64(32)
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def add(self, key: int, text: str) -> Optional[Tuple[int, float]]:
+        """
+        Aggiunge un esempio all'indice.
+
+        Se è un duplicato di un esempio già presente ritorna (chiave
+        dell'esempio, similarità) e non lo indicizza, altrimenti None.
+        """
+        digest = hashlib.sha1(text.encode('utf-8')).digest()
+        if digest in self.exact:
+            return self.exact[digest], 1.0
+
+        signature = self.signature(text)
+        bands = [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+        best = None
+        checked = set()
+        for band, bucket in zip(bands, self.buckets):
+            for other in bucket.get(band, ()):
+                if other in checked:
+                    continue
+                checked.add(other)
+                similarity = float(np.mean(signature == self.signatures[other]))
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (other, similarity)
+        if best is not None:
+            return best
+
+        self.exact[digest] = key
+        self.signatures[key] = signature
+        for band, bucket in zip(bands, self.buckets):
+            bucket.setdefault(band, []).append(key)
+        return None
+
+
+class DuplicateReport:
+    """Gruppi di duplicati: per ogni esempio tenuto, quelli simili trovati dopo"""
+
+    def __init__(self):
+        self.examples = 0
+        # Esempi in formato non riconosciuto (o senza testo): non confrontati
+        self.unrecognized = 0
+        self.kept: Dict[int, Dict] = {}
+        self.clusters: Dict[int, List[Dict]] = {}
+
+    def record(self, key: int, source: Dict, match: Optional[Tuple[int, float]]):
+        self.examples += 1
+        if match is None:
+            self.kept[key] = source
+            return
+        other, similarity = match
+        self.clusters.setdefault(other, []).append(dict(source, similarity=round(similarity, 3)))
+
+    @property
+    def duplicates(self) -> int:
+        return sum(len(members) for members in self.clusters.values())
+
+    def to_dict(self) -> Dict:
+        return {
+            'examples': self.examples,
+            'unrecognized': self.unrecognized,
+            'duplicates': self.duplicates,
+            'clusters': [
+                {'kept': self.kept[key], 'duplicates': members}
+                for key, members in sorted(self.clusters.items())
+            ]
+        }
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def print_summary(self, max_clusters: int = 5):
+        print(f"\n🔍 Duplicati: {self.duplicates} su {self.examples} esempi "
+              f"({len(self.clusters)} gruppi)")
+        if self.unrecognized:
+            print(f"   ⚠️  {self.unrecognized} esempi non confrontati (formato non riconosciuto)")
+        for key, members in sorted(self.clusters.items())[:max_clusters]:
+            print(f"   • {self.kept[key]['preview']!r}")
+            for member in members[:3]:
+                print(f"       ≈ {member['preview']!r} ({member['similarity']:.0%})")
+        if len(self.clusters) > max_clusters:
+            print(f"   ... altri {len(self.clusters) - max_clusters} gruppi nel report")
+
+
+def _source(example: Dict, **where) -> Dict:
+    question = next((m['content'] for m in _messages(example) if m.get('role') == 'user'), '')
+    return dict(where, preview=question[:80])
+
+
+def dedup_examples(examples, index: NearDuplicateIndex, report: DuplicateReport, drop: bool = True, **where):
+    """
+    Filtra uno stream di esempi, registrando i duplicati nel report.
+
+    Con drop=False gli esempi passano tutti (solo report). Gli esempi in
+    formato non riconosciuto passano senza essere indicizzati: con un testo
+    vuoto sembrerebbero tutti duplicati esatti l'uno dell'altro.
+    """
+    for i, example in enumerate(examples):
+        text = example_text(example)
+        if not text:
+            report.unrecognized += 1
+            yield example
+            continue
+        key = report.examples
+        match = index.add(key, text)
+        report.record(key, _source(example, index=i, **where), match)
+        if match is None or not drop:
+            yield example
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trova duplicati e quasi-duplicati nei dataset (MinHash + LSH)")
+    parser.add_argument("input_files", nargs="+", help="File JSON (array) o JSONL da confrontare")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"Similarità minima per considerare due esempi duplicati (default: {DEFAULT_THRESHOLD})")
+    parser.add_argument("--report", type=str, default="dedup_report.json",
+                        help="File del report con i gruppi di duplicati (default: dedup_report.json)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Scrive gli esempi senza duplicati (array JSON) in questo file")
+    args = parser.parse_args()
+
+    print("=" * 70)
+    print("🔍 Ricerca duplicati")
+    print("=" * 70)
+
+    index = NearDuplicateIndex(args.threshold)
+    report = DuplicateReport()
+    kept = []
+    for path in args.input_files:
+        print(f"📁 {path}")
+        kept.extend(dedup_examples(iter_input_items(Path(path)), index, report, file=path))
+
+    report.print_summary()
+    report.save(args.report)
+    print(f"\n📋 Report: {args.report}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(kept, f, ensure_ascii=False, indent=2)
+        print(f"💾 {len(kept)} esempi senza duplicati: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Packing delle sequenze di training (first-fit-decreasing).
+
+I dataset sono una domanda e una risposta brevi per riga: con batch_size 1
+e max_seq_length 1536 quasi tutto il passo di training lavora su poche
+centinaia di token. Qui più esempi vengono messi nella stessa sequenza,
+come turni successivi della stessa conversazione (i confini restano quelli
+del chat template), fino a riempire max_seq_length: meno passi per epoca a
+parità di token.
+
+Attenzione, è un compromesso: `mlx_lm lora` non isola gli esempi dentro una
+sequenza (niente maschera di attenzione per segmento né separatori
+riconosciuti dal training). Ogni risposta viene quindi addestrata con le
+coppie domanda/risposta precedenti, estranee, come contesto: il modello
+impara anche a rispondere "in mezzo" a conversazioni non correlate. Va
+bene per esperti con molti esempi brevi e indipendenti; se il contesto
+conta (dialoghi a più turni, risposte che rimandano a turni precedenti)
+usa il dataset non impacchettato. Il dataset originale resta invariato.
+
+Per ogni file vengono scritti il JSONL "packed" e un manifest con la
+composizione di ogni sequenza e le statistiche di riempimento. Gli esempi
+vengono letti due volte dal disco (token, poi scrittura) e in memoria
+restano solo offset e lunghezze.
+
+Esempio:
+    python pack_dataset.py ../data/biology_expert --max-seq-length 1536
+    python -m mlx_lm lora --model <MODEL> --train --data ../data/biology_expert/packed
+"""
+
+import argparse
+import json
+from pathlib import Path
+from typing import Dict, List
+
+from token_chunker import count_messages, load_tokenizer, print_token_report, token_length_report
+
+# Scritto nel manifest e mostrato dopo il packing
+PACKING_NOTE = (
+    "Gli esempi di una sequenza sono turni della stessa conversazione, senza isolamento "
+    "dell'attenzione: ogni risposta viene addestrata con gli esempi precedenti (estranei) "
+    "come contesto. Per dati in cui il contesto conta usa il dataset non impacchettato."
+)
+
+
+class _FirstFit:
+    """
+    Bin con capacità residua in un segment tree: il primo bin in cui
+    l'elemento entra si trova in O(log n). I bin non ancora usati hanno
+    capacità piena, quindi "aprire un bin nuovo" è solo il primo di loro.
+    """
+
+    def __init__(self, max_bins, capacity):
+        self.size = 1
+        while self.size < max_bins:
+            self.size *= 2
+        self.tree = [capacity] * (2 * self.size)
+        self.used = 0
+
+    def place(self, length):
+        node = 1
+        while node < self.size:
+            node = 2 * node if self.tree[2 * node] >= length else 2 * node + 1
+        index = node - self.size
+        self.tree[node] -= length
+        node //= 2
+        while node:
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+            node //= 2
+        self.used = max(self.used, index + 1)
+        return index
+
+
+def first_fit_decreasing(lengths: List[int], capacity: int) -> List[List[int]]:
+    """
+    Raggruppa gli indici degli esempi in bin di al più `capacity` token.
+
+    Gli esempi più lunghi della capacità restano da soli nel loro bin.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: (-lengths[i], i))
+    fitting = [i for i in order if lengths[i] <= capacity]
+    bins = [[i] for i in order if lengths[i] > capacity]
+
+    packer = _FirstFit(max(1, len(fitting)), capacity)
+    packed = [[] for _ in range(len(fitting))]
+    for i in fitting:
+        packed[packer.place(lengths[i])].append(i)
+    return bins + packed[:packer.used]
+
+
+def _header_tokens(tokenizer, messages):
+    """Token che il template mette una volta sola per conversazione (es. system prompt predefinito)"""
+    one = count_messages(tokenizer, messages)
+    two = count_messages(tokenizer, messages + messages)
+    return max(0, 2 * one - two)
+
+
+def _merge(examples):
+    """Una conversazione con i turni di tutti gli esempi, system prompt ripetuti tolti"""
+    messages = list(examples[0]['messages'])
+    system = messages[0] if messages and messages[0]['role'] == 'system' else None
+    for example in examples[1:]:
+        turns = example['messages']
+        if system is not None and turns and turns[0] == system:
+            turns = turns[1:]
+        messages.extend(turns)
+    return {"messages": messages}
+
+
+def pack_jsonl(input_file, output_file, tokenizer, max_seq_length=1536) -> Dict:
+    """Scrive in output_file gli esempi di input_file impacchettati; ritorna il manifest"""
+    input_file, output_file = Path(input_file), Path(output_file)
+
+    # Prima lettura: offset e token di ogni esempio
+    offsets, lengths = [], []
+    header = None
+    with open(input_file, 'rb') as f:
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            messages = json.loads(line)['messages']
+            if header is None:
+                header = _header_tokens(tokenizer, messages)
+            offsets.append(offset)
+            lengths.append(count_messages(tokenizer, messages))
+
+    if not offsets:
+        raise ValueError(f"Nessun esempio in {input_file}")
+
+    # Il blocco iniziale del template si paga una volta per sequenza
+    turn_lengths = [n - header for n in lengths]
+    bins = first_fit_decreasing(turn_lengths, max_seq_length - header)
+
+    # Seconda lettura: scrittura delle sequenze; la lunghezza stimata viene
+    # verificata e gli esempi in eccesso passano a una sequenza nuova
+    sequences, packed_lengths, oversized = [], [], 0
+    tmp_file = output_file.with_name(output_file.name + '.tmp')
+    with open(input_file, 'rb') as f, open(tmp_file, 'w', encoding='utf-8') as out:
+        def read(i):
+            f.seek(offsets[i])
+            return json.loads(f.readline())
+
+        b = 0
+        while b < len(bins):
+            indices = bins[b]
+            packed = _merge([read(i) for i in indices])
+            n = count_messages(tokenizer, packed['messages'])
+            if n > max_seq_length and len(indices) > 1:
+                bins.append([indices.pop()])
+                continue
+            oversized += int(n > max_seq_length)
+            out.write(json.dumps(packed, ensure_ascii=False) + '\n')
+            sequences.append(sorted(indices))
+            packed_lengths.append(n)
+            b += 1
+    tmp_file.replace(output_file)
+
+    total = sum(packed_lengths)
+    return {
+        'source': str(input_file),
+        'output': str(output_file),
+        'max_seq_length': max_seq_length,
+        'note': PACKING_NOTE,
+        'examples': len(offsets),
+        'sequences': len(sequences),
+        'source_tokens': sum(lengths),
+        'packed_tokens': total,
+        'fill_ratio': round(total / (len(sequences) * max_seq_length), 3),
+        'oversized_sequences': oversized,
+        'lengths': token_length_report(packed_lengths, max_seq_length),
+        # Numero di riga (da 0) degli esempi in ogni sequenza
+        'composition': sequences
+    }
+
+
+def pack_dataset_dir(data_dir, tokenizer, max_seq_length=1536, output_dir=None):
+    """
+    Impacchetta train.jsonl e valid.jsonl di una directory di dataset.
+
+    Scrive in output_dir (default data_dir/packed) i due file e manifest.json,
+    pronti per `mlx_lm lora --data`.
+    """
+    data_dir = Path(data_dir)
+    output_dir = Path(output_dir) if output_dir else data_dir / "packed"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = {}
+    for split in ("train", "valid"):
+        source = data_dir / f"{split}.jsonl"
+        if source.exists():
+            manifest[split] = pack_jsonl(source, output_dir / f"{split}.jsonl", tokenizer, max_seq_length)
+
+    with open(output_dir / "manifest.json", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return output_dir, manifest
+
+
+def print_pack_summary(output_dir, manifest):
+    for split, info in manifest.items():
+        print(f"   {split}: {info['examples']} esempi → {info['sequences']} sequenze "
+              f"(riempimento {info['fill_ratio']:.0%})")
+    if 'train' in manifest:
+        print_token_report(manifest['train']['lengths'], manifest['train']['max_seq_length'])
+    print(f"\n⚠️  {PACKING_NOTE}")
+    print(f"\n📦 Dataset packed: {output_dir}")
+    print(f"📋 Manifest: {output_dir / 'manifest.json'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Packing delle sequenze di training (first-fit-decreasing). Gli esempi di una "
+                    "sequenza si vedono a vicenda come contesto durante il training: vedi la nota in testa al file."
+    )
+    parser.add_argument("data_dir", type=str, help="Directory con train.jsonl e valid.jsonl")
+    parser.add_argument("--output-dir", type=str, default=None, help="Directory di output (default: <data_dir>/packed)")
+    parser.add_argument("--max-seq-length", type=int, default=1536,
+                        help="Token massimi per sequenza, come nel training (default: 1536)")
+    parser.add_argument("--tokenizer", type=str, default=None,
+                        help="Tokenizer (default: base_model di models_config.json)")
+    args = parser.parse_args()
+
+    print("=" * 70)
+    print("📦 Packing delle sequenze di training")
+    print("=" * 70)
+
+    output_dir, manifest = pack_dataset_dir(
+        args.data_dir, load_tokenizer(args.tokenizer), args.max_seq_length, args.output_dir
+    )
+    print_pack_summary(output_dir, manifest)
+
+
+if __name__ == "__main__":
+    main()
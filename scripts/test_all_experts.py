@@ -1,19 +1,36 @@
 #!/usr/bin/env python3
 """
 Test completo di tutti i modelli esperti con domande appropriate
+
+Il modello base viene caricato una sola volta: per ogni esperto si attacca
+il suo adapter LoRA e tutte le sue domande vengono generate insieme in un
+unico batch (lo stesso scheduler della webapp).
+
+Con --output salva un report JSONL (una riga per domanda: risposta, token,
+TTFT, token/s); con --compare confronta due report e segnala regressioni di
+velocità e risposte cambiate.
+
+Esempi:
+    python scripts/test_all_experts.py
+    python scripts/test_all_experts.py --output eval/run_a.jsonl --from-data 8
+    python scripts/test_all_experts.py --compare eval/run_a.jsonl eval/run_b.jsonl
 """
 
+import argparse
+import difflib
+import json
+import statistics
 import sys
+import time
+from datetime import datetime
 from pathlib import Path
-sys.path.append(str(Path(__file__).parent.parent))
-
-from mlx_lm import load, generate
-import json
 
 # Percorsi
 BASE_DIR = Path(__file__).parent.parent
 MODELS_DIR = BASE_DIR / "models"
+DATA_DIR = BASE_DIR / "data"
 CONFIG_FILE = MODELS_DIR / "models_config.json"
+WEBAPP_DIR = BASE_DIR / "webapp"
 
 # Domande di test per ogni esperto
 TEST_QUESTIONS = {
@@ -43,110 +60,187 @@ TEST_QUESTIONS = {
     ]
 }
 
-def format_prompt(message):
-    """Formatta il prompt in formato chat"""
-    return f"<|im_start|>user\n{message}<|im_end|>\n<|im_start|>assistant\n"
-
-
-def test_expert(expert_id, base_model, adapter_path, questions):
-    """Testa un esperto con domande specifiche"""
-    print(f"\n{'='*70}")
-    print(f"🧪 TEST: {expert_id}")
-    print(f"{'='*70}\n")
-
-    try:
-        # Carica il modello
-        print(f"📦 Caricamento modello...")
-        print(f"   Base: {base_model}")
-        print(f"   Adapter: {adapter_path if adapter_path else 'None (modello base)'}")
-
-        if adapter_path:
-            model, tokenizer = load(base_model, adapter_path=str(adapter_path))
-        else:
-            model, tokenizer = load(base_model)
 
-        print(f"✅ Modello caricato!\n")
-
-        # Testa ogni domanda
-        for i, question in enumerate(questions, 1):
-            print(f"❓ Domanda {i}: {question}")
-            print(f"{'─'*70}")
-
-            # Formatta prompt
-            prompt = format_prompt(question)
-
-            # Genera risposta con parametri controllati
-            response = generate(
-                model,
-                tokenizer,
-                prompt=prompt,
-                max_tokens=300,  # Limitato per test veloce
-                verbose=False
-            )
-
-            # Pulisci risposta
-            response = response.replace("<|im_end|>", "").strip()
-
-            print(f"🤖 Risposta:\n{response}")
-            print(f"{'─'*70}\n")
-
-        print(f"✅ Test completato per {expert_id}\n")
-        return True
-
-    except Exception as e:
-        print(f"❌ ERRORE durante test di {expert_id}: {e}\n")
-        return False
-
-
-def main():
-    print("="*70)
+def load_config():
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def dataset_questions(adapter_path, limit):
+    """Prime `limit` domande del dataset di training dell'esperto (se c'è)"""
+    if not adapter_path or limit <= 0:
+        return []
+    data_file = DATA_DIR / adapter_path / "my_data.json"
+    if not data_file.exists():
+        return []
+    with open(data_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    questions = [item.get('domanda') or item.get('question') for item in data]
+    return [q for q in questions if q][:limit]
+
+
+def questions_for(model_info, from_data):
+    questions = list(TEST_QUESTIONS.get(model_info['id'], ["Test generico"]))
+    for q in dataset_questions(model_info.get('adapter_path'), from_data):
+        if q not in questions:
+            questions.append(q)
+    return questions
+
+
+# ============================================================================
+# VALUTAZIONE
+# ============================================================================
+
+def create_runtime(base_model, backend_name, batch_size):
+    """Backend, modello base residente, scheduler e costruttore di prompt della webapp"""
+    sys.path.insert(0, str(WEBAPP_DIR))
+    from backends import get_backend
+    from model_manager import ModelManager
+    from prompting import PromptBuilder
+    from scheduler import InferenceScheduler
+
+    backend = get_backend(backend_name)
+    manager = ModelManager(base_model, MODELS_DIR, 512 * 1024 * 1024, backend)
+    manager.ensure_base()
+    scheduler = InferenceScheduler(manager, max_batch_size=batch_size)
+    return manager, scheduler, PromptBuilder(manager.tokenizer)
+
+
+def evaluate_expert(manager, scheduler, builder, model_info, questions, max_tokens, temperature):
+    """
+    Genera tutte le risposte di un esperto in un solo batch.
+
+    Le richieste vengono messe in coda insieme: lo scheduler fa uno swap
+    dell'adapter e le decodifica nello stesso forward pass.
+    """
+    adapter_path = model_info.get('adapter_path')
+    system_prompt = model_info.get('system_prompt')
+
+    # Lettura dell'adapter e swap fuori dal tempo delle domande
+    swap_start = time.perf_counter()
+    with manager.lock:
+        manager.activate(model_info['id'], adapter_path)
+    swap_ms = (time.perf_counter() - swap_start) * 1000
+
+    start = time.perf_counter()
+    requests = [
+        scheduler.submit(
+            model_info['id'], adapter_path, builder.build(q, [], system_prompt),
+            max_tokens=max_tokens, temperature=temperature
+        )
+        for q in questions
+    ]
+    rows = []
+    for question, request in zip(questions, requests):
+        response = request.text(manager.tokenizer).replace("<|im_end|>", "").strip()
+        stats = request.stats.to_dict()
+        rows.append({
+            'type': 'answer',
+            'expert': model_info['id'],
+            'question': question,
+            'response': response,
+            'prompt_tokens': stats['prompt_tokens'],
+            'generated_tokens': stats['generated_tokens'],
+            'ttft_ms': stats['ttft_ms'],
+            'total_ms': stats['total_ms'],
+            'tokens_per_sec': stats['tokens_per_sec'],
+            'finish_reason': stats['finish_reason']
+        })
+    wall = time.perf_counter() - start
+
+    generated = sum(r['generated_tokens'] for r in rows)
+    summary = {
+        'type': 'expert',
+        'expert': model_info['id'],
+        'questions': len(rows),
+        'swap_ms': round(swap_ms, 1),
+        'wall_s': round(wall, 3),
+        'generated_tokens': generated,
+        'batch_tokens_per_sec': round(generated / wall, 2) if wall > 0 else None
+    }
+    return rows, summary
+
+
+def run_eval(args):
+    print("=" * 70)
     print("🧪 TEST COMPLETO DI TUTTI GLI ESPERTI")
-    print("="*70)
+    print("=" * 70)
 
     # Carica configurazione
     if not CONFIG_FILE.exists():
         print(f"❌ File di configurazione non trovato: {CONFIG_FILE}")
-        return
-
-    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-        config = json.load(f)
+        return 1
 
+    config = load_config()
     base_model = config['base_model']
-    models = config['models']
+    models = [m for m in config['models'] if m.get('enabled', True)]
+    if args.experts:
+        models = [m for m in models if m['id'] in args.experts]
 
     print(f"\n📋 Modello base: {base_model}")
     print(f"📋 Esperti da testare: {len(models)}\n")
 
-    results = {}
-
-    # Testa ogni modello
-    for model_info in models:
-        model_id = model_info['id']
+    manager, scheduler, builder = create_runtime(base_model, args.backend, args.batch_size)
+
+    report = None
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        report = open(args.output, 'w', encoding='utf-8')
+        report.write(json.dumps({
+            'type': 'run',
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'base_model': base_model,
+            'backend': args.backend,
+            'max_tokens': args.max_tokens,
+            'temperature': args.temperature,
+            'batch_size': args.batch_size
+        }, ensure_ascii=False) + "\n")
 
-        # Skip se disabilitato
-        if not model_info.get('enabled', True):
-            print(f"⏭️  Saltato {model_id} (disabilitato)\n")
-            continue
-
-        # Verifica che l'adapter esista (se non è None)
-        adapter_path_str = model_info.get('adapter_path')
+    results = {}
+    try:
+        for model_info in models:
+            model_id = model_info['id']
 
-        if adapter_path_str is None:
-            # Modello base senza adapter
-            adapter_path = None
-        else:
-            adapter_path = MODELS_DIR / adapter_path_str
-            if not adapter_path.exists():
-                print(f"⚠️  Adapter non trovato per {model_id}: {adapter_path}\n")
+            # Verifica che l'adapter esista (se non è None)
+            adapter_path = model_info.get('adapter_path')
+            if adapter_path and not (MODELS_DIR / adapter_path).exists():
+                print(f"⚠️  Adapter non trovato per {model_id}: {MODELS_DIR / adapter_path}\n")
                 results[model_id] = False
                 continue
 
-        # Ottieni domande di test
-        questions = TEST_QUESTIONS.get(model_id, ["Test generico"])
+            questions = questions_for(model_info, args.from_data)
+            print(f"\n{'='*70}")
+            print(f"🧪 TEST: {model_id} ({len(questions)} domande)")
+            print(f"{'='*70}\n")
+
+            try:
+                rows, summary = evaluate_expert(
+                    manager, scheduler, builder, model_info, questions, args.max_tokens, args.temperature
+                )
+            except Exception as e:
+                print(f"❌ ERRORE durante test di {model_id}: {e}\n")
+                results[model_id] = False
+                continue
 
-        # Esegui test
-        success = test_expert(model_id, base_model, adapter_path, questions)
-        results[model_id] = success
+            for i, row in enumerate(rows, 1):
+                if not args.quiet:
+                    print(f"❓ Domanda {i}: {row['question']}")
+                    print(f"{'─'*70}")
+                    print(f"🤖 Risposta:\n{row['response']}")
+                    print(f"{'─'*70}")
+                print(f"   ⏱️  {row['generated_tokens']} token, TTFT {row['ttft_ms']} ms, "
+                      f"{row['tokens_per_sec']} token/s\n")
+                if report:
+                    report.write(json.dumps(row, ensure_ascii=False) + "\n")
+            if report:
+                report.write(json.dumps(summary, ensure_ascii=False) + "\n")
+
+            print(f"✅ {model_id}: {summary['generated_tokens']} token in {summary['wall_s']}s "
+                  f"({summary['batch_tokens_per_sec']} token/s batch, swap {summary['swap_ms']} ms)\n")
+            results[model_id] = all(r['finish_reason'] in ('stop', 'length') for r in rows)
+    finally:
+        if report:
+            report.close()
 
     # Riepilogo
     print("\n" + "="*70)
@@ -161,11 +255,128 @@ def main():
     passed = sum(1 for s in results.values() if s)
 
     print(f"\n📈 Risultato: {passed}/{total} test passati")
+    if args.output:
+        print(f"💾 Report salvato: {args.output}")
 
     if passed == total:
         print("🎉 Tutti i test sono passati!")
+        return 0
+    print("⚠️  Alcuni test sono falliti, controlla i log sopra")
+    return 1
+
+
+# ============================================================================
+# CONFRONTO TRA DUE RUN
+# ============================================================================
+
+def load_report(path):
+    """Righe di risposta di un report, indicizzate per (esperto, domanda)"""
+    answers = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if row.get('type') == 'answer':
+                answers[(row['expert'], row['question'])] = row
+    return answers
+
+
+def _median(values):
+    values = [v for v in values if v is not None]
+    return round(statistics.median(values), 2) if values else None
+
+
+def _change(old, new):
+    """Variazione relativa (new - old) / old"""
+    if old is None or new is None or old == 0:
+        return None
+    return (new - old) / old
+
+
+def compare_reports(old_path, new_path, speed_tolerance=0.1, min_similarity=0.9):
+    """
+    Confronta due report: per esperto mediana dei token/s e del TTFT, per
+    domanda similarità tra le risposte. Ritorna il numero di regressioni.
+    """
+    old, new = load_report(old_path), load_report(new_path)
+    regressions = 0
+
+    print("=" * 70)
+    print(f"📊 CONFRONTO: {old_path} → {new_path}")
+    print("=" * 70 + "\n")
+
+    experts = sorted({expert for expert, _ in old} | {expert for expert, _ in new})
+    for expert in experts:
+        old_rows = [r for (e, _), r in old.items() if e == expert]
+        new_rows = [r for (e, _), r in new.items() if e == expert]
+        tps_old, tps_new = _median(r['tokens_per_sec'] for r in old_rows), _median(r['tokens_per_sec'] for r in new_rows)
+        ttft_old, ttft_new = _median(r['ttft_ms'] for r in old_rows), _median(r['ttft_ms'] for r in new_rows)
+        tps_change, ttft_change = _change(tps_old, tps_new), _change(ttft_old, ttft_new)
+
+        slower = (tps_change is not None and tps_change < -speed_tolerance) or (
+            ttft_change is not None and ttft_change > speed_tolerance
+        )
+        regressions += int(slower)
+        status = "🐢 PIÙ LENTO" if slower else "✅"
+        print(f"{status} {expert}: token/s {tps_old} → {tps_new}"
+              f"{f' ({tps_change:+.0%})' if tps_change is not None else ''}, "
+              f"TTFT {ttft_old} → {ttft_new} ms{f' ({ttft_change:+.0%})' if ttft_change is not None else ''}")
+
+    print()
+    changed = missing = 0
+    for key in sorted(old):
+        expert, question = key
+        if key not in new:
+            missing += 1
+            print(f"❌ Mancante nel nuovo run: [{expert}] {question}")
+            continue
+        a, b = old[key]['response'], new[key]['response']
+        if a == b:
+            continue
+        similarity = difflib.SequenceMatcher(None, a, b).ratio()
+        if similarity < min_similarity:
+            changed += 1
+            print(f"✏️  Risposta cambiata ({similarity:.0%} simile): [{expert}] {question}")
+            print(f"   prima: {a[:120]!r}")
+            print(f"   dopo:  {b[:120]!r}")
+    regressions += changed + missing
+
+    added = len(set(new) - set(old))
+    print(f"\n📈 Domande confrontate: {len(set(old) & set(new))}, risposte cambiate: {changed}, "
+          f"mancanti: {missing}, nuove: {added}")
+    if regressions:
+        print(f"⚠️  {regressions} regressioni")
     else:
-        print("⚠️  Alcuni test sono falliti, controlla i log sopra")
+        print("🎉 Nessuna regressione")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test e valutazione di tutti gli esperti")
+    parser.add_argument("--output", type=str, default=None, help="Report JSONL della valutazione")
+    parser.add_argument("--compare", nargs=2, metavar=("VECCHIO", "NUOVO"),
+                        help="Confronta due report JSONL invece di generare")
+    parser.add_argument("--experts", nargs='+', default=None, help="Solo questi esperti (default: tutti)")
+    parser.add_argument("--from-data", type=int, default=0,
+                        help="Aggiunge le prime N domande del dataset di ogni esperto (default: 0)")
+    parser.add_argument("--max-tokens", type=int, default=300, help="Token massimi per risposta (default: 300)")
+    parser.add_argument("--temperature", type=float, default=0.0,
+                        help="Temperatura (default: 0, risposte confrontabili tra run)")
+    parser.add_argument("--batch-size", type=int, default=16, help="Domande generate insieme (default: 16)")
+    parser.add_argument("--backend", type=str, default="mlx", choices=["mlx", "fake"],
+                        help="Backend di inferenza (default: mlx)")
+    parser.add_argument("--quiet", action="store_true", help="Non stampa le risposte")
+    parser.add_argument("--speed-tolerance", type=float, default=0.1,
+                        help="Calo di token/s (o aumento del TTFT) tollerato nel confronto (default: 0.1)")
+    parser.add_argument("--min-similarity", type=float, default=0.9,
+                        help="Similarità minima tra risposte nel confronto (default: 0.9)")
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare_reports(args.compare[0], args.compare[1], args.speed_tolerance, args.min_similarity)
+        sys.exit(1 if regressions else 0)
+    sys.exit(run_eval(args))
 
 
 if __name__ == "__main__":
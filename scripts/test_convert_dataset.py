@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Test della lettura in streaming degli array JSON e della scrittura di train/valid.
+
+    cd scripts && python -m pytest -q test_convert_dataset.py
+"""
+
+import io
+import json
+
+import pytest
+
+from convert_dataset import iter_json_array, write_datasets
+
+MIXED = [-1, 2.5e3, 0, True, None, "a,b]", {"domanda": "x", "risposta": [1, 2.25]}, 1e-7, False, -0.125, [], 12345]
+
+
+@pytest.mark.parametrize("chunk_size", range(1, 12))
+def test_mixed_scalars_any_chunk_size(chunk_size):
+    for text in (json.dumps(MIXED), json.dumps(MIXED, indent=2), '[-1, 2.5e3]'):
+        expected = json.loads(text)
+        assert list(iter_json_array(io.StringIO(text), chunk_size=chunk_size)) == expected
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1024])
+def test_invalid_element(chunk_size):
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO('[1, 2x, 3]'), chunk_size=chunk_size))
+
+
+def test_unterminated_array():
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO('[1, 2'), chunk_size=2))
+
+
+def example(i):
+    return {"messages": [{"role": "user", "content": f"domanda {i}"}, {"role": "assistant", "content": "ok"}]}
+
+
+@pytest.mark.parametrize("valid_ratio", [0.0, 1.0])
+def test_split_never_leaves_a_file_empty(tmp_path, valid_ratio):
+    train_file, valid_file = tmp_path / "train.jsonl", tmp_path / "valid.jsonl"
+    counts, _ = write_datasets((example(i) for i in range(5)), train_file, valid_file, valid_ratio)
+
+    train = train_file.read_text(encoding='utf-8').splitlines()
+    valid = valid_file.read_text(encoding='utf-8').splitlines()
+    assert counts == {'train': len(train), 'valid': len(valid)}
+    assert train and valid
+    assert len(train) + len(valid) == 6
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+Test della ricerca di duplicati.
+
+    cd scripts && python -m pytest -q test_dedup_dataset.py
+"""
+
+from dedup_dataset import DuplicateReport, NearDuplicateIndex, dedup_examples
+
+
+def test_unrecognized_items_are_not_duplicates():
+    examples = [
+        {"domanda": "Chi era Giulio Cesare?", "risposta": "Un generale e politico romano."},
+        {"foo": 1},
+        {"bar": 2},
+        {"question": "Chi era Giulio Cesare?", "answer": "Un generale e politico romano."},
+        {"baz": 3},
+    ]
+    report = DuplicateReport()
+    kept = list(dedup_examples(examples, NearDuplicateIndex(), report))
+
+    assert report.unrecognized == 3
+    assert report.duplicates == 1
+    assert kept == [examples[0], examples[1], examples[2], examples[4]]
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Divisione del testo in chunk misurati in token del modello base.
+
+I chunk a numero fisso di parole non hanno un rapporto preciso con il
+`max_seq_length` del training (in italiano una parola vale 1-3 token, e il
+chat template aggiunge la sua parte): qui ogni esempio viene misurato con il
+tokenizer vero, template compreso, e i chunk vengono riempiti frase per
+frase fino al budget. Così la memoria del training è prevedibile.
+"""
+
+import json
+import re
+from pathlib import Path
+from typing import Dict, List
+
+BASE_DIR = Path(__file__).parent.parent
+CONFIG_FILE = BASE_DIR / "models" / "models_config.json"
+
+# Fine frase (punteggiatura seguita da spazi) o fine paragrafo
+_SENTENCE_END = re.compile(r'(?<=[.!?…:;])\s+|\n\s*\n')
+
+
+def default_tokenizer_name() -> str:
+    """Modello base di models_config.json (il tokenizer usato nel training)"""
+    if CONFIG_FILE.exists():
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)['base_model']
+    return "mlx-community/Qwen2.5-7B-Instruct-4bit"
+
+
+def load_tokenizer(name: str = None):
+    """Tokenizer Hugging Face del modello base (nome del repo o directory locale)"""
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(name or default_tokenizer_name())
+
+
+def count_messages(tokenizer, messages: List[Dict[str, str]]) -> int:
+    """Token di una conversazione con il chat template, come la vede il training"""
+    if getattr(tokenizer, 'chat_template', None):
+        text = tokenizer.apply_chat_template(messages, tokenize=False)
+    else:
+        # ChatML se il tokenizer non ha un template (come mlx_lm)
+        text = ''.join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+class TokenChunker:
+    """
+    Riempie chunk di frasi fino a un budget di token per esempio.
+
+    Il budget è `max_seq_length` meno i token del chat template e della
+    domanda: l'esempio completo (domanda + chunk) sta nel contesto del
+    training. `overlap_tokens` ripete all'inizio di ogni chunk le ultime
+    frasi del precedente, per non perdere il filo tra un chunk e l'altro.
+    """
+
+    def __init__(self, tokenizer, max_seq_length: int = 1536, overlap_tokens: int = 0):
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.overlap_tokens = overlap_tokens
+
+    def count(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def example_tokens(self, user: str, assistant: str) -> int:
+        """Token dell'esempio completo, come lo vede il training"""
+        messages = [{"role": "user", "content": user}, {"role": "assistant", "content": assistant}]
+        return count_messages(self.tokenizer, messages)
+
+    def budget(self, prompts: List[str]) -> int:
+        """Token disponibili per il chunk con il prompt più lungo tra quelli indicati"""
+        overhead = max(self.example_tokens(p, "") for p in prompts)
+        return self.max_seq_length - overhead
+
+    def _units(self, text: str, budget: int):
+        """Frasi con il loro conteggio di token; le frasi troppo lunghe vengono spezzate"""
+        units = []
+        start = 0
+        for match in _SENTENCE_END.finditer(text):
+            units.append(text[start:match.end()])
+            start = match.end()
+        if start < len(text):
+            units.append(text[start:])
+
+        for unit in units:
+            if not unit.strip():
+                continue
+            n = self.count(unit)
+            if n <= budget:
+                yield unit, n
+                continue
+            # Frase più lunga dell'intero budget: si taglia sui token
+            ids = self.tokenizer.encode(unit, add_special_tokens=False)
+            for i in range(0, len(ids), budget):
+                piece = self.tokenizer.decode(ids[i:i + budget])
+                yield piece, self.count(piece)
+
+    def _overlap(self, units):
+        """Ultime frasi del chunk da ripetere all'inizio del successivo"""
+        if self.overlap_tokens <= 0:
+            return []
+        carried, total = [], 0
+        for unit, n in reversed(units):
+            if total + n > self.overlap_tokens:
+                break
+            carried.insert(0, (unit, n))
+            total += n
+        # Mai ripetere un chunk intero
+        return carried if len(carried) < len(units) else []
+
+    def split(self, text: str, budget: int) -> List[str]:
+        """Divide il testo in chunk di al più `budget` token"""
+        if budget <= 0:
+            raise ValueError("max_seq_length troppo piccolo per il chat template e la domanda")
+
+        units = list(self._units(text, budget))
+        chunks = []
+        carried = []
+        i = 0
+        while i < len(units):
+            current = list(carried)
+            total = sum(n for _, n in current)
+            # L'overlap non deve impedire alla frase successiva di entrare
+            while current and total + units[i][1] > budget:
+                total -= current.pop(0)[1]
+
+            added = 0
+            while i < len(units) and (added == 0 or total + units[i][1] <= budget):
+                current.append(units[i])
+                total += units[i][1]
+                i += 1
+                added += 1
+
+            # La somma dei token delle frasi è una stima: si verifica il testo
+            # unito e le frasi in eccesso passano al chunk successivo
+            while len(current) > 1 and self.count(''.join(u for u, _ in current)) > budget:
+                if added > 1:
+                    current.pop()
+                    i -= 1
+                    added -= 1
+                else:
+                    current.pop(0)
+
+            chunk = ''.join(u for u, _ in current).strip()
+            if chunk:
+                chunks.append(chunk)
+            carried = self._overlap(current)
+        return chunks
+
+
+def token_length_report(lengths: List[int], max_seq_length: int, bins: int = 10) -> Dict:
+    """Statistiche e istogramma delle lunghezze in token degli esempi"""
+    if not lengths:
+        return {'examples': 0}
+    ordered = sorted(lengths)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    width = max(1, -(-max(max_seq_length, ordered[-1]) // bins))
+    histogram = {}
+    for n in ordered:
+        low = max(n - 1, 0) // width * width
+        key = f"{low + 1}-{low + width}"
+        histogram[key] = histogram.get(key, 0) + 1
+
+    return {
+        'examples': len(ordered),
+        'total_tokens': sum(ordered),
+        'min': ordered[0],
+        'mean': round(sum(ordered) / len(ordered), 1),
+        'p50': pct(50),
+        'p95': pct(95),
+        'max': ordered[-1],
+        'over_max_seq_length': sum(1 for n in ordered if n > max_seq_length),
+        'histogram': histogram
+    }
+
+
+def print_token_report(report: Dict, max_seq_length: int):
+    """Stampa statistiche e istogramma (una barra per intervallo)"""
+    if not report.get('examples'):
+        print("   Nessun esempio")
+        return
+    print(f"\n📊 Lunghezza esempi in token (max_seq_length {max_seq_length}):")
+    print(f"   Esempi: {report['examples']}, token totali: {report['total_tokens']:,}")
+    print(f"   Min {report['min']}, media {report['mean']}, p50 {report['p50']}, "
+          f"p95 {report['p95']}, max {report['max']}")
+    peak = max(report['histogram'].values())
+    for key, count in report['histogram'].items():
+        bar = '█' * max(1, round(count / peak * 40))
+        print(f"   {key:>11} | {bar} {count}")
+    if report['over_max_seq_length']:
+        print(f"   ⚠️  {report['over_max_seq_length']} esempi oltre max_seq_length (verranno troncati)")
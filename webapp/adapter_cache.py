@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Cache LRU degli adapter LoRA in memoria, limitata da un budget in byte.
+
+Gli adapter sono piccoli rispetto al modello base condiviso, quindi ne
+teniamo molti in RAM: cambiare esperto diventa un semplice swap di pesi
+già caricati invece di una rilettura da disco.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class AdapterCache:
+    """
+    Cache LRU chiave -> valore con budget in byte e voci fissate (pinned).
+
+    Le voci in uso da una richiesta (retain/release) non vengono eliminate:
+    se il budget è superato l'eliminazione aspetta il rilascio.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._pinned = set()
+        self._refs = {}  # key -> richieste che la stanno usando
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Ritorna il valore in cache (aggiornando l'ordine LRU) o None"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes):
+        """Inserisce un valore ed elimina i meno usati se si supera il budget"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.pop(key)
+            self._entries[key] = (value, nbytes)
+            self._evict(protect=key)
+
+    def discard(self, key):
+        """Rimuove una chiave dalla cache (resta fissata, se lo era)"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pin(self, key):
+        """Fissa una chiave: non verrà mai eliminata dalla cache"""
+        with self._lock:
+            self._pinned.add(key)
+
+    def retain(self, key):
+        """Segna una chiave come in uso (anche prima che sia in cache)"""
+        with self._lock:
+            self._refs[key] = self._refs.get(key, 0) + 1
+
+    def release(self, key):
+        """Fine dell'uso: se era l'ultimo riferimento la voce torna eliminabile"""
+        with self._lock:
+            count = self._refs.get(key, 0) - 1
+            if count > 0:
+                self._refs[key] = count
+                return
+            self._refs.pop(key, None)
+            self._evict()
+
+    def unpin(self, key):
+        with self._lock:
+            self._pinned.discard(key)
+            self._evict()
+
+    def _evict(self, protect=None):
+        for key in list(self._entries):
+            if self.used_bytes() <= self.budget_bytes:
+                break
+            if key in self._pinned or key in self._refs or key == protect:
+                continue
+            self._entries.pop(key)
+            self.evictions += 1
+            print(f"🗑️  Adapter rimosso dalla cache: {key}")
+
+    def used_bytes(self):
+        return sum(nbytes for _, nbytes in self._entries.values())
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def stats(self):
+        """Contatori per /api/health"""
+        with self._lock:
+            return {
+                'entries': list(self._entries),
+                'pinned': sorted(self._pinned),
+                'in_use': dict(self._refs),
+                'used_mb': round(self.used_bytes() / (1024 * 1024), 2),
+                'budget_mb': round(self.budget_bytes / (1024 * 1024), 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -10,9 +10,17 @@ import time
 from pathlib import Path
 from functools import wraps
 from flask import Flask, render_template, request, jsonify, Response, stream_with_context, session, redirect, url_for
-from mlx_lm import load, generate
-import mlx.core as mx
 from dotenv import load_dotenv
+import metrics
+from backends import get_backend
+from expert_router import ExpertRouter
+from model_manager import ModelManager, process_rss_bytes
+from model_registry import ModelRegistry
+from scheduler import InferenceScheduler
+from prompt_cache import PromptCache
+from prompting import ContextTooLongError, ContextWindow, PromptBuilder, valid_max_tokens
+from response_cache import ResponseCache, adapter_fingerprint, replay_chunks
+from warmup import Warmup, wait_for_port
 
 # Carica variabili d'ambiente
 load_dotenv()
@@ -22,15 +30,109 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'change-this-secret-key-in-pr
 app.config['APP_PASSWORD'] = os.getenv('APP_PASSWORD', 'admin123')
 app.config['SECRET_PATH'] = os.getenv('SECRET_PATH', '')
 app.config['REQUIRE_AUTH_LOCAL'] = os.getenv('REQUIRE_AUTH_LOCAL', 'false').lower() == 'true'
+app.config['ADAPTER_CACHE_MB'] = int(os.getenv('ADAPTER_CACHE_MB', '512'))
+app.config['DEFAULT_MODEL_ID'] = os.getenv('DEFAULT_MODEL_ID', '')
+app.config['MAX_BATCH_SIZE'] = int(os.getenv('MAX_BATCH_SIZE', '8'))
+app.config['PROMPT_CACHE_SESSIONS'] = int(os.getenv('PROMPT_CACHE_SESSIONS', '16'))
+app.config['PROMPT_CACHE_IDLE_SECONDS'] = int(os.getenv('PROMPT_CACHE_IDLE_SECONDS', '600'))
+app.config['PROMPT_CACHE_MB'] = int(os.getenv('PROMPT_CACHE_MB', '2048'))
+app.config['MAX_CONTEXT_TOKENS'] = int(os.getenv('MAX_CONTEXT_TOKENS', '1536'))
+app.config['NUM_DRAFT_TOKENS'] = int(os.getenv('NUM_DRAFT_TOKENS', '3'))
+app.config['RESPONSE_CACHE'] = os.getenv('RESPONSE_CACHE', 'true').lower() == 'true'
+app.config['RESPONSE_CACHE_TTL_SECONDS'] = int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+app.config['RESPONSE_CACHE_MAX_ENTRIES'] = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '5000'))
+app.config['RESPONSE_CACHE_MB'] = int(os.getenv('RESPONSE_CACHE_MB', '64'))
+app.config['RESPONSE_CACHE_SIMILARITY'] = float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0')) or None
+app.config['INFERENCE_BACKEND'] = os.getenv('INFERENCE_BACKEND', 'mlx')
+app.config['FAKE_TOKEN_MS'] = float(os.getenv('FAKE_TOKEN_MS', '10'))
+app.config['FAKE_PREFILL_MS'] = float(os.getenv('FAKE_PREFILL_MS', '0.2'))
+app.config['FAKE_SWAP_MS'] = float(os.getenv('FAKE_SWAP_MS', '5'))
+app.config['METRICS_PUBLIC'] = os.getenv('METRICS_PUBLIC', 'false').lower() == 'true'
+app.config['MODELS_CONFIG_CHECK_SECONDS'] = float(os.getenv('MODELS_CONFIG_CHECK_SECONDS', '2'))
+app.config['WARMUP_MODELS'] = os.getenv('WARMUP_MODELS', 'all')
+app.config['WARMUP_TOKENS'] = int(os.getenv('WARMUP_TOKENS', '4'))
+app.config['ROUTER_MIN_SCORE'] = float(os.getenv('ROUTER_MIN_SCORE', '0.05'))
 
 # Percorsi
 BASE_DIR = Path(__file__).parent.parent
 MODELS_DIR = BASE_DIR / "models"
 CONFIG_FILE = MODELS_DIR / "models_config.json"
-
-# Cache dei modelli caricati
-loaded_models = {}
-current_model_id = None
+DATA_DIR = BASE_DIR / "data"
+RESPONSE_CACHE_FILE = Path(os.getenv('RESPONSE_CACHE_PATH', str(Path(__file__).parent / "cache" / "responses.sqlite3")))
+
+# Backend di inferenza: MLX reale oppure modello finto per test di carico
+if app.config['INFERENCE_BACKEND'] == 'fake':
+    backend = get_backend(
+        'fake',
+        token_ms=app.config['FAKE_TOKEN_MS'],
+        prefill_ms=app.config['FAKE_PREFILL_MS'],
+        swap_ms=app.config['FAKE_SWAP_MS']
+    )
+else:
+    backend = get_backend(app.config['INFERENCE_BACKEND'])
+
+# Gauge di /metrics letti al momento dello scrape
+metrics.ACCELERATOR_MEMORY.set_function(backend.memory_bytes)
+metrics.PROCESS_PEAK_RSS.set_function(process_rss_bytes)
+metrics.ACTIVE_SEQUENCES.set_function(lambda: scheduler.active_by_model() if scheduler else {})
+metrics.QUEUED_REQUESTS.set_function(lambda: scheduler.queued() if scheduler else 0)
+
+# Modello base residente + adapter attivo (creato al primo load_model)
+model_manager = None
+
+
+def on_catalog_change(old, new, changed):
+    """Dopo un ricaricamento del catalogo: via pesi e KV cache degli esperti cambiati"""
+    for model_id in changed:
+        info = old.get(model_id)
+        if model_manager is not None:
+            model_manager.invalidate(model_id)
+        if scheduler is not None:
+            scheduler.forget_snapshots(model_id)
+        prompt_cache.clear((model_id, info.get('adapter_path')))
+    # Centroidi del router per il nuovo catalogo, non alla prima richiesta "auto"
+    expert_router.prepare(new)
+
+
+# models_config.json in memoria, ricaricato quando il file o gli adapter cambiano
+model_registry = ModelRegistry(
+    CONFIG_FILE,
+    MODELS_DIR,
+    check_interval=app.config['MODELS_CONFIG_CHECK_SECONDS'],
+    on_change=on_catalog_change
+)
+
+# Worker di inferenza condiviso da tutti gli endpoint di chat
+scheduler = None
+
+# KV cache delle conversazioni, riusata tra un turno e il successivo
+prompt_cache = PromptCache(
+    backend,
+    max_sessions=app.config['PROMPT_CACHE_SESSIONS'],
+    max_idle_seconds=app.config['PROMPT_CACHE_IDLE_SECONDS'],
+    max_bytes=app.config['PROMPT_CACHE_MB'] * 1024 * 1024
+)
+
+# Budget di token del prompt (system prompt + turni recenti + risposta)
+context_window = ContextWindow(app.config['MAX_CONTEXT_TOKENS'])
+
+# Prompt in token dal chat template del modello base (token dei turni in cache)
+prompt_builder = None
+
+# Scelta dell'esperto dalla domanda per model_id "auto"
+expert_router = ExpertRouter(DATA_DIR, min_score=app.config['ROUTER_MIN_SCORE'])
+
+# Preparazione degli esperti in background dopo l'avvio del server
+warmup = Warmup()
+
+# Risposte già generate, su disco (sopravvivono ai riavvii)
+response_cache = ResponseCache(
+    RESPONSE_CACHE_FILE,
+    ttl_seconds=app.config['RESPONSE_CACHE_TTL_SECONDS'],
+    max_entries=app.config['RESPONSE_CACHE_MAX_ENTRIES'],
+    max_bytes=app.config['RESPONSE_CACHE_MB'] * 1024 * 1024,
+    similarity=app.config['RESPONSE_CACHE_SIMILARITY']
+) if app.config['RESPONSE_CACHE'] else None
 
 
 def is_local_request():
@@ -55,118 +157,116 @@ def login_required(f):
     return decorated_function
 
 
-def load_models_config():
-    """Carica la configurazione dei modelli disponibili"""
-    if not CONFIG_FILE.exists():
-        return {"base_model": "mlx-community/Qwen2.5-7B-Instruct-4bit", "models": []}
-
-    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
-
-
 def get_available_models():
-    """Restituisce lista dei modelli disponibili (enabled)"""
-    config = load_models_config()
-    available = []
-
-    for model in config['models']:
-        # Controlla se il modello è abilitato
-        if not model.get('enabled', True):
-            continue
+    """Restituisce lista dei modelli disponibili (abilitati e con l'adapter su disco)"""
+    return model_registry.available()
+
+
+def default_model_id():
+    """DEFAULT_MODEL_ID se disponibile, altrimenti il primo modello disponibile (None se non ce ne sono)"""
+    available = [m['id'] for m in get_available_models()]
+    default = app.config['DEFAULT_MODEL_ID']
+    if default in available:
+        return default
+    return available[0] if available else None
+
+
+def get_model_manager():
+    """Restituisce il gestore del modello base (creato una sola volta)"""
+    global model_manager
+
+    if model_manager is None:
+        budget_bytes = app.config['ADAPTER_CACHE_MB'] * 1024 * 1024
+        manager = ModelManager(model_registry.catalog.base_model, MODELS_DIR, budget_bytes, backend)
+        # L'esperto di default resta sempre in cache, con o senza warm-up
+        default = default_model_id()
+        if default is not None:
+            manager.pin(default)
+        model_manager = manager
+    return model_manager
+
+
+def get_scheduler():
+    """Restituisce lo scheduler di inferenza (creato una sola volta)"""
+    global scheduler
+
+    if scheduler is None:
+        scheduler = InferenceScheduler(
+            get_model_manager(),
+            max_batch_size=app.config['MAX_BATCH_SIZE'],
+            prompt_cache=prompt_cache
+        )
+    return scheduler
 
-        # Se ha un adapter, verifica che esista
-        if model['adapter_path']:
-            adapter_path = MODELS_DIR / model['adapter_path']
-            if not adapter_path.exists():
-                continue
 
-        available.append(model)
+def get_prompt_builder():
+    """Restituisce il costruttore di prompt per il tokenizer del modello base"""
+    global prompt_builder
 
-    return available
+    if prompt_builder is None:
+        manager = get_model_manager()
+        manager.ensure_base()
+        prompt_builder = PromptBuilder(manager.tokenizer)
+        if not prompt_builder.template.segmented:
+            print("⚠️  Chat template non tokenizzabile per turni: il prompt viene tokenizzato intero")
+    return prompt_builder
 
 
 def load_model(model_id):
-    """Carica un modello specifico (con cache)"""
-    global loaded_models, current_model_id
+    """
+    Prepara un modello: base residente + adapter in cache (lo swap lo fa lo scheduler).
 
-    # Se è già caricato, ritorna subito
-    if model_id in loaded_models and current_model_id == model_id:
-        return loaded_models[model_id]
+    model_data['handle'] tiene l'adapter in cache per la richiesta e va
+    rilasciato (handle.release()) quando la richiesta non lo usa più.
+    """
+    start = time.perf_counter()
+    model_data = _load_model(model_id)
+    # Solo i modelli esistenti: model_id arriva dal client
+    metrics.MODEL_LOAD.observe(time.perf_counter() - start, model_id)
+    return model_data
 
-    # IMPORTANTE: Libera memoria dei modelli vecchi per evitare OOM
-    # Mantieni solo il modello corrente in cache
-    if current_model_id and current_model_id != model_id:
-        if current_model_id in loaded_models:
-            print(f"🗑️  Rimozione modello vecchio dalla cache: {current_model_id}")
-            del loaded_models[current_model_id]
-            import gc
-            gc.collect()  # Forza garbage collection
 
-    config = load_models_config()
-    base_model = config['base_model']
+def _load_model(model_id):
+    # Uno snapshot per tutta la richiesta, anche se il catalogo viene ricaricato
+    catalog = model_registry.catalog
 
     # Trova il modello richiesto
-    model_info = None
-    for m in config['models']:
-        if m['id'] == model_id:
-            model_info = m
-            break
+    model_info = catalog.get(model_id)
 
     if not model_info:
         raise ValueError(f"Modello '{model_id}' non trovato")
 
-    print(f"🔄 Caricamento modello: {model_info['name']}")
+    manager = get_model_manager()
+    if manager.base_model != catalog.base_model:
+        raise ValueError(
+            f"Il modello base è cambiato ({manager.base_model} -> {catalog.base_model}), riavvia il server"
+        )
 
-    # Carica il modello base + adapter (se presente)
-    if model_info['adapter_path']:
-        adapter_path = str(MODELS_DIR / model_info['adapter_path'])
-        print(f"   📦 Adapter: {adapter_path}")
-        model, tokenizer = load(base_model, adapter_path=adapter_path)
-    else:
-        print(f"   📦 Modello base (no adapter)")
-        model, tokenizer = load(base_model)
-
-    # Salva in cache
-    loaded_models[model_id] = {
-        'model': model,
-        'tokenizer': tokenizer,
-        'info': model_info
+    # Il modello base resta in memoria: si prepara solo l'adapter LoRA, che
+    # resta in cache finché la richiesta non rilascia l'handle
+    handle = manager.acquire(model_id, model_info['adapter_path'])
+    try:
+        # Modello draft per il decoding speculativo (opzionale)
+        if model_info.get('draft_model'):
+            manager.load_draft(model_info['draft_model'])
+
+        # Snapshot della KV cache dell'intestazione (system prompt dell'esperto o
+        # quello predefinito del chat template), calcolato una volta dal worker
+        builder = get_prompt_builder()
+        header_tokens = builder.header_tokens(model_info.get('system_prompt'))
+        if len(header_tokens) >= prompt_cache.min_reuse_tokens:
+            get_scheduler().precompute_system_prompt(model_id, model_info['adapter_path'], header_tokens)
+    except BaseException:
+        handle.release()
+        raise
+
+    return {
+        'model': manager.model,
+        'tokenizer': manager.tokenizer,
+        'prompt_builder': builder,
+        'info': model_info,
+        'handle': handle
     }
-    current_model_id = model_id
-
-    print(f"✅ Modello caricato: {model_info['name']}")
-    return loaded_models[model_id]
-
-
-def format_prompt(message, conversation_history=None, system_prompt=None):
-    """Formatta il prompt in formato chat con system prompt opzionale"""
-    messages = []
-
-    # Aggiungi system prompt se presente
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-
-    # Aggiungi lo storico della conversazione se presente
-    if conversation_history:
-        for entry in conversation_history:
-            messages.append({"role": "user", "content": entry['user']})
-            messages.append({"role": "assistant", "content": entry['assistant']})
-
-    # Aggiungi il messaggio corrente
-    messages.append({"role": "user", "content": message})
-
-    # Formatta in stile chat (Qwen format)
-    formatted = ""
-    for msg in messages:
-        if msg['role'] == 'system':
-            formatted += f"<|im_start|>system\n{msg['content']}<|im_end|>\n"
-        elif msg['role'] == 'user':
-            formatted += f"<|im_start|>user\n{msg['content']}<|im_end|>\n"
-        else:
-            formatted += f"<|im_start|>assistant\n{msg['content']}<|im_end|>\n"
-
-    formatted += "<|im_start|>assistant\n"
-    return formatted
 
 
 @app.route('/')
@@ -200,10 +300,10 @@ def logout():
 @login_required
 def api_models():
     """Restituisce la lista dei modelli disponibili"""
-    models = get_available_models()
+    models = [dict(m, state=warmup.model_state(m['id'])) for m in get_available_models()]
     return jsonify({
         'models': models,
-        'current': current_model_id
+        'current': session.get('model_id')
     })
 
 
@@ -217,8 +317,16 @@ def api_select_model():
     if not model_id:
         return jsonify({'error': 'model_id mancante'}), 400
 
+    if model_id == 'auto':
+        # L'esperto viene scelto a ogni messaggio: niente da caricare ora
+        session['model_id'] = model_id
+        return jsonify({'success': True, 'model': AUTO_MODEL_INFO})
+
     try:
         model_data = load_model(model_id)
+        model_data['handle'].release()
+        # Solo un'indicazione per il client: ogni richiesta di chat indica il suo model_id
+        session['model_id'] = model_id
         return jsonify({
             'success': True,
             'model': model_data['info']
@@ -227,6 +335,186 @@ def api_select_model():
         return jsonify({'error': str(e)}), 500
 
 
+AUTO_MODEL_INFO = {'id': 'auto', 'name': 'Automatico', 'description': "Sceglie l'esperto in base alla domanda"}
+
+
+def resolve_model(model_id, message):
+    """
+    Con model_id "auto" sceglie l'esperto dalla domanda.
+
+    Ritorna (model_id, routing): routing (None se il model_id è esplicito)
+    contiene esperto scelto, confidenza e tempo di classificazione. Se la
+    domanda non somiglia a nessun dataset si usa DEFAULT_MODEL_ID (o il
+    primo modello disponibile).
+    """
+    if model_id != 'auto':
+        return model_id, None
+
+    fallback = default_model_id()
+    if fallback is None:
+        raise ValueError("Nessun modello disponibile")
+
+    routing = expert_router.route(message, model_registry.catalog, fallback)
+    return routing['model_id'], routing
+
+
+def start_chat(model_id, message, history, max_tokens, temperature):
+    """
+    Prepara il prompt e mette in coda la generazione sullo scheduler.
+
+    Ritorna (model_data, generation, dropped_turns); usata sia dalle route
+    Flask sia dalla modalità ASGI (asgi.py).
+    """
+    # Carica il modello (l'adapter resta fissato in cache fino a fine generazione)
+    model_data = load_model(model_id)
+    handle = model_data['handle']
+
+    try:
+        # Ottieni il system prompt se presente nella configurazione
+        system_prompt = model_data['info'].get('system_prompt', None)
+
+        # Token del prompt con i soli turni recenti che stanno nel contesto
+        with metrics.PROMPT_BUILD.time(model_id):
+            prompt_tokens, dropped_turns, max_tokens = context_window.fit(
+                model_data['prompt_builder'], message, history, system_prompt, max_tokens
+            )
+
+        # Il worker campiona i token, l'endpoint li legge man mano
+        info = model_data['info']
+        generation = get_scheduler().submit(
+            model_id,
+            info['adapter_path'],
+            prompt_tokens,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            draft_model=info.get('draft_model'),
+            num_draft_tokens=info.get('num_draft_tokens', app.config['NUM_DRAFT_TOKENS']),
+            on_done=handle.release
+        )
+    except BaseException:
+        handle.release()
+        raise
+    return model_data, generation, dropped_turns
+
+
+def start_fanout(model_ids, message, max_tokens, temperature):
+    """
+    Stessa domanda a più esperti in un unico batch multi-LoRA.
+
+    Ritorna (models, group): i model_data degli esperti nell'ordine di
+    model_ids (senza duplicati) e il GenerationGroup con gli eventi di tutte
+    le risposte. Usata sia dalle route Flask sia dalla modalità ASGI.
+    """
+    model_ids = list(dict.fromkeys(model_ids))
+    if not model_ids:
+        raise ValueError("Nessun esperto indicato")
+    if len(model_ids) > app.config['MAX_BATCH_SIZE']:
+        raise ValueError(f"Al massimo {app.config['MAX_BATCH_SIZE']} esperti per richiesta")
+
+    # Ogni esperto resta fissato in cache fino alla fine della sua risposta
+    models = []
+    try:
+        for model_id in model_ids:
+            models.append(load_model(model_id))
+
+        prompts, limits = [], []
+        for model_id, model_data in zip(model_ids, models):
+            with metrics.PROMPT_BUILD.time(model_id):
+                prompt_tokens, _, limit = context_window.fit(
+                    model_data['prompt_builder'], message, [], model_data['info'].get('system_prompt'), max_tokens
+                )
+            prompts.append(prompt_tokens)
+            limits.append(limit)
+
+        group = get_scheduler().submit_group(
+            [(model_id, m['info']['adapter_path']) for model_id, m in zip(model_ids, models)],
+            prompts,
+            limits,
+            temperature=temperature,
+            on_done=[m['handle'].release for m in models]
+        )
+    except BaseException:
+        for model_data in models:
+            model_data['handle'].release()
+        raise
+    return models, group
+
+
+def fanout_event(models, group, index, kind, value):
+    """Evento SSE di /api/chat/fanout, con l'esperto che l'ha prodotto"""
+    info = models[index]['info']
+    event = {'model_id': info['id'], 'model': info['name']}
+    if kind == 'token':
+        event['token'] = value
+    elif kind == 'error':
+        event['error'] = value
+    else:
+        event.update(done=True, stats=group.requests[index].stats.to_dict())
+    return event
+
+
+def clean_response(response):
+    """Pulisci la risposta (rimuovi tag speciali)"""
+    return response.replace("<|im_end|>", "").strip()
+
+
+def lookup_response(model_id, message, history, max_tokens, temperature):
+    """
+    Cerca la risposta nella cache prima di generare.
+
+    Ritorna (hit, ref): hit è la risposta in cache (o None), ref serve a
+    store_response() per salvare la risposta generata dopo una miss.
+    """
+    if response_cache is None:
+        return None, None
+    catalog = model_registry.catalog
+    model_info = catalog.get(model_id)
+    if model_info is None:
+        return None, None
+
+    start = time.perf_counter()
+    key, scope = ResponseCache.make_keys(
+        model_id,
+        catalog.base_model,
+        adapter_fingerprint(MODELS_DIR, model_info['adapter_path']),
+        model_info.get('system_prompt'),
+        message,
+        history,
+        max_tokens,
+        temperature
+    )
+    hit = response_cache.get(key)
+
+    # Domande quasi uguali: solo greedy (risposta deterministica) e senza storico
+    embedding = None
+    if response_cache.similarity is not None and temperature == 0 and not history:
+        embedding = get_model_manager().embed_text(message)
+        if hit is None:
+            hit = response_cache.find_similar(scope, embedding)
+
+    if hit is None:
+        metrics.CACHE_LOOKUPS.inc('response', model_id, 'miss')
+        return None, (key, scope, model_id, embedding)
+
+    metrics.CACHE_LOOKUPS.inc('response', model_id, 'hit')
+    stats = hit['stats']
+    hit['dropped_turns'] = stats.pop('dropped_turns', 0)
+    stats['cache'] = 'semantic' if 'similarity' in hit else 'exact'
+    stats['similarity'] = hit.get('similarity')
+    stats['lookup_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    hit['model'] = model_info['name']
+    return hit, None
+
+
+def store_response(ref, response, generation, dropped_turns):
+    """Salva in cache una risposta generata per intero"""
+    if ref is None or generation.stats.finish_reason not in ('stop', 'length'):
+        return
+    key, scope, model_id, embedding = ref
+    stats = dict(generation.stats.to_dict(), dropped_turns=dropped_turns)
+    response_cache.put(key, scope, model_id, response, stats, embedding)
+
+
 @app.route('/api/chat', methods=['POST'])
 @login_required
 def api_chat():
@@ -240,36 +528,37 @@ def api_chat():
 
     if not message:
         return jsonify({'error': 'Messaggio vuoto'}), 400
+    if not valid_max_tokens(max_tokens):
+        return jsonify({'error': 'max_tokens deve essere un intero positivo'}), 400
 
     try:
-        # Carica il modello
-        model_data = load_model(model_id)
-        model = model_data['model']
-        tokenizer = model_data['tokenizer']
-
-        # Ottieni il system prompt se presente nella configurazione
-        system_prompt = model_data['info'].get('system_prompt', None)
-
-        # Formatta il prompt
-        prompt = format_prompt(message, history, system_prompt=system_prompt)
-
-        # Genera la risposta
-        response = generate(
-            model,
-            tokenizer,
-            prompt=prompt,
-            max_tokens=max_tokens,
-            verbose=False
-        )
-
-        # Pulisci la risposta (rimuovi tag speciali)
-        response = response.replace("<|im_end|>", "").strip()
+        model_id, routing = resolve_model(model_id, message)
+
+        cached, cache_ref = lookup_response(model_id, message, history, max_tokens, temperature)
+        if cached is not None:
+            return jsonify({
+                'response': cached['response'],
+                'model': cached['model'],
+                'routing': routing,
+                'dropped_turns': cached['dropped_turns'],
+                'cached': True,
+                'stats': cached['stats']
+            })
+
+        model_data, generation, dropped_turns = start_chat(model_id, message, history, max_tokens, temperature)
+        response = clean_response(generation.text(model_data['tokenizer']))
+        store_response(cache_ref, response, generation, dropped_turns)
 
         return jsonify({
             'response': response,
-            'model': model_data['info']['name']
+            'model': model_data['info']['name'],
+            'routing': routing,
+            'dropped_turns': dropped_turns,
+            'stats': generation.stats.to_dict()
         })
 
+    except ContextTooLongError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"❌ Errore: {e}")
         return jsonify({'error': str(e)}), 500
@@ -288,43 +577,102 @@ def api_chat_stream():
 
     if not message:
         return jsonify({'error': 'Messaggio vuoto'}), 400
+    if not valid_max_tokens(max_tokens):
+        return jsonify({'error': 'max_tokens deve essere un intero positivo'}), 400
+
+    try:
+        model_id, routing = resolve_model(model_id, message)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 500
 
     def generate_stream():
+        streaming = False
         try:
-            # Carica il modello
-            model_data = load_model(model_id)
-            model = model_data['model']
-            tokenizer = model_data['tokenizer']
-
-            # Ottieni il system prompt se presente nella configurazione
-            system_prompt = model_data['info'].get('system_prompt', None)
-
-            # Formatta il prompt
-            prompt = format_prompt(message, history, system_prompt=system_prompt)
-
-            # Tokenizza il prompt
-            prompt_tokens = mx.array(tokenizer.encode(prompt))
-
-            # Genera token per token
-            generated_tokens = []
-            for token, _ in zip(
-                generate(model, tokenizer, prompt=prompt, max_tokens=max_tokens),
-                range(max_tokens)
-            ):
-                # Decodifica il token
-                text = tokenizer.decode([token])
-
-                # Stop se troviamo il token di fine
-                if "<|im_end|>" in text or token == tokenizer.eos_token_id:
-                    break
-
-                # Invia il token al client
+            # Con model_id "auto" il primo evento dice quale esperto risponde
+            if routing is not None:
+                yield f"data: {json.dumps({'routing': routing})}\n\n"
+
+            # Risposta in cache: la si rimanda come stream di segmenti
+            cached, cache_ref = lookup_response(model_id, message, history, max_tokens, temperature)
+            if cached is not None:
+                for text in replay_chunks(cached['response']):
+                    yield f"data: {json.dumps({'token': text})}\n\n"
+                done = {'done': True, 'dropped_turns': cached['dropped_turns'], 'cached': True, 'stats': cached['stats']}
+                yield f"data: {json.dumps(done)}\n\n"
+                return
+
+            model_data, generation, dropped_turns = start_chat(model_id, message, history, max_tokens, temperature)
+            metrics.ACTIVE_STREAMS.inc(model_id)
+            streaming = True
+
+            # Invia ogni segmento di testo appena il worker campiona il token
+            parts = []
+            for text in generation.stream(model_data['tokenizer']):
+                parts.append(text)
                 yield f"data: {json.dumps({'token': text})}\n\n"
+            store_response(cache_ref, clean_response(''.join(parts)), generation, dropped_turns)
+
+            done = {'done': True, 'dropped_turns': dropped_turns, 'stats': generation.stats.to_dict()}
+            yield f"data: {json.dumps(done)}\n\n"
 
-            yield f"data: {json.dumps({'done': True})}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            if streaming:
+                metrics.ACTIVE_STREAMS.dec(model_id)
+
+    return Response(
+        stream_with_context(generate_stream()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+@app.route('/api/chat/fanout', methods=['POST'])
+@login_required
+def api_chat_fanout():
+    """Stessa domanda a più esperti in un solo batch (streaming, eventi per esperto)"""
+    data = request.json
+    message = data.get('message', '')
+    model_ids = data.get('model_ids', [])
+    max_tokens = data.get('max_tokens', 500)
+    temperature = data.get('temperature', 0.7)
+
+    if not message:
+        return jsonify({'error': 'Messaggio vuoto'}), 400
+    if not valid_max_tokens(max_tokens):
+        return jsonify({'error': 'max_tokens deve essere un intero positivo'}), 400
+    if not isinstance(model_ids, list):
+        return jsonify({'error': 'model_ids deve essere una lista'}), 400
+
+    try:
+        models, group = start_fanout(model_ids, message, max_tokens, temperature)
+    except ContextTooLongError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ Errore: {e}")
+        return jsonify({'error': str(e)}), 500
+
+    def generate_stream():
+        start = time.perf_counter()
+        for model_data in models:
+            metrics.ACTIVE_STREAMS.inc(model_data['info']['id'])
+        try:
+            # Segmenti di tutte le risposte, nell'ordine in cui il batch li genera
+            for index, kind, value in group.stream(models[0]['tokenizer']):
+                yield f"data: {json.dumps(fanout_event(models, group, index, kind, value))}\n\n"
+
+            done = {'done': True, 'total_ms': round((time.perf_counter() - start) * 1000, 1)}
+            yield f"data: {json.dumps(done)}\n\n"
 
         except Exception as e:
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            for model_data in models:
+                metrics.ACTIVE_STREAMS.dec(model_data['info']['id'])
 
     return Response(
         stream_with_context(generate_stream()),
@@ -336,14 +684,88 @@ def api_chat_stream():
     )
 
 
+def health_status():
+    """Stato del server per /api/health"""
+    return {
+        'status': 'ok',
+        'backend': backend.name,
+        'loaded_models': model_manager.adapters.keys() if model_manager else [],
+        'model_registry': model_registry.stats(),
+        'warmup': warmup.stats(),
+        'router': expert_router.stats(),
+        'model_manager': model_manager.stats() if model_manager else None,
+        'scheduler': scheduler.stats() if scheduler else None,
+        'prompt_cache': prompt_cache.stats(),
+        'prompt_builder': prompt_builder.stats() if prompt_builder else None,
+        'response_cache': response_cache.stats() if response_cache else None
+    }
+
+
 @app.route('/api/health', methods=['GET'])
 def health():
     """Health check"""
-    return jsonify({
-        'status': 'ok',
-        'loaded_models': list(loaded_models.keys()),
-        'current_model': current_model_id
-    })
+    return jsonify(health_status())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Metriche in formato Prometheus (protette come le API, salvo METRICS_PUBLIC)"""
+    local = is_local_request() and not app.config['REQUIRE_AUTH_LOCAL']
+    if not (app.config['METRICS_PUBLIC'] or local or session.get('authenticated')):
+        # Niente redirect al login: chi legge /metrics è uno scraper
+        return Response('unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def warmup_order():
+    """
+    Esperti da preparare, in ordine di priorità.
+
+    WARMUP_MODELS: "all" (default: prima DEFAULT_MODEL_ID, poi l'ordine di
+    models_config.json), "none", oppure una lista di id separati da virgole.
+    """
+    setting = app.config['WARMUP_MODELS'].strip()
+    available = [m['id'] for m in get_available_models()]
+    if setting == 'none':
+        return []
+    if setting == 'all':
+        default = default_model_id()
+        return sorted(available, key=lambda model_id: model_id != default)
+    return [model_id.strip() for model_id in setting.split(',') if model_id.strip() in available]
+
+
+def warm_up_model(model_id):
+    """Adapter in cache, snapshot del system prompt e una generazione breve (compila i kernel)"""
+    model_data, generation, _ = start_chat(model_id, "Ciao", [], app.config['WARMUP_TOKENS'], 0)
+    generation.text(model_data['tokenizer'])
+
+
+def start_warmup(port):
+    """
+    Prepara gli esperti in background appena il server è in ascolto.
+
+    Il warm-up decide solo l'ordine di caricamento: l'esperto di default è
+    fissato in cache alla creazione del gestore (get_model_manager). Il
+    prefetch si ferma se la cache degli adapter inizia a eliminare voci: gli esperti
+    già pronti non vengono sacrificati per quelli meno prioritari.
+    """
+    # Il router di model_id "auto" è pronto prima della prima richiesta
+    expert_router.prepare(model_registry.catalog)
+
+    order = warmup_order()
+    if not order:
+        return
+    evictions = {}
+
+    def wait():
+        wait_for_port(port)
+        evictions['start'] = get_model_manager().adapters.evictions
+
+    def cache_full():
+        return get_model_manager().adapters.evictions > evictions['start']
+
+    print(f"🔥 Warm-up in background: {', '.join(order)}")
+    warmup.start(order, warm_up_model, wait=wait, should_stop=cache_full)
 
 
 if __name__ == '__main__':
@@ -354,18 +776,10 @@ if __name__ == '__main__':
     print("📡 Server in avvio...")
     print()
 
-    # Carica il primo modello disponibile
-    available = get_available_models()
-    if available:
-        first_model = available[0]['id']
-        print(f"🔄 Pre-caricamento modello: {available[0]['name']}")
-        try:
-            load_model(first_model)
-            print(f"✅ Modello pronto!")
-        except Exception as e:
-            print(f"⚠️  Errore caricamento: {e}")
+    # Con il reloader di debug il server gira nel processo figlio
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_warmup(8080)
 
-    print()
     print("=" * 70)
     print("🌐 Server avviato!")
     print("=" * 70)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Modalità di serving asincrona (ASGI) della web app.
+
+Stesse route API di app.py (/api/chat, /api/chat/stream, /api/chat/fanout, /api/models,
+/api/model/select, /api/health, /metrics), ma la gestione HTTP gira su un event loop:
+le connessioni SSE in attesa non occupano un thread ciascuna e uno stream
+lento non rallenta gli altri.
+
+Caricamento dei modelli e costruzione del prompt girano in un executor
+dedicato; la generazione resta nel worker dello scheduler, che sveglia
+l'event loop ad ogni token. Le pagine HTML (/, /login, /logout) sono
+servite dall'app Flask montata come WSGI, con la stessa sessione.
+
+Avvio:
+    python asgi.py
+    # oppure: uvicorn asgi:asgi_app --host 0.0.0.0 --port 8080
+"""
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as web
+import metrics
+from prompting import ContextTooLongError, valid_max_tokens
+from response_cache import replay_chunks
+
+# Thread per le operazioni bloccanti (caricamento modelli, tokenizzazione)
+EXECUTOR_WORKERS = int(os.getenv('ASGI_EXECUTOR_WORKERS', '4'))
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix='jarvis-executor')
+
+
+async def run_blocking(func, *args):
+    """Esegue una funzione bloccante nell'executor senza fermare l'event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args))
+
+
+def session_data(request):
+    """Contenuto del cookie di sessione Flask (vuoto se assente o non valido)"""
+    flask_app = web.app
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return {}
+
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        return serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+def save_session(response, request, **values):
+    """Aggiorna il cookie di sessione Flask (stesso formato e firma di app.py)"""
+    flask_app = web.app
+    data = dict(session_data(request), **values)
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    response.set_cookie(
+        flask_app.config['SESSION_COOKIE_NAME'],
+        serializer.dumps(data),
+        max_age=int(flask_app.permanent_session_lifetime.total_seconds()) if data.get('_permanent') else None,
+        path=flask_app.config['SESSION_COOKIE_PATH'] or '/',
+        secure=flask_app.config['SESSION_COOKIE_SECURE'],
+        httponly=flask_app.config['SESSION_COOKIE_HTTPONLY'],
+        samesite=flask_app.config['SESSION_COOKIE_SAMESITE'] or 'lax'
+    )
+    return response
+
+
+def is_authenticated(request):
+    """Stesse regole di login_required, leggendo il cookie di sessione Flask"""
+    client = request.client.host if request.client else None
+    if client in ['127.0.0.1', 'localhost', '::1', '0.0.0.0'] and not web.app.config['REQUIRE_AUTH_LOCAL']:
+        return True
+    return bool(session_data(request).get('authenticated'))
+
+
+def login_required(handler):
+    """Decorator per proteggere le route API con password"""
+    @wraps(handler)
+    async def decorated(request):
+        if not is_authenticated(request):
+            return RedirectResponse('/login', status_code=302)
+        return await handler(request)
+    return decorated
+
+
+@login_required
+async def api_models(request):
+    """Restituisce la lista dei modelli disponibili"""
+    models = [dict(m, state=web.warmup.model_state(m['id'])) for m in web.get_available_models()]
+    return JSONResponse({
+        'models': models,
+        'current': session_data(request).get('model_id')
+    })
+
+
+@login_required
+async def api_select_model(request):
+    """Seleziona un modello"""
+    data = await request.json()
+    model_id = data.get('model_id')
+
+    if not model_id:
+        return JSONResponse({'error': 'model_id mancante'}, status_code=400)
+
+    if model_id == 'auto':
+        # L'esperto viene scelto a ogni messaggio: niente da caricare ora
+        return save_session(JSONResponse({'success': True, 'model': web.AUTO_MODEL_INFO}), request, model_id=model_id)
+
+    try:
+        model_data = await run_blocking(web.load_model, model_id)
+        model_data['handle'].release()
+        # Solo un'indicazione per il client: ogni richiesta di chat indica il suo model_id
+        return save_session(JSONResponse({
+            'success': True,
+            'model': model_data['info']
+        }), request, model_id=model_id)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+@login_required
+async def api_chat(request):
+    """Endpoint per chat (risposta completa)"""
+    data = await request.json()
+    message = data.get('message', '')
+    model_id = data.get('model_id', 'base')
+    history = data.get('history', [])
+    max_tokens = data.get('max_tokens', 500)
+    temperature = data.get('temperature', 0.7)
+
+    if not message:
+        return JSONResponse({'error': 'Messaggio vuoto'}, status_code=400)
+    if not valid_max_tokens(max_tokens):
+        return JSONResponse({'error': 'max_tokens deve essere un intero positivo'}, status_code=400)
+
+    try:
+        model_id, routing = await run_blocking(web.resolve_model, model_id, message)
+
+        cached, cache_ref = await run_blocking(
+            web.lookup_response, model_id, message, history, max_tokens, temperature
+        )
+        if cached is not None:
+            return JSONResponse({
+                'response': cached['response'],
+                'model': cached['model'],
+                'routing': routing,
+                'dropped_turns': cached['dropped_turns'],
+                'cached': True,
+                'stats': cached['stats']
+            })
+
+        model_data, generation, dropped_turns = await run_blocking(
+            web.start_chat, model_id, message, history, max_tokens, temperature
+        )
+        response = web.clean_response(await generation.atext(model_data['tokenizer']))
+        await run_blocking(web.store_response, cache_ref, response, generation, dropped_turns)
+
+        return JSONResponse({
+            'response': response,
+            'model': model_data['info']['name'],
+            'routing': routing,
+            'dropped_turns': dropped_turns,
+            'stats': generation.stats.to_dict()
+        })
+
+    except ContextTooLongError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except Exception as e:
+        print(f"❌ Errore: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+@login_required
+async def api_chat_stream(request):
+    """Endpoint per chat con streaming (Server-Sent Events)"""
+    data = await request.json()
+    message = data.get('message', '')
+    model_id = data.get('model_id', 'base')
+    history = data.get('history', [])
+    max_tokens = data.get('max_tokens', 500)
+    temperature = data.get('temperature', 0.7)
+
+    if not message:
+        return JSONResponse({'error': 'Messaggio vuoto'}, status_code=400)
+    if not valid_max_tokens(max_tokens):
+        return JSONResponse({'error': 'max_tokens deve essere un intero positivo'}, status_code=400)
+
+    try:
+        model_id, routing = await run_blocking(web.resolve_model, model_id, message)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+    async def generate_stream():
+        streaming = False
+        try:
+            # Con model_id "auto" il primo evento dice quale esperto risponde
+            if routing is not None:
+                yield f"data: {json.dumps({'routing': routing})}\n\n"
+
+            # Risposta in cache: la si rimanda come stream di segmenti
+            cached, cache_ref = await run_blocking(
+                web.lookup_response, model_id, message, history, max_tokens, temperature
+            )
+            if cached is not None:
+                for text in replay_chunks(cached['response']):
+                    yield f"data: {json.dumps({'token': text})}\n\n"
+                done = {'done': True, 'dropped_turns': cached['dropped_turns'], 'cached': True, 'stats': cached['stats']}
+                yield f"data: {json.dumps(done)}\n\n"
+                return
+
+            model_data, generation, dropped_turns = await run_blocking(
+                web.start_chat, model_id, message, history, max_tokens, temperature
+            )
+            metrics.ACTIVE_STREAMS.inc(model_id)
+            streaming = True
+
+            # Se il client si disconnette lo stream viene chiuso e la
+            # richiesta cancellata (astream libera lo slot nel batch)
+            parts = []
+            async for text in generation.astream(model_data['tokenizer']):
+                parts.append(text)
+                yield f"data: {json.dumps({'token': text})}\n\n"
+            await run_blocking(
+                web.store_response, cache_ref, web.clean_response(''.join(parts)), generation, dropped_turns
+            )
+
+            done = {'done': True, 'dropped_turns': dropped_turns, 'stats': generation.stats.to_dict()}
+            yield f"data: {json.dumps(done)}\n\n"
+
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            if streaming:
+                metrics.ACTIVE_STREAMS.dec(model_id)
+
+    return StreamingResponse(
+        generate_stream(),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+@login_required
+async def api_chat_fanout(request):
+    """Stessa domanda a più esperti in un solo batch (streaming, eventi per esperto)"""
+    data = await request.json()
+    message = data.get('message', '')
+    model_ids = data.get('model_ids', [])
+    max_tokens = data.get('max_tokens', 500)
+    temperature = data.get('temperature', 0.7)
+
+    if not message:
+        return JSONResponse({'error': 'Messaggio vuoto'}, status_code=400)
+    if not valid_max_tokens(max_tokens):
+        return JSONResponse({'error': 'max_tokens deve essere un intero positivo'}, status_code=400)
+    if not isinstance(model_ids, list):
+        return JSONResponse({'error': 'model_ids deve essere una lista'}, status_code=400)
+
+    try:
+        models, group = await run_blocking(web.start_fanout, model_ids, message, max_tokens, temperature)
+    except ContextTooLongError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except Exception as e:
+        print(f"❌ Errore: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+    async def generate_stream():
+        start = time.perf_counter()
+        for model_data in models:
+            metrics.ACTIVE_STREAMS.inc(model_data['info']['id'])
+        try:
+            # Se il client si disconnette tutte le risposte del gruppo vengono cancellate
+            async for index, kind, value in group.astream(models[0]['tokenizer']):
+                yield f"data: {json.dumps(web.fanout_event(models, group, index, kind, value))}\n\n"
+
+            done = {'done': True, 'total_ms': round((time.perf_counter() - start) * 1000, 1)}
+            yield f"data: {json.dumps(done)}\n\n"
+
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            for model_data in models:
+                metrics.ACTIVE_STREAMS.dec(model_data['info']['id'])
+
+    return StreamingResponse(
+        generate_stream(),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+async def health(request):
+    """Health check"""
+    return JSONResponse(web.health_status())
+
+
+async def metrics_endpoint(request):
+    """Metriche in formato Prometheus (protette come le API, salvo METRICS_PUBLIC)"""
+    if not (web.app.config['METRICS_PUBLIC'] or is_authenticated(request)):
+        return PlainTextResponse('unauthorized\n', status_code=401)
+    return PlainTextResponse(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+asgi_app = Starlette(routes=[
+    Route('/api/models', api_models, methods=['GET']),
+    Route('/api/model/select', api_select_model, methods=['POST']),
+    Route('/api/chat', api_chat, methods=['POST']),
+    Route('/api/chat/stream', api_chat_stream, methods=['POST']),
+    Route('/api/chat/fanout', api_chat_fanout, methods=['POST']),
+    Route('/api/health', health, methods=['GET']),
+    Route('/metrics', metrics_endpoint, methods=['GET']),
+    # Pagine HTML, login e file statici restano all'app Flask
+    Mount('/', app=WSGIMiddleware(web.app))
+])
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    print("=" * 70)
+    print("🚀 Jarvis MLX Web Chat (ASGI)")
+    print("=" * 70)
+    print()
+
+    web.start_warmup(8080)
+
+    print("🌐 Server avviato su http://0.0.0.0:8080")
+    print("💡 Premi CTRL+C per fermare il server")
+    print("=" * 70)
+    print()
+
+    uvicorn.run(asgi_app, host='0.0.0.0', port=8080)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Interfaccia dei backend di inferenza.
+
+Gestore del modello, scheduler e prompt cache non toccano mai direttamente
+MLX: passano da un backend che sa caricare il modello base, applicare un
+adapter, fare prefill e passi di decoding sulle proprie KV cache.
+
+- "mlx": il backend reale (mlx_lm), solo su Apple Silicon
+- "fake": modello finto deterministico con latenza per token configurabile,
+  per avviare, profilare e mettere sotto carico il server ovunque
+
+I moduli dei backend vengono importati solo quando servono, così il server
+con il backend finto parte anche senza MLX installato.
+"""
+
+
+class InferenceBackend:
+    """
+    Operazioni richieste a un backend.
+
+    `model`, `cache` e `logits` sono oggetti opachi del backend: chi li usa
+    li passa solo avanti. Una cache "batch" contiene più sequenze allineate
+    a sinistra, una cache semplice una sola.
+    """
+
+    name = None
+
+    # --- Modello base e adapter ---
+
+    def load_base(self, base_model):
+        """Carica il modello base, ritorna (model, tokenizer)"""
+        raise NotImplementedError
+
+    def read_adapter(self, adapter_dir):
+        """Legge un adapter LoRA, ritorna (config, weights, nbytes)"""
+        raise NotImplementedError
+
+    def apply_adapter(self, model, config, weights):
+        """Attacca l'adapter al modello base"""
+        raise NotImplementedError
+
+    def remove_adapter(self, model):
+        """Riporta il modello allo stato base (anche dopo apply_adapters)"""
+        raise NotImplementedError
+
+    def apply_adapters(self, model, adapters):
+        """
+        Attacca più adapter insieme (multi-LoRA), uno per riga del batch.
+
+        adapters è una lista di (config, weights) o None (modello base puro);
+        set_adapter_rows sceglie quale usa ogni riga.
+        """
+        raise NotImplementedError
+
+    def set_adapter_rows(self, model, rows):
+        """Indice in apply_adapters dell'adapter di ogni riga del prossimo forward pass"""
+        raise NotImplementedError
+
+    def param_bytes(self, model):
+        """Dimensione in byte dei parametri del modello"""
+        raise NotImplementedError
+
+    def memory_bytes(self):
+        """Memoria attiva sull'acceleratore (0 se non disponibile)"""
+        return 0
+
+    def embed(self, model, tokens):
+        """Embedding normalizzato (lista di float) di una sequenza di token"""
+        raise NotImplementedError
+
+    # --- Generazione ---
+
+    def prefill(self, model, prompt_tokens, prefill_step_size=512, cache=None):
+        """Processa il prompt, ritorna (logits dell'ultima posizione, cache)"""
+        raise NotImplementedError
+
+    def sample(self, logits, temperatures):
+        """Un token per riga (temperatura 0 = greedy), come lista di int"""
+        raise NotImplementedError
+
+    def decode_step(self, model, batch_cache, last_tokens):
+        """Un passo di decoding per tutte le righe della cache batch"""
+        raise NotImplementedError
+
+    def eval_cache(self, cache):
+        """Forza il calcolo della cache (i backend lazy la materializzano)"""
+
+    # --- Cache batch ---
+
+    def merge_caches(self, caches):
+        """Unisce le cache di più sequenze in una cache batch"""
+        raise NotImplementedError
+
+    def extend_batch(self, batch_cache, other):
+        """Aggiunge in coda le righe di un'altra cache batch"""
+        raise NotImplementedError
+
+    def filter_batch(self, batch_cache, keep):
+        """Mantiene solo le righe indicate"""
+        raise NotImplementedError
+
+    def extract_row(self, batch_cache, index):
+        """Cache semplice della riga indicata"""
+        raise NotImplementedError
+
+    # --- Prompt cache ---
+
+    def cache_nbytes(self, cache):
+        raise NotImplementedError
+
+    def copy_cache_prefix(self, cache, n):
+        """Copia indipendente dei primi n token della cache"""
+        raise NotImplementedError
+
+    def trim_cache(self, cache, n):
+        """Scarta gli ultimi n token della cache (in place)"""
+        raise NotImplementedError
+
+    # --- Decoding speculativo ---
+
+    def draft_tokens(self, draft_model, draft_cache, last_token, num_draft, temperature):
+        """Propone num_draft token con il modello draft"""
+        raise NotImplementedError
+
+    def verify_draft(self, model, cache, last_token, proposed, temperature):
+        """Token del modello principale per ogni posizione (len(proposed) + 1)"""
+        raise NotImplementedError
+
+    def rewind_caches(self, cache, draft_model, draft_cache, proposed, accepted):
+        """
+        Riporta le cache allo stato dopo i token accettati.
+
+        Il modello principale ha processato last_token + tutte le proposte, il
+        draft last_token + tutte tranne l'ultima: si scarta il resto, oppure,
+        se sono state accettate tutte, si aggiunge al draft l'ultima proposta.
+        """
+        self.trim_cache(cache, len(proposed) - accepted)
+        if accepted < len(proposed):
+            self.trim_cache(draft_cache, len(proposed) - 1 - accepted)
+        elif proposed:
+            self.prefill(draft_model, proposed[-1:], cache=draft_cache)
+
+    # --- Generazione singola ---
+
+    def stream(self, model, tokenizer, prompt_tokens, max_tokens, temperature=0.0, stop_tokens=()):
+        """
+        Genera i token di una singola richiesta, uno alla volta.
+
+        Senza scheduler né batching: per script e test che usano il backend
+        direttamente.
+        """
+        logits, cache = self.prefill(model, prompt_tokens)
+        for _ in range(max_tokens):
+            token = self.sample(logits, [temperature])[0]
+            if token in stop_tokens:
+                return
+            yield token
+            logits, cache = self.prefill(model, [token], cache=cache)
+
+
+def get_backend(name, **options):
+    """Crea il backend indicato ("mlx" o "fake")"""
+    if name == 'mlx':
+        from mlx_backend import MLXBackend
+        return MLXBackend()
+    if name == 'fake':
+        from fake_backend import FakeBackend
+        return FakeBackend(**options)
+    raise ValueError(f"Backend di inferenza sconosciuto: {name}")
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Scelta automatica dell'esperto in base alla domanda (model_id "auto").
+
+Classificatore TF-IDF a centroide più vicino, costruito dai dataset degli
+esperti (data/<adapter_path>/my_data.json): domande e, con peso minore,
+risposte. Ogni esperto è il centroide normalizzato dei suoi esempi; una
+domanda viene assegnata all'esperto con la similarità coseno più alta.
+Con un indice invertito termine -> esperti la classificazione tocca solo i
+termini della domanda: ben sotto il millisecondo.
+"""
+
+import json
+import math
+import re
+import threading
+import time
+from pathlib import Path
+
+_WORDS = re.compile(r'\w+')
+
+# Lunghezza a cui vengono troncate le parole (stemming leggero: ricetta/ricette)
+STEM_LENGTH = 6
+
+# Peso delle risposte rispetto alle domande nei centroidi
+ANSWER_WEIGHT = 0.5
+
+
+def terms(text):
+    """Termini normalizzati di un testo"""
+    return [w[:STEM_LENGTH] for w in _WORDS.findall(text.lower()) if len(w) > 1 and not w.isdigit()]
+
+
+def _example_texts(item):
+    """(domanda, risposta) di un esempio nei formati dei dataset"""
+    if not isinstance(item, dict):
+        return None, None
+    for q, a in (('domanda', 'risposta'), ('question', 'answer'), ('user', 'assistant')):
+        if q in item:
+            return item.get(q) or '', item.get(a) or ''
+    messages = item.get('messages') or []
+    question = next((m.get('content', '') for m in messages if m.get('role') == 'user'), None)
+    answer = next((m.get('content', '') for m in messages if m.get('role') == 'assistant'), '')
+    return question, answer
+
+
+class ExpertRouter:
+    """Centroidi TF-IDF degli esperti e classificazione delle domande"""
+
+    def __init__(self, data_dir, min_score=0.05):
+        self.data_dir = Path(data_dir)
+        self.min_score = min_score
+        # (catalogo, indice invertito, idf, esperti): sostituito in blocco
+        self._state = (None, {}, {}, [])
+        self._build_lock = threading.Lock()
+        self.examples = {}
+        self.build_seconds = None
+
+    def build(self, catalog):
+        """Ricostruisce i centroidi dai dataset degli esperti del catalogo"""
+        start = time.perf_counter()
+        documents = {}
+        for model in catalog.available:
+            if not model.get('adapter_path'):
+                continue
+            data_file = self.data_dir / model['adapter_path'] / "my_data.json"
+            if not data_file.exists():
+                continue
+            try:
+                with open(data_file, 'r', encoding='utf-8') as f:
+                    items = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️  Dataset non leggibile per il router ({data_file}): {e}")
+                continue
+            docs = []
+            for item in items:
+                question, answer = _example_texts(item)
+                if question:
+                    docs.append((terms(question), terms(answer)))
+            if docs:
+                documents[model['id']] = docs
+
+        # IDF sugli esempi di tutti gli esperti
+        df = {}
+        n_docs = 0
+        for docs in documents.values():
+            for question, answer in docs:
+                n_docs += 1
+                for term in set(question) | set(answer):
+                    df[term] = df.get(term, 0) + 1
+        idf = {term: math.log((1 + n_docs) / (1 + count)) + 1 for term, count in df.items()}
+
+        index = {}
+        experts = list(documents)
+        for i, model_id in enumerate(experts):
+            centroid = {}
+            for question, answer in documents[model_id]:
+                vector = {}
+                for weight, words in ((1.0, question), (ANSWER_WEIGHT, answer)):
+                    for term in words:
+                        vector[term] = vector.get(term, 0.0) + weight * idf[term]
+                _normalize(vector)
+                for term, value in vector.items():
+                    centroid[term] = centroid.get(term, 0.0) + value
+            _normalize(centroid)
+            for term, value in centroid.items():
+                index.setdefault(term, []).append((i, value))
+
+        self._state = (catalog, index, idf, experts)
+        self.examples = {model_id: len(docs) for model_id, docs in documents.items()}
+        self.build_seconds = time.perf_counter() - start
+
+    def prepare(self, catalog):
+        """Costruisce i centroidi per il catalogo, se non sono già i suoi"""
+        if catalog is not self._state[0]:
+            with self._build_lock:
+                if catalog is not self._state[0]:
+                    self.build(catalog)
+
+    def route(self, message, catalog, fallback=None):
+        """
+        Esperto per la domanda.
+
+        Ritorna {'model_id', 'confidence', 'score', 'scores', 'route_ms'}:
+        score è la similarità coseno con il centroide scelto, confidence la
+        sua quota sul totale delle similarità. Sotto min_score (nessun
+        termine in comune) si usa `fallback`.
+        """
+        start = time.perf_counter()
+        # Di solito già fatto all'avvio o al ricaricamento del catalogo (app.py)
+        self.prepare(catalog)
+        _, index, idf, experts = self._state
+
+        vector = {}
+        for term in terms(message):
+            weight = idf.get(term)
+            if weight is not None:
+                vector[term] = vector.get(term, 0.0) + weight
+        norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+
+        scores = [0.0] * len(experts)
+        for term, value in vector.items():
+            for i, weight in index[term]:
+                scores[i] += value / norm * weight
+
+        best = max(range(len(scores)), key=scores.__getitem__) if scores else None
+        total = sum(scores)
+        if best is None or scores[best] < self.min_score:
+            model_id, score, confidence = fallback, 0.0, 0.0
+        else:
+            model_id, score, confidence = experts[best], scores[best], scores[best] / total
+        return {
+            'model_id': model_id,
+            'confidence': round(confidence, 3),
+            'score': round(score, 3),
+            'scores': {m: round(s, 3) for m, s in zip(experts, scores) if s > 0},
+            'route_ms': round((time.perf_counter() - start) * 1000, 3)
+        }
+
+    def stats(self):
+        """Stato per /api/health"""
+        return {
+            'experts': self.examples,
+            'terms': len(self._state[1]),
+            'build_ms': round(self.build_seconds * 1000, 1) if self.build_seconds is not None else None
+        }
+
+
+def _normalize(vector):
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    if norm:
+        for term in vector:
+            vector[term] /= norm
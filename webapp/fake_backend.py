@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Backend di inferenza finto, deterministico e senza dipendenze.
+
+Simula il modello con un tokenizer a byte (più i token speciali ChatML) e
+una "rete" che sceglie il token successivo da un hash di tutta la sequenza:
+la stessa conversazione sullo stesso esperto produce sempre la stessa
+risposta. Prefill, decoding, swap degli adapter e memoria della KV cache
+hanno costi configurabili, così scheduler, cache e API si possono misurare
+su qualsiasi macchina, anche senza MLX né pesi.
+
+Parte dei token dipende dall'adapter attivo: il modello draft (senza
+adapter) indovina gli altri, quindi anche il decoding speculativo ha un
+tasso di accettazione realistico.
+"""
+
+import json
+import re
+import time
+from pathlib import Path
+
+from backends import InferenceBackend
+
+SPECIAL_TOKENS = {'<|im_start|>': 256, '<|im_end|>': 257, '<|endoftext|>': 258}
+_SPECIAL_IDS = {v: k for k, v in SPECIAL_TOKENS.items()}
+_SPECIAL_RE = re.compile('(' + '|'.join(re.escape(t) for t in SPECIAL_TOKENS) + ')')
+
+# Caratteri generati (lo spazio più spesso, per avere "parole")
+_ALPHABET = [ord(c) for c in "abcdefghilmnoprstuvz     "]
+
+_MASK = (1 << 64) - 1
+_FNV_PRIME = 1099511628211
+_FNV_OFFSET = 14695981039346656037
+
+
+def _mix(state, value):
+    return ((state ^ value) * _FNV_PRIME) & _MASK
+
+
+def _salt(text):
+    state = _FNV_OFFSET
+    for b in text.encode('utf-8'):
+        state = _mix(state, b)
+    return state
+
+
+class FakeTokenizer:
+    """Tokenizer a byte con i token speciali ChatML (nessun chat template: si usa ChatML)"""
+
+    chat_template = None
+    eos_token_id = SPECIAL_TOKENS['<|im_end|>']
+    eos_token_ids = {SPECIAL_TOKENS['<|im_end|>'], SPECIAL_TOKENS['<|endoftext|>']}
+    vocab_size = 259
+
+    def encode(self, text, add_special_tokens=True):
+        ids = []
+        for part in _SPECIAL_RE.split(text):
+            if part in SPECIAL_TOKENS:
+                ids.append(SPECIAL_TOKENS[part])
+            elif part:
+                ids.extend(part.encode('utf-8'))
+        return ids
+
+    def decode(self, ids):
+        out = bytearray()
+        for i in ids:
+            out.extend(_SPECIAL_IDS[i].encode('utf-8') if i in _SPECIAL_IDS else bytes([i]))
+        return out.decode('utf-8', errors='replace')
+
+
+class FakeModel:
+    def __init__(self, name):
+        self.name = name
+        # Sale dell'adapter attivo (0 = modello base)
+        self.adapter_salt = 0
+        # Multi-LoRA: sali degli adapter attaccati e sale di ogni riga del batch
+        self.adapter_salts = None
+        self.row_salts = None
+
+    def salt(self, row):
+        return self.row_salts[row] if self.adapter_salts is not None else self.adapter_salt
+
+
+class FakeCache:
+    """KV cache finta: l'hash cumulativo della sequenza dopo ogni token"""
+
+    def __init__(self, states=None):
+        self.states = states or []
+
+    def last_state(self):
+        return self.states[-1] if self.states else _FNV_OFFSET
+
+
+class FakeBatchCache:
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class FakeBackend(InferenceBackend):
+    """Backend finto con latenze configurabili"""
+
+    name = 'fake'
+
+    def __init__(self, token_ms=10.0, prefill_ms=0.2, swap_ms=5.0, draft_ms=1.0,
+                 adapter_ratio=0.3, eos_every=400, kv_bytes_per_token=57344, adapter_bytes=4 * 1024 * 1024):
+        # Tempo di un forward pass di decoding (tutto il batch) e di prefill per token
+        self.token_seconds = token_ms / 1000
+        self.prefill_seconds = prefill_ms / 1000
+        self.swap_seconds = swap_ms / 1000
+        self.draft_seconds = draft_ms / 1000
+        # Frazione dei token che dipende dall'adapter
+        self.adapter_ratio = adapter_ratio
+        # In media un token di fine risposta ogni eos_every token
+        self.eos_every = eos_every
+        # Memoria simulata (come un 7B con GQA in fp16)
+        self.kv_bytes_per_token = kv_bytes_per_token
+        self.adapter_bytes = adapter_bytes
+
+    # --- Modello finto ---
+
+    def _next_token(self, model, state, row=0):
+        h = _mix(state, 0x9E3779B97F4A7C15)
+        salt = model.salt(row)
+        if salt and (h >> 8) % 1000 < self.adapter_ratio * 1000:
+            h = _mix(h, salt)
+        if h % self.eos_every == 0:
+            return SPECIAL_TOKENS['<|im_end|>']
+        return _ALPHABET[(h >> 16) % len(_ALPHABET)]
+
+    def _forward(self, model, cache, tokens, row=0):
+        """Aggiunge i token alla cache e ritorna la previsione dopo ognuno"""
+        predictions = []
+        state = cache.last_state()
+        for token in tokens:
+            state = _mix(state, token)
+            cache.states.append(state)
+            predictions.append(self._next_token(model, state, row))
+        return predictions
+
+    # --- Modello base e adapter ---
+
+    def load_base(self, base_model):
+        return FakeModel(base_model), FakeTokenizer()
+
+    def read_adapter(self, adapter_dir):
+        adapter_dir = Path(adapter_dir)
+        config = {}
+        config_file = adapter_dir / "adapter_config.json"
+        if config_file.exists():
+            with open(config_file, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        return config, {'salt': _salt(str(adapter_dir.resolve()))}, self.adapter_bytes
+
+    def apply_adapter(self, model, config, weights):
+        time.sleep(self.swap_seconds)
+        model.adapter_salt = weights['salt']
+
+    def remove_adapter(self, model):
+        model.adapter_salt = 0
+        model.adapter_salts = None
+        model.row_salts = None
+
+    def apply_adapters(self, model, adapters):
+        time.sleep(self.swap_seconds * len(adapters))
+        model.adapter_salts = [adapter[1]['salt'] if adapter else 0 for adapter in adapters]
+
+    def set_adapter_rows(self, model, rows):
+        model.row_salts = [model.adapter_salts[i] for i in rows]
+
+    def param_bytes(self, model):
+        return 0
+
+    def embed(self, model, tokens):
+        """Istogramma normalizzato dei byte"""
+        counts = [0.0] * 256
+        for t in tokens:
+            if t < 256:
+                counts[t] += 1
+        norm = sum(c * c for c in counts) ** 0.5 or 1.0
+        return [c / norm for c in counts]
+
+    # --- Generazione ---
+
+    def prefill(self, model, prompt_tokens, prefill_step_size=512, cache=None):
+        if cache is None:
+            cache = FakeCache()
+        time.sleep(self.prefill_seconds * len(prompt_tokens))
+        return [self._forward(model, cache, prompt_tokens)[-1]], cache
+
+    def sample(self, logits, temperatures):
+        # I "logits" sono già i token scelti: il modello finto è deterministico
+        return list(logits)
+
+    def decode_step(self, model, batch_cache, last_tokens):
+        time.sleep(self.token_seconds)
+        return [
+            self._forward(model, row, [t], i)[-1]
+            for i, (row, t) in enumerate(zip(batch_cache.rows, last_tokens))
+        ]
+
+    # --- Cache batch ---
+
+    def merge_caches(self, caches):
+        return FakeBatchCache(list(caches))
+
+    def extend_batch(self, batch_cache, other):
+        batch_cache.rows.extend(other.rows)
+
+    def filter_batch(self, batch_cache, keep):
+        batch_cache.rows = [batch_cache.rows[i] for i in keep]
+
+    def extract_row(self, batch_cache, index):
+        return FakeCache(list(batch_cache.rows[index].states))
+
+    # --- Prompt cache ---
+
+    def cache_nbytes(self, cache):
+        return len(cache.states) * self.kv_bytes_per_token
+
+    def copy_cache_prefix(self, cache, n):
+        return FakeCache(cache.states[:n])
+
+    def trim_cache(self, cache, n):
+        if n > 0:
+            del cache.states[-n:]
+
+    # --- Decoding speculativo ---
+
+    def draft_tokens(self, draft_model, draft_cache, last_token, num_draft, temperature):
+        proposed = []
+        token = last_token
+        for _ in range(num_draft):
+            time.sleep(self.draft_seconds)
+            token = self._forward(draft_model, draft_cache, [token])[-1]
+            proposed.append(token)
+        # Come nel backend MLX la cache del draft non contiene l'ultima proposta
+        return proposed
+
+    def verify_draft(self, model, cache, last_token, proposed, temperature):
+        time.sleep(self.token_seconds)
+        return self._forward(model, cache, [last_token] + proposed)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Mattoni per la generazione incrementale token per token.
+
+Detokenizzazione in streaming, statistiche e token di stop, comuni a tutti
+i backend; le operazioni sul modello (prefill, decoding, campionamento)
+sono nei backend di inferenza (backends.py).
+"""
+
+STOP_MARKERS = ["<|im_end|>", "<|endoftext|>"]
+
+
+class IncrementalDetokenizer:
+    """
+    Detokenizzatore in streaming indipendente dal tokenizer.
+
+    Decodifica solo una piccola finestra di token (prefisso già emesso +
+    token nuovi) e trattiene il testo finché termina con un carattere UTF-8
+    incompleto ('\\ufffd'), così i caratteri multi-byte spezzati su più
+    token escono interi.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, tokens):
+        return self.tokenizer.decode(tokens)
+
+    def add_token(self, token):
+        """Aggiunge un token e ritorna il nuovo testo pronto (anche '')"""
+        self.tokens.append(token)
+        prefix_text = self._decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.tokens[self.prefix_offset:])
+
+        if len(new_text) > len(prefix_text) and not new_text.endswith('\ufffd'):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.tokens)
+            return new_text[len(prefix_text):]
+        return ''
+
+    def finalize(self):
+        """Emette l'eventuale testo rimasto in sospeso a fine generazione"""
+        prefix_text = self._decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.tokens[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.tokens)
+        return new_text[len(prefix_text):]
+
+
+def stop_token_ids(tokenizer):
+    """Token che terminano la risposta: EOS del tokenizer + marker ChatML"""
+    stops = set(getattr(tokenizer, 'eos_token_ids', None) or [])
+    if getattr(tokenizer, 'eos_token_id', None) is not None:
+        stops.add(tokenizer.eos_token_id)
+    for marker in STOP_MARKERS:
+        ids = tokenizer.encode(marker, add_special_tokens=False)
+        if len(ids) == 1:
+            stops.add(ids[0])
+    return stops
+
+
+class GenerationStats:
+    """Metriche di una singola generazione (TTFT, token/s, ...)"""
+
+    def __init__(self, prompt_tokens=0):
+        self.prompt_tokens = prompt_tokens
+        self.generated_tokens = 0
+        self.cached_tokens = 0
+        self.queue_wait = None
+        self.prefill_time = None
+        self.ttft = None
+        self.total_time = None
+        self.finish_reason = None
+        # Decoding speculativo: token proposti dal draft e accettati
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+
+    def tokens_per_sec(self):
+        if not self.generated_tokens or not self.total_time or self.ttft is None:
+            return None
+        decode_time = self.total_time - self.ttft
+        if decode_time <= 0 or self.generated_tokens < 2:
+            return None
+        return (self.generated_tokens - 1) / decode_time
+
+    def acceptance_rate(self):
+        if not self.draft_tokens:
+            return None
+        return self.accepted_tokens / self.draft_tokens
+
+    def to_dict(self):
+        tps = self.tokens_per_sec()
+        return {
+            'prompt_tokens': self.prompt_tokens,
+            'generated_tokens': self.generated_tokens,
+            'cached_tokens': self.cached_tokens,
+            'queue_wait_ms': round(self.queue_wait * 1000, 1) if self.queue_wait is not None else None,
+            'prefill_ms': round(self.prefill_time * 1000, 1) if self.prefill_time is not None else None,
+            'ttft_ms': round(self.ttft * 1000, 1) if self.ttft is not None else None,
+            'total_ms': round(self.total_time * 1000, 1) if self.total_time is not None else None,
+            'tokens_per_sec': round(tps, 2) if tps is not None else None,
+            'finish_reason': self.finish_reason,
+            'draft_tokens': self.draft_tokens,
+            'accepted_tokens': self.accepted_tokens,
+            'acceptance_rate': round(self.acceptance_rate(), 3) if self.draft_tokens else None
+        }
+
+
+def accepted_prefix(proposed, sampled):
+    """Numero di proposte del draft confermate dal modello principale"""
+    n = 0
+    while n < len(proposed) and proposed[n] == sampled[n]:
+        n += 1
+    return n
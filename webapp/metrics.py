@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Metriche in formato Prometheus (esposte su /metrics).
+
+Contatori, gauge e istogrammi con etichette, senza dipendenze esterne:
+ogni aggiornamento è un'operazione su un dict sotto un lock, quindi la
+strumentazione nel ciclo di generazione costa pochi microsecondi.
+
+Le metriche sono definite qui, a livello di modulo, e aggiornate dai
+moduli che le producono (scheduler, gestore del modello, cache, app).
+I valori che esistono già altrove (memoria, sequenze attive) sono gauge
+calcolati al momento della lettura.
+"""
+
+import bisect
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Secondi: dai pochi millisecondi del prefill di un turno ai minuti di una coda lunga
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Token al secondo di una singola conversazione
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 100, 150, 200, 500)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}: attese le etichette {self.labelnames}, ricevute {labels}")
+        return tuple('' if v is None else str(v) for v in labels)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, key, value in self._samples():
+            lines.append(f'{name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    """Valore che può solo crescere (richieste, token, hit della cache)"""
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Valore istantaneo; con set_function viene letto al momento dello scrape"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set_function(self, function):
+        """
+        Calcola il valore a ogni lettura. La funzione ritorna un numero
+        (gauge senza etichette) o un dict {tupla di etichette: valore};
+        None o un errore saltano la metrica.
+        """
+        self._function = function
+
+    def _samples(self):
+        if self._function is None:
+            return super()._samples()
+        try:
+            value = self._function()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        if not isinstance(value, dict):
+            return [(self.name, (), value)]
+        return [(self.name, self._key(k if isinstance(k, tuple) else (k,)), v) for k, v in sorted(value.items())]
+
+
+class Histogram(_Metric):
+    """Distribuzione di valori a bucket cumulativi (latenze, token/s)"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Conteggi per bucket (non cumulativi) + bucket +Inf, somma
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Misura la durata del blocco with"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in sorted(self._values.items())]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(float(bound))))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def render():
+    """Tutte le metriche nel formato testuale di Prometheus (0.0.4)"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def current_rss_bytes():
+    """Memoria residente attuale del processo (None dove /proc non c'è, es. macOS)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize()
+
+
+# ============================================================================
+# METRICHE DELLA WEBAPP
+# ============================================================================
+
+# --- Generazione (scheduler) ---
+REQUESTS = Counter(
+    'jarvis_generation_requests_total', 'Generazioni terminate per esperto e motivo', ('model', 'reason')
+)
+GENERATED_TOKENS = Counter('jarvis_generated_tokens_total', 'Token generati per esperto', ('model',))
+PROMPT_TOKENS = Counter(
+    'jarvis_prompt_tokens_total', 'Token dei prompt per esperto (cached = riusati dalla prompt cache)',
+    ('model', 'source')
+)
+QUEUE_WAIT = Histogram('jarvis_queue_wait_seconds', 'Attesa in coda prima del prefill', ('model',))
+PREFILL = Histogram('jarvis_prefill_seconds', 'Durata del prefill del prompt', ('model',))
+TTFT = Histogram('jarvis_ttft_seconds', 'Tempo al primo token (dalla messa in coda)', ('model',))
+DECODE_TPS = Histogram(
+    'jarvis_decode_tokens_per_second', 'Velocità di decoding per conversazione', ('model',),
+    buckets=THROUGHPUT_BUCKETS
+)
+ACTIVE_SEQUENCES = Gauge('jarvis_active_sequences', 'Conversazioni nel batch di decoding', ('model',))
+QUEUED_REQUESTS = Gauge('jarvis_queued_requests', 'Richieste in attesa del prefill')
+
+# --- Modello e adapter ---
+MODEL_LOAD = Histogram('jarvis_model_load_seconds', 'Durata di load_model (base + adapter in cache)', ('model',))
+ADAPTER_LOAD = Histogram('jarvis_adapter_load_seconds', 'Lettura da disco dei pesi di un adapter', ('model',))
+ADAPTER_SWAP = Histogram('jarvis_adapter_swap_seconds', 'Durata dello swap verso l\'adapter dell\'esperto', ('model',))
+
+# --- Prompt e cache ---
+PROMPT_BUILD = Histogram('jarvis_prompt_build_seconds', 'Costruzione dei token del prompt', ('model',))
+CACHE_LOOKUPS = Counter(
+    'jarvis_cache_lookups_total', 'Ricerche nelle cache (adapter, prompt, response) per esito',
+    ('cache', 'model', 'result')
+)
+
+# --- HTTP ---
+ACTIVE_STREAMS = Gauge('jarvis_active_streams', 'Stream SSE aperti', ('model',))
+
+# --- Memoria ---
+PROCESS_RSS = Gauge('jarvis_process_resident_memory_bytes', 'Memoria residente del processo')
+PROCESS_PEAK_RSS = Gauge('jarvis_process_peak_resident_memory_bytes', 'Picco di memoria residente del processo')
+ACCELERATOR_MEMORY = Gauge('jarvis_accelerator_active_memory_bytes', 'Memoria attiva sull\'acceleratore')
+PROCESS_RSS.set_function(current_rss_bytes)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Backend di inferenza MLX (mlx_lm) per Apple Silicon.
+
+Modello base 4-bit con layer LoRA attaccati/staccati al volo (anche più
+adapter insieme, uno per riga del batch), KV cache batch left-padded per il
+batching continuo e KV cache semplici per prompt cache e decoding
+speculativo.
+"""
+
+import json
+from pathlib import Path
+
+import mlx.core as mx
+import mlx.nn as nn
+from mlx.utils import tree_flatten, tree_unflatten
+from mlx_lm import load
+from mlx_lm.models.cache import BatchKVCache, KVCache, make_prompt_cache, trim_prompt_cache
+from mlx_lm.tuner.utils import linear_to_lora_layers, remove_lora_layers
+
+from backends import InferenceBackend
+
+
+class _AdapterRows:
+    """Adapter di ogni riga del batch, condiviso da tutti i layer multi-LoRA del modello"""
+
+    def __init__(self):
+        self.ids = mx.array([0])
+
+
+class MultiLoRALinear(nn.Module):
+    """
+    Layer lineare del modello base con più adapter LoRA, uno per riga.
+
+    lora_a (adapter, input, rank) e lora_b (adapter, rank, output) impilano
+    i pesi di tutti gli adapter: rank portato al massimo con zeri, scala già
+    applicata a lora_b, pesi nulli per gli adapter che non toccano il layer.
+    """
+
+    def __init__(self, linear, lora_a, lora_b, rows):
+        super().__init__()
+        self.linear = linear
+        self.lora_a = lora_a
+        self.lora_b = lora_b
+        self.rows = rows
+
+    def __call__(self, x):
+        y = self.linear(x)
+        ids = self.rows.ids
+        z = (x @ self.lora_a[ids]) @ self.lora_b[ids]
+        return y + z.astype(x.dtype)
+
+
+class MLXBackend(InferenceBackend):
+    """Backend reale su MLX"""
+
+    name = 'mlx'
+
+    # --- Modello base e adapter ---
+
+    def load_base(self, base_model):
+        return load(base_model)
+
+    def read_adapter(self, adapter_dir):
+        """Legge configurazione e pesi di un adapter LoRA dalla sua directory"""
+        adapter_dir = Path(adapter_dir)
+        with open(adapter_dir / "adapter_config.json", 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        weights = mx.load(str(adapter_dir / "adapters.safetensors"))
+        return config, weights, sum(w.nbytes for w in weights.values())
+
+    def apply_adapter(self, model, config, weights):
+        """Applica i layer LoRA e carica i pesi dell'adapter"""
+        fine_tune_type = config.get('fine_tune_type', 'lora')
+        if fine_tune_type != 'lora':
+            raise ValueError(f"Tipo di adapter non supportato per hot-swap: {fine_tune_type}")
+
+        linear_to_lora_layers(model, config['num_layers'], config['lora_parameters'])
+        mx.eval(list(weights.values()))
+        model.load_weights(list(weights.items()), strict=False)
+        model.eval()
+
+    def remove_adapter(self, model):
+        multi = [(name, m.linear) for name, m in model.named_modules() if isinstance(m, MultiLoRALinear)]
+        if multi:
+            model.update_modules(tree_unflatten(multi))
+        else:
+            remove_lora_layers(model)
+
+    def apply_adapters(self, model, adapters):
+        """
+        Attacca insieme gli adapter LoRA di più esperti.
+
+        Ogni layer con LoRA in almeno un adapter diventa un MultiLoRALinear;
+        con set_adapter_rows ogni riga del batch usa il proprio adapter, così
+        esperti diversi avanzano nello stesso forward pass sul modello base.
+        """
+        layers = {}
+        for i, adapter in enumerate(adapters):
+            if adapter is None:
+                continue
+            config, weights = adapter
+            fine_tune_type = config.get('fine_tune_type', 'lora')
+            if fine_tune_type != 'lora':
+                raise ValueError(f"Tipo di adapter non supportato per il batch multi-LoRA: {fine_tune_type}")
+            scale = config['lora_parameters']['scale']
+            for name, lora_a in weights.items():
+                if name.endswith('.lora_a'):
+                    path = name[:-len('.lora_a')]
+                    layers.setdefault(path, {})[i] = (lora_a, weights[path + '.lora_b'] * scale)
+
+        modules = dict(model.named_modules())
+        rows = _AdapterRows()
+        multi = []
+        for path, per_adapter in layers.items():
+            rank = max(a.shape[1] for a, _ in per_adapter.values())
+            first_a, first_b = next(iter(per_adapter.values()))
+            lora_a = mx.zeros((len(adapters), first_a.shape[0], rank), dtype=first_a.dtype)
+            lora_b = mx.zeros((len(adapters), rank, first_b.shape[1]), dtype=first_b.dtype)
+            for i, (a, b) in per_adapter.items():
+                lora_a[i, :, :a.shape[1]] = a
+                lora_b[i, :b.shape[0], :] = b
+            multi.append((path, MultiLoRALinear(modules[path], lora_a, lora_b, rows)))
+
+        model.update_modules(tree_unflatten(multi))
+        mx.eval([(m.lora_a, m.lora_b) for _, m in multi])
+        model.adapter_rows = rows
+        model.eval()
+
+    def set_adapter_rows(self, model, rows):
+        model.adapter_rows.ids = mx.array(rows)
+
+    def param_bytes(self, model):
+        return sum(p.nbytes for _, p in tree_flatten(model.parameters()))
+
+    def memory_bytes(self):
+        get_active = getattr(mx, 'get_active_memory', None)
+        if get_active is None:
+            get_active = getattr(getattr(mx, 'metal', None), 'get_active_memory', None)
+        try:
+            return get_active() if get_active else 0
+        except Exception:
+            return 0
+
+    def embed(self, model, tokens):
+        """
+        Media degli embedding di input dei token, normalizzata: non dipende
+        dall'adapter attivo ed è abbastanza per riconoscere riformulazioni
+        minime (punteggiatura, maiuscole, parole in più o in meno).
+        """
+        embed_tokens = getattr(model, 'model', model).embed_tokens
+        mean = embed_tokens(mx.array(tokens)).astype(mx.float32).mean(axis=0)
+        mean = mean / mx.maximum(mx.linalg.norm(mean), 1e-6)
+        mx.eval(mean)
+        return mean.tolist()
+
+    # --- Generazione ---
+
+    def prefill(self, model, prompt_tokens, prefill_step_size=512, cache=None):
+        """Processa il prompt a blocchi riempiendo la KV cache"""
+        if cache is None:
+            cache = make_prompt_cache(model)
+        prompt = mx.array(prompt_tokens)
+        while prompt.size > prefill_step_size:
+            model(prompt[:prefill_step_size][None], cache=cache)
+            mx.eval([c.state for c in cache])
+            prompt = prompt[prefill_step_size:]
+        logits = model(prompt[None], cache=cache)[:, -1, :]
+        return logits, cache
+
+    def _sample(self, logits, temperatures):
+        logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+        temps = mx.array(temperatures, dtype=logprobs.dtype)
+        greedy = mx.argmax(logprobs, axis=-1)
+        sampled = mx.random.categorical(logprobs * (1 / mx.maximum(temps, 1e-5))[:, None])
+        return mx.where(temps > 0, sampled, greedy)
+
+    def sample(self, logits, temperatures):
+        """Campiona un token per riga con temperatura indipendente per ogni riga"""
+        return self._sample(logits, temperatures).tolist()
+
+    def decode_step(self, model, batch_cache, last_tokens):
+        inputs = mx.array(last_tokens)[:, None]
+        return model(inputs, cache=batch_cache)[:, -1, :]
+
+    def eval_cache(self, cache):
+        mx.eval([c.state for c in cache])
+
+    # --- Cache batch ---
+
+    def merge_caches(self, caches):
+        """Unisce le KV cache di più sequenze in una cache batch (left-padded)"""
+        return [BatchKVCache.merge(list(layer)) for layer in zip(*caches)]
+
+    def extend_batch(self, batch_cache, other):
+        for c, o in zip(batch_cache, other):
+            c.extend(o)
+
+    def filter_batch(self, batch_cache, keep):
+        for c in batch_cache:
+            c.filter(keep)
+
+    def extract_row(self, batch_cache, index):
+        return [layer.extract(index) for layer in batch_cache]
+
+    # --- Prompt cache ---
+
+    def cache_nbytes(self, cache):
+        total = 0
+        for layer in cache:
+            keys, values = getattr(layer, 'keys', None), getattr(layer, 'values', None)
+            if keys is not None:
+                total += keys.nbytes + values.nbytes
+        return total
+
+    def copy_cache_prefix(self, cache, n):
+        """
+        Copia i primi n token di una KV cache.
+
+        Le slice MLX sono nuovi array: scrivere nella copia non modifica
+        l'originale, che resta riutilizzabile da altre conversazioni.
+        """
+        copied = []
+        for layer in cache:
+            c = KVCache()
+            c.keys = layer.keys[..., :n, :]
+            c.values = layer.values[..., :n, :]
+            c.offset = n
+            copied.append(c)
+        return copied
+
+    def trim_cache(self, cache, n):
+        if n > 0:
+            trim_prompt_cache(cache, n)
+
+    # --- Decoding speculativo ---
+
+    def draft_tokens(self, draft_model, draft_cache, last_token, num_draft, temperature):
+        """
+        Propone num_draft token con il modello draft, uno dopo l'altro.
+
+        La cache del draft avanza di num_draft token (last_token e le proposte
+        tranne l'ultima).
+        """
+        y = mx.array([last_token])
+        proposed = []
+        for _ in range(num_draft):
+            logits = draft_model(y[None], cache=draft_cache)[:, -1, :]
+            y = self._sample(logits, [temperature])
+            mx.async_eval(y)
+            proposed.append(y)
+        return mx.concatenate(proposed).tolist() if proposed else []
+
+    def verify_draft(self, model, cache, last_token, proposed, temperature):
+        """
+        Verifica le proposte del draft con un solo forward pass del modello.
+
+        Le proposte valgono finché coincidono con i token campionati dal
+        modello principale; il primo token diverso (o quello dopo l'ultima
+        proposta) è comunque corretto.
+        """
+        inputs = mx.array([last_token] + proposed)[None]
+        logits = model(inputs, cache=cache)[0]
+        return self.sample(logits, [temperature] * logits.shape[0])
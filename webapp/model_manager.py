@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Gestione del modello base residente e hot-swap degli adapter LoRA.
+
+Il modello base (models_config.json["base_model"]) viene caricato una sola
+volta; cambiare esperto significa solo staccare i layer LoRA correnti e
+attaccare quelli del nuovo adapter, senza rileggere i pesi 4-bit dal disco.
+
+Caricamento e swap passano dal backend di inferenza (backends.py).
+"""
+
+import resource
+import sys
+import threading
+import time
+from pathlib import Path
+
+import metrics
+from adapter_cache import AdapterCache
+
+
+def _bytes_to_mb(n):
+    return round(n / (1024 * 1024), 2)
+
+
+def process_rss_bytes():
+    """Memoria residente (picco) del processo, in byte"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Su macOS ru_maxrss è in byte, su Linux in kilobyte
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class ModelHandle:
+    """
+    Riferimento di una richiesta a un esperto.
+
+    Finché non viene rilasciato, i pesi dell'adapter restano nella cache
+    (l'eliminazione aspetta che il contatore torni a zero).
+    """
+
+    def __init__(self, manager, model_id, adapter_path):
+        self.manager = manager
+        self.model_id = model_id
+        self.adapter_path = adapter_path
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        """Rilascia l'esperto (idempotente)"""
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.manager.adapters.release(self.model_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class ModelManager:
+    """
+    Modello base residente con un adapter LoRA attivo alla volta, oppure un
+    gruppo di adapter insieme (uno per riga del batch, activate_group)
+    """
+
+    def __init__(self, base_model, models_dir, adapter_budget_bytes, backend):
+        self.backend = backend
+        self.base_model = base_model
+        self.models_dir = Path(models_dir)
+        self.model = None
+        self.tokenizer = None
+        self.adapters = AdapterCache(adapter_budget_bytes)
+        self.active_model_id = None
+        self.active_adapter = None
+        # Esperti attivi insieme nel batch multi-LoRA: tupla di (model_id, adapter_path)
+        self.active_group = None
+        self.base_load_seconds = None
+        self.last_swap_seconds = None
+        self.swap_count = 0
+        self.total_swap_seconds = 0.0
+        self._adapter_bytes = 0
+        # Modelli draft per il decoding speculativo (nome -> modello)
+        self.drafts = {}
+        self._lock = threading.RLock()
+        # Solo per gli embedding: non aspettano i forward pass del worker
+        self._embed_lock = threading.Lock()
+
+    def ensure_base(self):
+        """Carica il modello base la prima volta che serve"""
+        with self._lock:
+            if self.model is None:
+                print(f"🔄 Caricamento modello base: {self.base_model}")
+                start = time.perf_counter()
+                self.model, self.tokenizer = self.backend.load_base(self.base_model)
+                self.base_load_seconds = time.perf_counter() - start
+                print(f"✅ Modello base residente ({self.base_load_seconds:.1f}s)")
+            return self.model, self.tokenizer
+
+    @property
+    def lock(self):
+        """Lock da tenere durante ogni forward pass sul modello condiviso"""
+        return self._lock
+
+    def prepare(self, model_id, adapter_path):
+        """Carica base e pesi dell'adapter in cache senza attivarlo"""
+        with self._lock:
+            self.ensure_base()
+            if adapter_path:
+                self._get_adapter(model_id, adapter_path)
+
+    def acquire(self, model_id, adapter_path):
+        """Prepara l'esperto e ritorna un ModelHandle che lo tiene in cache"""
+        self.adapters.retain(model_id)
+        try:
+            self.prepare(model_id, adapter_path)
+        except BaseException:
+            self.adapters.release(model_id)
+            raise
+        return ModelHandle(self, model_id, adapter_path)
+
+    def activate(self, model_id, adapter_path):
+        """
+        Rende attivo l'adapter del modello indicato (None = modello base puro).
+
+        I pesi dell'adapter vengono presi dalla cache LRU se presenti,
+        altrimenti letti da disco e messi in cache.
+        Ritorna i secondi spesi nello swap (0 se era già attivo).
+        """
+        with self._lock:
+            self.ensure_base()
+            if self.active_group is None and model_id == self.active_model_id and adapter_path == self.active_adapter:
+                return 0.0
+
+            start = time.perf_counter()
+            self._detach()
+            if adapter_path:
+                config, weights, nbytes = self._get_adapter(model_id, adapter_path)
+                self.backend.apply_adapter(self.model, config, weights)
+                self._adapter_bytes = nbytes
+            self.active_model_id = model_id
+            self.active_adapter = adapter_path
+            elapsed = time.perf_counter() - start
+            self._record_swap(model_id, elapsed)
+            print(f"🔁 Adapter attivo: {adapter_path or 'nessuno'} ({elapsed * 1000:.1f} ms)")
+            return elapsed
+
+    def activate_group(self, experts):
+        """
+        Attacca insieme gli adapter di più esperti (multi-LoRA).
+
+        experts è una tupla di (model_id, adapter_path): la posizione di ogni
+        esperto è l'indice che lo scheduler passa a set_adapter_rows.
+        Ritorna i secondi spesi nello swap (0 se il gruppo era già attivo).
+        """
+        experts = tuple(experts)
+        with self._lock:
+            self.ensure_base()
+            if experts == self.active_group:
+                return 0.0
+
+            start = time.perf_counter()
+            self._detach()
+            adapters = [
+                self._get_adapter(model_id, adapter_path) if adapter_path else None
+                for model_id, adapter_path in experts
+            ]
+            self.backend.apply_adapters(self.model, [a[:2] if a else None for a in adapters])
+            self._adapter_bytes = sum(a[2] for a in adapters if a)
+            self.active_group = experts
+            elapsed = time.perf_counter() - start
+            label = '+'.join(model_id for model_id, _ in experts)
+            self._record_swap(label, elapsed)
+            print(f"🔁 Adapter attivi insieme: {label} ({elapsed * 1000:.1f} ms)")
+            return elapsed
+
+    def _record_swap(self, model_id, elapsed):
+        self.last_swap_seconds = elapsed
+        self.swap_count += 1
+        self.total_swap_seconds += elapsed
+        metrics.ADAPTER_SWAP.observe(elapsed, model_id)
+
+    def _get_adapter(self, model_id, adapter_path):
+        """Pesi dell'adapter dalla cache, o da disco in caso di miss"""
+        cached = self.adapters.get(model_id)
+        if cached is not None and cached[0] == adapter_path:
+            metrics.CACHE_LOOKUPS.inc('adapter', model_id, 'hit')
+            return cached[1:]
+
+        metrics.CACHE_LOOKUPS.inc('adapter', model_id, 'miss')
+        with metrics.ADAPTER_LOAD.time(model_id):
+            config, weights, nbytes = self.backend.read_adapter(self.models_dir / adapter_path)
+        self.adapters.put(model_id, (adapter_path, config, weights, nbytes), nbytes)
+        return config, weights, nbytes
+
+    def load_draft(self, name):
+        """
+        Carica (una volta) un modello draft per il decoding speculativo.
+
+        Il draft propone i token che il modello principale verifica, quindi
+        deve usare lo stesso vocabolario del modello base.
+        """
+        with self._lock:
+            draft = self.drafts.get(name)
+            if draft is None:
+                self.ensure_base()
+                print(f"🔄 Caricamento modello draft: {name}")
+                start = time.perf_counter()
+                draft, tokenizer = self.backend.load_base(name)
+                if tokenizer.vocab_size != self.tokenizer.vocab_size:
+                    raise ValueError(f"Il modello draft {name} non ha lo stesso vocabolario del modello base")
+                self.drafts[name] = draft
+                print(f"✅ Modello draft pronto ({time.perf_counter() - start:.1f}s)")
+            return draft
+
+    def embed_text(self, text):
+        """
+        Embedding di un testo per la ricerca di domande quasi uguali.
+
+        Non prende il lock del modello, che il worker tiene per ogni passo di
+        decoding: gli embedding di input non dipendono dall'adapter (gli swap
+        toccano solo i layer lineari), quindi la ricerca in cache risponde
+        anche mentre la generazione è in corso.
+        """
+        model, tokenizer = self.model, self.tokenizer
+        if model is None:
+            model, tokenizer = self.ensure_base()
+        tokens = tokenizer.encode(text.strip().lower(), add_special_tokens=False) or [0]
+        with self._embed_lock:
+            return self.backend.embed(model, tokens)
+
+    def invalidate(self, model_id):
+        """Dimentica i pesi in cache di un adapter (es. riaddestrato): verranno riletti da disco"""
+        with self._lock:
+            self.adapters.discard(model_id)
+            if self.active_model_id == model_id:
+                # Il prossimo activate stacca i layer LoRA e applica i pesi nuovi
+                self.active_model_id = None
+            if self.active_group and any(m == model_id for m, _ in self.active_group):
+                self._detach()
+
+    def pin(self, model_id):
+        """Mantiene sempre in cache l'adapter del modello (es. l'esperto di default)"""
+        self.adapters.pin(model_id)
+
+    def _detach(self):
+        """Rimuove i layer LoRA riportando il modello allo stato base"""
+        if self.active_adapter or self.active_group:
+            self.backend.remove_adapter(self.model)
+        self.active_model_id = None
+        self.active_adapter = None
+        self.active_group = None
+        self._adapter_bytes = 0
+
+    def base_bytes(self):
+        """Dimensione in byte dei pesi del modello base"""
+        if self.model is None:
+            return 0
+        return max(0, self.backend.param_bytes(self.model) - self._adapter_bytes)
+
+    def draft_bytes(self):
+        """Dimensione in byte dei pesi dei modelli draft"""
+        return sum(self.backend.param_bytes(draft) for draft in self.drafts.values())
+
+    def stats(self):
+        """Statistiche per /api/health"""
+        avg_swap = self.total_swap_seconds / self.swap_count if self.swap_count else None
+        return {
+            'backend': self.backend.name,
+            'base_model': self.base_model,
+            'base_loaded': self.model is not None,
+            'base_load_seconds': self.base_load_seconds,
+            'active_model': self.active_model_id,
+            'active_adapter': self.active_adapter,
+            'active_group': [model_id for model_id, _ in self.active_group] if self.active_group else None,
+            'swap_count': self.swap_count,
+            'last_swap_ms': round(self.last_swap_seconds * 1000, 2) if self.last_swap_seconds is not None else None,
+            'avg_swap_ms': round(avg_swap * 1000, 2) if avg_swap is not None else None,
+            'draft_models': list(self.drafts),
+            'memory': {
+                'base_weights_mb': _bytes_to_mb(self.base_bytes()),
+                'adapter_weights_mb': _bytes_to_mb(self._adapter_bytes),
+                'draft_weights_mb': _bytes_to_mb(self.draft_bytes()),
+                'accelerator_active_mb': _bytes_to_mb(self.backend.memory_bytes()),
+                'process_peak_rss_mb': _bytes_to_mb(process_rss_bytes())
+            },
+            'adapter_cache': self.adapters.stats()
+        }
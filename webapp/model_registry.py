@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Catalogo dei modelli (models_config.json) in memoria.
+
+Il file viene letto e validato una volta; le richieste leggono uno snapshot
+immutabile del catalogo. Al più ogni `check_interval` secondi si controlla
+l'mtime del file e delle directory/pesi degli adapter: se qualcosa è
+cambiato il catalogo viene ricaricato e sostituito in un colpo solo (le
+richieste in corso continuano con lo snapshot che avevano). Una
+configurazione non valida viene segnalata e il catalogo precedente resta
+in uso.
+"""
+
+import json
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_BASE_MODEL = "mlx-community/Qwen2.5-7B-Instruct-4bit"
+
+
+class ModelConfigError(ValueError):
+    """models_config.json non valido"""
+
+
+def validate_config(config):
+    """Controlla struttura e tipi di models_config.json; solleva ModelConfigError"""
+    if not isinstance(config, dict):
+        raise ModelConfigError("La configurazione deve essere un oggetto JSON")
+    if not isinstance(config.get('base_model'), str) or not config['base_model']:
+        raise ModelConfigError("'base_model' mancante")
+    if not isinstance(config.get('models'), list):
+        raise ModelConfigError("'models' deve essere una lista")
+
+    seen = set()
+    for i, model in enumerate(config['models']):
+        where = f"models[{i}]"
+        if not isinstance(model, dict):
+            raise ModelConfigError(f"{where} deve essere un oggetto")
+        model_id = model.get('id')
+        if not isinstance(model_id, str) or not model_id:
+            raise ModelConfigError(f"{where}: 'id' mancante")
+        if model_id in seen:
+            raise ModelConfigError(f"{where}: id '{model_id}' duplicato")
+        seen.add(model_id)
+        if not isinstance(model.get('name', model_id), str):
+            raise ModelConfigError(f"{where}: 'name' deve essere una stringa")
+        adapter_path = model.get('adapter_path')
+        if adapter_path is not None and (not isinstance(adapter_path, str) or '..' in Path(adapter_path).parts):
+            raise ModelConfigError(f"{where}: 'adapter_path' deve essere una directory dentro models/")
+        if not isinstance(model.get('enabled', True), bool):
+            raise ModelConfigError(f"{where}: 'enabled' deve essere true o false")
+        for key in ('system_prompt', 'draft_model', 'description', 'icon'):
+            if model.get(key) is not None and not isinstance(model[key], str):
+                raise ModelConfigError(f"{where}: '{key}' deve essere una stringa")
+        num_draft = model.get('num_draft_tokens')
+        if num_draft is not None and (not isinstance(num_draft, int) or num_draft < 1):
+            raise ModelConfigError(f"{where}: 'num_draft_tokens' deve essere un intero positivo")
+
+
+class Catalog:
+    """Snapshot immutabile della configurazione: non va modificato"""
+
+    def __init__(self, config, models_dir, signature):
+        self.config = config
+        self.base_model = config['base_model']
+        self.models = config['models']
+        self.signature = signature
+        self.loaded_at = time.time()
+        self._by_id = {m['id']: m for m in self.models}
+        self.available = [
+            m for m in self.models
+            if m.get('enabled', True) and (
+                not m.get('adapter_path') or (Path(models_dir) / m['adapter_path']).exists()
+            )
+        ]
+
+    def get(self, model_id):
+        """Voce del modello (o None)"""
+        return self._by_id.get(model_id)
+
+
+class ModelRegistry:
+    """Catalogo dei modelli con ricaricamento automatico quando i file cambiano"""
+
+    def __init__(self, config_file, models_dir, check_interval=2.0, on_change=None):
+        self.config_file = Path(config_file)
+        self.models_dir = Path(models_dir)
+        self.check_interval = check_interval
+        # Chiamata dopo un ricaricamento con (catalogo vecchio, nuovo, id cambiati)
+        self.on_change = on_change
+        self._catalog = None
+        self._next_check = 0.0
+        self._reload_lock = threading.Lock()
+        self.reloads = 0
+        self.last_error = None
+
+    @property
+    def catalog(self):
+        """Snapshot corrente (ricaricato se i file sono cambiati)"""
+        if self._catalog is None:
+            with self._reload_lock:
+                if self._catalog is None:
+                    self._reload()
+        elif time.monotonic() >= self._next_check:
+            self._check()
+        return self._catalog
+
+    def available(self):
+        """Modelli abilitati con l'adapter presente su disco"""
+        return self.catalog.available
+
+    def get(self, model_id):
+        return self.catalog.get(model_id)
+
+    def _check(self):
+        # Un solo thread controlla; gli altri usano lo snapshot che c'è
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = time.monotonic() + self.check_interval
+            if self._signature(self._catalog.models) != self._catalog.signature:
+                self._reload()
+        finally:
+            self._reload_lock.release()
+
+    def _signature(self, models):
+        """mtime del file di configurazione e di directory e pesi degli adapter"""
+        def stat(path):
+            try:
+                st = path.stat()
+                return st.st_mtime_ns, st.st_size
+            except OSError:
+                return None
+
+        adapters = []
+        for model in models:
+            if model.get('adapter_path'):
+                adapter_dir = self.models_dir / model['adapter_path']
+                adapters.append((model['id'], stat(adapter_dir), stat(adapter_dir / "adapters.safetensors")))
+        return stat(self.config_file), tuple(adapters)
+
+    def _read(self):
+        if not self.config_file.exists():
+            return {"base_model": DEFAULT_BASE_MODEL, "models": []}
+        with open(self.config_file, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        validate_config(config)
+        return config
+
+    def _reload(self):
+        old = self._catalog
+        try:
+            config = self._read()
+            self.last_error = None
+        except (OSError, ValueError) as e:
+            self.last_error = str(e)
+            if old is None:
+                raise
+            print(f"⚠️  models_config.json non valido, resta la configurazione precedente: {e}")
+            # Non si riprova finché il file non cambia di nuovo
+            self._catalog = Catalog(old.config, self.models_dir, self._signature(old.models))
+            return
+
+        catalog = Catalog(config, self.models_dir, self._signature(config['models']))
+        self._catalog = catalog
+        if old is None:
+            return
+
+        self.reloads += 1
+        changed = self._changed_models(old, catalog)
+        print(f"🔄 Catalogo modelli ricaricato ({len(catalog.available)} disponibili"
+              f"{', cambiati: ' + ', '.join(changed) if changed else ''})")
+        if self.on_change is not None:
+            try:
+                self.on_change(old, catalog, changed)
+            except Exception as e:
+                print(f"⚠️  Errore dopo il ricaricamento del catalogo: {e}")
+
+    @staticmethod
+    def _changed_models(old, new):
+        """Modelli con voce o pesi dell'adapter diversi tra i due snapshot"""
+        old_adapters = {entry[0]: entry[1:] for entry in old.signature[1]}
+        new_adapters = {entry[0]: entry[1:] for entry in new.signature[1]}
+        changed = []
+        for model in old.models:
+            model_id = model['id']
+            if new.get(model_id) != model or old_adapters.get(model_id) != new_adapters.get(model_id):
+                changed.append(model_id)
+        return changed
+
+    def stats(self):
+        """Stato del catalogo per /api/health"""
+        catalog = self.catalog
+        return {
+            'models': len(catalog.models),
+            'available': [m['id'] for m in catalog.available],
+            'loaded_at': catalog.loaded_at,
+            'reloads': self.reloads,
+            'last_error': self.last_error
+        }
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Cache delle KV cache per conversazione (riuso del prefisso tra i turni).
+
+A fine generazione la KV cache della conversazione (prompt + risposta)
+viene conservata; al turno successivo il nuovo prompt inizia con lo stesso
+prefisso (system prompt + turni precedenti), quindi si riparte dalla cache
+e si fa il prefill solo del nuovo messaggio utente.
+
+La sessione viene riconosciuta dal prefisso comune dei token, senza bisogno
+di un id lato client. Le voci sono limitate per numero, tempo di inattività
+e memoria totale.
+
+Per ogni esperto con system_prompt si conserva anche uno snapshot fisso
+della KV cache del solo blocco di sistema: ogni nuova conversazione parte
+da una sua copia, quindi il primo turno non paga il prefill del system
+prompt. Gli snapshot non scadono e non vengono mai consumati.
+"""
+
+import threading
+import time
+
+import metrics
+
+
+def common_prefix_length(a, b):
+    """Lunghezza del prefisso comune tra due liste di token"""
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class _Entry:
+    def __init__(self, model_key, tokens, cache, nbytes, pinned=False):
+        self.model_key = model_key
+        self.tokens = tokens
+        self.cache = cache
+        self.pinned = pinned
+        self.nbytes = nbytes
+        self.last_used = time.monotonic()
+
+
+class PromptCache:
+    """Cache LRU di KV cache per conversazione"""
+
+    def __init__(self, backend, max_sessions=16, max_idle_seconds=600, max_bytes=2 * 1024 ** 3, min_reuse_tokens=16):
+        # Il backend sa copiare, accorciare e misurare le proprie KV cache
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.max_idle_seconds = max_idle_seconds
+        self.max_bytes = max_bytes
+        # Sotto questa soglia il riuso non vale la copia della cache
+        self.min_reuse_tokens = min_reuse_tokens
+        self._entries = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+
+    def fetch(self, model_key, tokens):
+        """
+        Cerca la conversazione il cui prefisso coincide con il nuovo prompt.
+
+        Ritorna (cache, n) dove n sono i token già processati, oppure
+        (None, 0). Se il prompt continua tutta la conversazione salvata
+        (il caso normale del turno successivo) la voce esce dalla cache:
+        la sequenza la estenderà e la rimetterà con store(). Se coincide
+        solo una parte, si copia quel prefisso e la voce resta.
+        """
+        with self._lock:
+            self._expire()
+            best, match = None, 0
+            for entry in self._entries:
+                if entry.model_key != model_key:
+                    continue
+                n = common_prefix_length(entry.tokens, tokens)
+                if n > match:
+                    best, match = entry, n
+
+            # Almeno un token va processato per ottenere i logits
+            best_len = min(match, len(tokens) - 1)
+            if best is None or best_len < self.min_reuse_tokens:
+                self.misses += 1
+                metrics.CACHE_LOOKUPS.inc('prompt', model_key[0], 'miss')
+                return None, 0
+
+            if match == len(best.tokens) and not best.pinned:
+                self._entries.remove(best)
+                cache = best.cache
+                self.backend.trim_cache(cache, len(best.tokens) - best_len)
+            else:
+                best.last_used = time.monotonic()
+                cache = self.backend.copy_cache_prefix(best.cache, best_len)
+            self.hits += 1
+            self.reused_tokens += best_len
+            metrics.CACHE_LOOKUPS.inc('prompt', model_key[0], 'hit')
+            return cache, best_len
+
+    def store(self, model_key, tokens, cache):
+        """Conserva la KV cache di una conversazione appena terminata"""
+        entry = _Entry(model_key, list(tokens), cache, self.backend.cache_nbytes(cache))
+        with self._lock:
+            # Una conversazione che estende una voce esistente la sostituisce
+            self._entries = [
+                e for e in self._entries
+                if e.pinned or not (
+                    e.model_key == model_key and common_prefix_length(e.tokens, entry.tokens) == len(e.tokens)
+                )
+            ]
+            self._entries.append(entry)
+            self._expire()
+            self._evict()
+
+    def has_snapshot(self, model_key, tokens):
+        """True se esiste già lo snapshot del system prompt indicato"""
+        with self._lock:
+            return any(e.pinned and e.model_key == model_key and e.tokens == tokens for e in self._entries)
+
+    def store_snapshot(self, model_key, tokens, cache):
+        """Salva lo snapshot del system prompt di un esperto (sostituisce il precedente)"""
+        entry = _Entry(model_key, list(tokens), cache, self.backend.cache_nbytes(cache), pinned=True)
+        with self._lock:
+            self._entries = [e for e in self._entries if not (e.pinned and e.model_key == model_key)]
+            self._entries.append(entry)
+
+    def _expire(self):
+        now = time.monotonic()
+        alive = [e for e in self._entries if e.pinned or now - e.last_used <= self.max_idle_seconds]
+        self.evictions += len(self._entries) - len(alive)
+        self._entries = alive
+
+    def _evict(self):
+        # _entries è in ordine di inserimento: i primi sono i meno recenti
+        while True:
+            sessions = [e for e in self._entries if not e.pinned]
+            if not sessions or (
+                len(sessions) <= self.max_sessions
+                and sum(e.nbytes for e in sessions) <= self.max_bytes
+            ):
+                break
+            self._entries.remove(sessions[0])
+            self.evictions += 1
+
+    def clear(self, model_key=None):
+        """Svuota la cache (o solo le voci di un modello)"""
+        with self._lock:
+            self._entries = [e for e in self._entries if model_key is not None and e.model_key != model_key]
+
+    def stats(self):
+        """Statistiche per /api/health"""
+        with self._lock:
+            return {
+                'sessions': sum(1 for e in self._entries if not e.pinned),
+                'snapshots': sorted(e.model_key[0] for e in self._entries if e.pinned),
+                'used_mb': round(sum(e.nbytes for e in self._entries) / (1024 * 1024), 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'reused_tokens': self.reused_tokens
+            }
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Costruzione del prompt direttamente in token, con budget di contesto.
+
+Il prompt è diviso in segmenti indipendenti: intestazione (system prompt),
+un segmento per ogni turno dello storico e la domanda corrente. Ogni
+segmento viene tokenizzato una volta sola e i suoi token restano in cache
+(per hash del contenuto), quindi ad ogni richiesta si tokenizza solo il
+messaggio nuovo.
+
+Il markup dei ruoli viene ricavato dal chat template del tokenizer, così
+funzionano anche modelli base diversi da Qwen; se il tokenizer non ha un
+template si usa il formato ChatML.
+
+Lo storico arriva intero dal browser (localStorage) ad ogni richiesta:
+si tengono il system prompt più i turni più recenti che stanno nel budget
+di contesto, lasciando spazio ai max_tokens della risposta.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Contenuti segnaposto per ricavare il markup dal chat template
+_PROBE = {
+    'system': 'JARVISPROBESYSTEM',
+    'user': 'JARVISPROBEUSERONE',
+    'assistant': 'JARVISPROBEASSISTANT',
+    'question': 'JARVISPROBEUSERTWO'
+}
+
+
+class ChatTemplate:
+    """
+    Markup dei ruoli, diviso in modo che ogni segmento finisca dove
+    inizia il contenuto utente successivo:
+
+        intestazione = system_prefix + S + system_to_user   (o start_to_user)
+        turno        = U + user_to_assistant + A + assistant_to_user
+        domanda      = M + generation_tail
+    """
+
+    def __init__(self, system_prefix, system_to_user, start_to_user,
+                 user_to_assistant, assistant_to_user, generation_tail, segmented=True):
+        self.system_prefix = system_prefix
+        self.system_to_user = system_to_user
+        self.start_to_user = start_to_user
+        self.user_to_assistant = user_to_assistant
+        self.assistant_to_user = assistant_to_user
+        self.generation_tail = generation_tail
+        # False se la tokenizzazione per segmenti non coincide con quella intera
+        self.segmented = segmented
+
+    @classmethod
+    def chatml(cls):
+        """Formato ChatML (Qwen), usato se il tokenizer non ha un chat template"""
+        return cls(
+            system_prefix="<|im_start|>system\n",
+            system_to_user="<|im_end|>\n<|im_start|>user\n",
+            start_to_user="<|im_start|>user\n",
+            user_to_assistant="<|im_end|>\n<|im_start|>assistant\n",
+            assistant_to_user="<|im_end|>\n<|im_start|>user\n",
+            generation_tail="<|im_end|>\n<|im_start|>assistant\n"
+        )
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer):
+        """Ricava il markup dal chat template del tokenizer (o ChatML)"""
+        if not getattr(tokenizer, 'chat_template', None):
+            return cls.chatml()
+
+        try:
+            with_system = _render(tokenizer, [
+                {'role': 'system', 'content': _PROBE['system']},
+                {'role': 'user', 'content': _PROBE['user']},
+                {'role': 'assistant', 'content': _PROBE['assistant']},
+                {'role': 'user', 'content': _PROBE['question']}
+            ])
+            without_system = _render(tokenizer, [
+                {'role': 'user', 'content': _PROBE['user']},
+                {'role': 'assistant', 'content': _PROBE['assistant']},
+                {'role': 'user', 'content': _PROBE['question']}
+            ])
+            s = _split(with_system, ['system', 'user', 'assistant', 'question'])
+            n = _split(without_system, ['user', 'assistant', 'question'])
+        except Exception as e:
+            print(f"⚠️  Chat template non utilizzabile ({e}), uso ChatML")
+            return cls.chatml()
+
+        template = cls(
+            system_prefix=s[0],
+            system_to_user=s[1],
+            start_to_user=n[0],
+            user_to_assistant=s[2],
+            assistant_to_user=s[3],
+            generation_tail=s[4]
+        )
+
+        # La divisione in segmenti deve ricostruire esattamente il template...
+        history = [{'user': _PROBE['user'], 'assistant': _PROBE['assistant']}]
+        if (template.render(_PROBE['question'], history, _PROBE['system']) != with_system
+                or template.render(_PROBE['question'], history, None) != without_system):
+            print("⚠️  Chat template non scomponibile per turni, uso ChatML")
+            return cls.chatml()
+
+        # ...e tokenizzare i segmenti separatamente deve dare gli stessi token
+        segments = template.segments(_PROBE['question'], history, _PROBE['system'])
+        joined = [t for seg in segments for t in _encode(tokenizer, seg)]
+        template.segmented = joined == _encode(tokenizer, with_system)
+        return template
+
+    def header(self, system_prompt):
+        """Intestazione fissa della conversazione"""
+        if system_prompt:
+            return self.system_prefix + system_prompt + self.system_to_user
+        return self.start_to_user
+
+    def turn(self, user, assistant):
+        return user + self.user_to_assistant + assistant + self.assistant_to_user
+
+    def question(self, message):
+        return message + self.generation_tail
+
+    def segments(self, message, history, system_prompt):
+        """Testo del prompt diviso in segmenti tokenizzabili separatamente"""
+        parts = [self.header(system_prompt)]
+        for entry in history or []:
+            parts.append(self.turn(entry['user'], entry['assistant']))
+        parts.append(self.question(message))
+        return parts
+
+    def render(self, message, history, system_prompt):
+        """Prompt completo come testo"""
+        return ''.join(self.segments(message, history, system_prompt))
+
+
+def _render(tokenizer, messages):
+    return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+
+def _split(text, roles):
+    """Divide il testo renderizzato attorno ai contenuti segnaposto"""
+    pieces = []
+    pos = 0
+    for role in roles:
+        probe = _PROBE[role]
+        idx = text.index(probe, pos)
+        pieces.append(text[pos:idx])
+        pos = idx + len(probe)
+    pieces.append(text[pos:])
+    return pieces
+
+
+def _encode(tokenizer, text):
+    return list(tokenizer.encode(text, add_special_tokens=False))
+
+
+class PromptBuilder:
+    """Costruisce i token del prompt riusando i token già calcolati per ogni segmento"""
+
+    def __init__(self, tokenizer, max_cached_segments=4096):
+        self.tokenizer = tokenizer
+        self.template = ChatTemplate.from_tokenizer(tokenizer)
+        self.max_cached_segments = max_cached_segments
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode_segment(self, text):
+        """Token di un segmento, calcolati una volta e poi in cache"""
+        key = hashlib.sha1(text.encode('utf-8')).digest()
+        with self._lock:
+            ids = self._ids.get(key)
+            if ids is not None:
+                self._ids.move_to_end(key)
+                self.hits += 1
+                return ids
+
+        ids = _encode(self.tokenizer, text)
+        with self._lock:
+            self.misses += 1
+            self._ids[key] = ids
+            while len(self._ids) > self.max_cached_segments:
+                self._ids.popitem(last=False)
+        return ids
+
+    def header_tokens(self, system_prompt):
+        """Prefisso fisso di ogni conversazione sull'esperto"""
+        return self.encode_segment(self.template.header(system_prompt))
+
+    def turn_tokens(self, entry):
+        return self.encode_segment(self.template.turn(entry['user'], entry['assistant']))
+
+    def question_tokens(self, message):
+        return self.encode_segment(self.template.question(message))
+
+    def build(self, message, history, system_prompt):
+        """Token del prompt completo"""
+        if not self.template.segmented:
+            # Template che non si presta alla divisione: una sola tokenizzazione
+            return _encode(self.tokenizer, self.template.render(message, history, system_prompt))
+
+        ids = list(self.header_tokens(system_prompt))
+        for entry in history or []:
+            ids.extend(self.turn_tokens(entry))
+        ids.extend(self.question_tokens(message))
+        return ids
+
+    def stats(self):
+        with self._lock:
+            return {
+                'segmented': self.template.segmented,
+                'cached_segments': len(self._ids),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class ContextTooLongError(ValueError):
+    """Il messaggio (con il system prompt) non entra nel contesto"""
+
+
+def valid_max_tokens(value):
+    """max_tokens arriva dal JSON del client: solo interi positivi (non bool)"""
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+class ContextWindow:
+    """Tronca lo storico ai turni più recenti che stanno nel budget di token"""
+
+    def __init__(self, max_context_tokens=1536):
+        self.max_context_tokens = max_context_tokens
+
+    def fit(self, builder, message, history, system_prompt, max_tokens):
+        """
+        Sceglie i turni dello storico da tenere e costruisce il prompt.
+
+        Ritorna (token_del_prompt, turni_scartati, max_tokens) dove
+        max_tokens viene ridotto se il prompt minimo non lascia abbastanza
+        spazio alla risposta.
+        """
+        if not valid_max_tokens(max_tokens):
+            raise ValueError(f"max_tokens deve essere un intero positivo, ricevuto {max_tokens!r}")
+        history = history or []
+        required = len(builder.header_tokens(system_prompt)) + len(builder.question_tokens(message))
+
+        available = self.max_context_tokens - required
+        if available <= 0:
+            raise ContextTooLongError(
+                f"Messaggio troppo lungo: {required} token, contesto massimo {self.max_context_tokens}"
+            )
+        max_tokens = min(max_tokens, available)
+
+        # Dal turno più recente all'indietro finché c'è spazio
+        budget = available - max_tokens
+        kept = 0
+        for entry in reversed(history):
+            cost = len(builder.turn_tokens(entry))
+            if cost > budget:
+                break
+            budget -= cost
+            kept += 1
+
+        kept_history = history[len(history) - kept:] if kept else []
+        prompt_tokens = builder.build(message, kept_history, system_prompt)
+        return prompt_tokens, len(history) - kept, max_tokens
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Cache delle risposte complete, persistente su disco (SQLite).
+
+Le stesse domande arrivano agli esperti più e più volte: una risposta già
+generata per lo stesso modello, adapter, prompt normalizzato e parametri di
+campionamento viene restituita in pochi millisecondi invece di rifare la
+generazione. La cache sopravvive ai riavvii, le voci scadono dopo un TTL e
+le meno usate vengono eliminate oltre il limite di voci o di dimensione.
+
+Per le richieste greedy (temperature 0) senza storico si può abilitare
+anche la ricerca per similarità: l'embedding della domanda viene confrontato
+con quelli delle domande già in cache sullo stesso esperto. numpy serve
+solo per questa ricerca e viene importato solo se è abilitata.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from pathlib import Path
+
+
+def normalize_text(text):
+    """Normalizza un testo per la chiave: Unicode NFC, a capo e spazi ai bordi"""
+    text = unicodedata.normalize('NFC', text or '').replace('\r\n', '\n')
+    return '\n'.join(line.rstrip() for line in text.strip().split('\n'))
+
+
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+def adapter_fingerprint(models_dir, adapter_path):
+    """
+    Hash dei pesi dell'adapter: un adapter riaddestrato invalida le risposte.
+
+    Il contenuto viene letto solo quando cambiano dimensione o mtime del file.
+    """
+    if not adapter_path:
+        return None
+    weights = Path(models_dir) / adapter_path / "adapters.safetensors"
+    try:
+        st = weights.stat()
+    except OSError:
+        return None
+
+    signature = (st.st_size, st.st_mtime_ns)
+    with _fingerprints_lock:
+        cached = _fingerprints.get(weights)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+    digest = hashlib.sha256()
+    with open(weights, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    fingerprint = digest.hexdigest()
+    with _fingerprints_lock:
+        _fingerprints[weights] = (signature, fingerprint)
+    return fingerprint
+
+
+def replay_chunks(response):
+    """Divide una risposta in cache in segmenti (parola + spazi) per lo streaming SSE"""
+    return re.findall(r'\s*\S+\s*', response) or [response]
+
+
+def _digest(payload):
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Cache chiave -> risposta su SQLite con TTL, limiti e ricerca per similarità"""
+
+    def __init__(self, path, ttl_seconds=7 * 24 * 3600, max_entries=5000,
+                 max_bytes=64 * 1024 * 1024, similarity=None):
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Soglia di similarità coseno (None = ricerca semantica disattivata)
+        self.similarity = similarity
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(self.path.parent, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                scope TEXT NOT NULL,
+                model_id TEXT NOT NULL,
+                response TEXT NOT NULL,
+                stats TEXT,
+                embedding BLOB,
+                nbytes INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_scope ON responses (scope)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._db.commit()
+
+    @staticmethod
+    def make_keys(model_id, base_model, adapter_hash, system_prompt, message, history, max_tokens, temperature):
+        """
+        Ritorna (key, scope).
+
+        scope identifica tutto tranne la domanda (esperto, adapter, system
+        prompt, storico, parametri): la ricerca per similarità confronta
+        solo domande con lo stesso scope.
+        """
+        scope = _digest({
+            'model_id': model_id,
+            'base_model': base_model,
+            'adapter': adapter_hash,
+            'system_prompt': normalize_text(system_prompt),
+            'history': [
+                [normalize_text(turn.get('user')), normalize_text(turn.get('assistant'))]
+                for turn in history or []
+            ],
+            'max_tokens': max_tokens,
+            'temperature': temperature
+        })
+        key = _digest({'scope': scope, 'message': normalize_text(message)})
+        return key, scope
+
+    def get(self, key):
+        """Risposta in cache per la chiave esatta (o None)"""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response, stats, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[2] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+        return {'response': row[0], 'stats': json.loads(row[1]) if row[1] else {}}
+
+    def find_similar(self, scope, embedding):
+        """Risposta della domanda più simile nello stesso scope, se sopra soglia"""
+        if self.similarity is None or embedding is None:
+            return None
+        import numpy as np
+
+        query = np.asarray(embedding, dtype=np.float32)
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, response, stats, embedding FROM responses "
+                "WHERE scope = ? AND embedding IS NOT NULL AND created >= ?",
+                (scope, now - self.ttl_seconds)
+            ).fetchall()
+            if not rows:
+                return None
+
+            matrix = np.stack([np.frombuffer(r[3], dtype=np.float32) for r in rows])
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity:
+                return None
+            key, response, stats = rows[best][:3]
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.semantic_hits += 1
+        return {
+            'response': response,
+            'stats': json.loads(stats) if stats else {},
+            'similarity': round(float(scores[best]), 4)
+        }
+
+    def put(self, key, scope, model_id, response, stats=None, embedding=None):
+        """Salva una risposta e applica TTL e limiti"""
+        now = time.time()
+        # float32 come in find_similar
+        blob = array('f', embedding).tobytes() if embedding is not None else None
+        nbytes = len(response.encode('utf-8')) + (len(blob) if blob else 0)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, scope, model_id, response, stats, embedding, nbytes, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, scope, model_id, response, json.dumps(stats) if stats else None, blob, nbytes, now, now)
+            )
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        expired = self._db.execute(
+            "DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,)
+        ).rowcount
+        self.evictions += expired
+
+        count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+
+        # Dalla meno recentemente usata finché si rientra nei limiti
+        victims = []
+        for key, nbytes in self._db.execute("SELECT key, nbytes FROM responses ORDER BY last_used"):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            victims.append((key,))
+            count -= 1
+            total -= nbytes
+        self._db.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self.evictions += len(victims)
+
+    def clear(self, model_id=None):
+        """Svuota la cache (o solo le risposte di un modello)"""
+        with self._lock:
+            if model_id is None:
+                self._db.execute("DELETE FROM responses")
+            else:
+                self._db.execute("DELETE FROM responses WHERE model_id = ?", (model_id,))
+            self._db.commit()
+
+    def stats(self):
+        """Statistiche per /api/health"""
+        with self._lock:
+            count, total = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM responses"
+            ).fetchone()
+            return {
+                'entries': count,
+                'used_mb': round(total / (1024 * 1024), 2),
+                'hits': self.hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'semantic': self.similarity is not None
+            }
@@ -0,0 +1,724 @@
+#!/usr/bin/env python3
+"""
+Scheduler di inferenza a batching continuo.
+
+Un solo worker in background possiede il modello: le richieste HTTP mettono
+in coda una GenerationRequest e leggono i token man mano che arrivano.
+Ad ogni passo il worker ammette nuove richieste (prefill) e fa avanzare di
+un token tutte le conversazioni attive dello stesso esperto con un unico
+forward pass batch, così il throughput cresce con gli utenti concorrenti.
+
+La stessa domanda a più esperti (submit_group) diventa un unico batch
+multi-LoRA: il modello base condiviso ha gli adapter di tutti gli esperti
+attaccati insieme e ogni riga del batch usa il proprio, così le risposte
+avanzano tutte nello stesso forward pass invece che a turno.
+
+Gli esperti con un modello draft (draft_model in models_config.json) usano
+invece il decoding speculativo: il draft propone alcuni token e il modello
+principale li verifica in un solo forward pass. Ogni conversazione accetta
+un numero diverso di token per passo, quindi queste sequenze hanno ciascuna
+la propria KV cache invece della cache batch.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+import metrics
+from generation import GenerationStats, IncrementalDetokenizer, accepted_prefix, stop_token_ids
+
+
+class GenerationRequest:
+    """Richiesta di generazione: il worker produce i token in una coda"""
+
+    def __init__(self, model_id, adapter_path, prompt_tokens, max_tokens, temperature,
+                 draft_model=None, num_draft_tokens=3, on_done=None):
+        self.model_id = model_id
+        self.adapter_path = adapter_path
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.stats = GenerationStats(len(prompt_tokens))
+        self.submitted_at = time.perf_counter()
+        self.cancelled = False
+        # Chiamata una volta a fine richiesta (es. rilascio del ModelHandle)
+        self.on_done = on_done
+        # Solo richieste di un gruppo multi-esperto: esperti del batch e indice del proprio adapter
+        self.group = None
+        self.adapter_row = None
+        self._events = queue.Queue()
+        # Event loop del consumatore asincrono (modalità ASGI), se presente
+        self._loop = None
+        self._wakeup = None
+
+    def _emit(self, kind, value=None):
+        if kind != 'token':
+            self._done()
+        self._events.put((kind, value))
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                # Event loop già chiuso: nessuno sta più leggendo
+                pass
+
+    def _done(self):
+        on_done, self.on_done = self.on_done, None
+        if on_done is not None:
+            on_done()
+
+    def cancel(self):
+        """Chiede al worker di liberare lo slot (es. client disconnesso)"""
+        self.cancelled = True
+
+    def stream(self, tokenizer):
+        """Produce i segmenti di testo appena il worker genera i token"""
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        try:
+            while True:
+                kind, value = self._events.get()
+                if kind == 'token':
+                    text = detokenizer.add_token(value)
+                    if text:
+                        yield text
+                elif kind == 'error':
+                    raise RuntimeError(value)
+                else:
+                    break
+
+            tail = detokenizer.finalize()
+            if tail:
+                yield tail
+        finally:
+            self.cancel()
+
+    def text(self, tokenizer):
+        """Attende la fine della generazione e ritorna la risposta completa"""
+        return ''.join(self.stream(tokenizer))
+
+    async def astream(self, tokenizer):
+        """
+        Come stream(), ma per un event loop asyncio.
+
+        L'attesa dei token non occupa un thread: il worker sveglia l'event
+        loop ad ogni evento.
+        """
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        try:
+            while True:
+                try:
+                    kind, value = self._events.get_nowait()
+                except queue.Empty:
+                    self._wakeup.clear()
+                    if self._events.empty():
+                        await self._wakeup.wait()
+                    continue
+
+                if kind == 'token':
+                    text = detokenizer.add_token(value)
+                    if text:
+                        yield text
+                elif kind == 'error':
+                    raise RuntimeError(value)
+                else:
+                    break
+
+            tail = detokenizer.finalize()
+            if tail:
+                yield tail
+        finally:
+            self.cancel()
+
+    async def atext(self, tokenizer):
+        """Versione asincrona di text()"""
+        return ''.join([text async for text in self.astream(tokenizer)])
+
+
+class _GroupEvents:
+    """Coda di una richiesta del gruppo: gli eventi finiscono nella coda comune con l'indice"""
+
+    def __init__(self, events, index):
+        self._events = events
+        self._index = index
+
+    def put(self, item):
+        self._events.put((self._index,) + item)
+
+
+class GenerationGroup:
+    """
+    Stessa domanda a più esperti: le richieste vengono lette insieme.
+
+    stream() e astream() producono (indice, tipo, valore) nell'ordine in cui
+    il worker genera i token: ('token', testo), poi ('done', motivo) oppure
+    ('error', messaggio) per ogni richiesta.
+    """
+
+    def __init__(self, requests):
+        self.requests = requests
+        self._events = queue.Queue()
+        for index, request in enumerate(requests):
+            request._events = _GroupEvents(self._events, index)
+
+    def cancel(self):
+        for request in self.requests:
+            request.cancel()
+
+    def _handle(self, detokenizers, index, kind, value):
+        detokenizer = detokenizers[index]
+        if kind == 'token':
+            text = detokenizer.add_token(value)
+            return [(index, 'token', text)] if text else []
+        if kind == 'error':
+            return [(index, 'error', value)]
+        tail = detokenizer.finalize()
+        return ([(index, 'token', tail)] if tail else []) + [(index, 'done', value)]
+
+    def stream(self, tokenizer):
+        """Eventi di tutte le richieste man mano che arrivano"""
+        detokenizers = [IncrementalDetokenizer(tokenizer) for _ in self.requests]
+        running = len(self.requests)
+        try:
+            while running:
+                index, kind, value = self._events.get()
+                if kind != 'token':
+                    running -= 1
+                yield from self._handle(detokenizers, index, kind, value)
+        finally:
+            self.cancel()
+
+    async def astream(self, tokenizer):
+        """Come stream(), ma per un event loop asyncio"""
+        wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for request in self.requests:
+            request._wakeup = wakeup
+            request._loop = loop
+        detokenizers = [IncrementalDetokenizer(tokenizer) for _ in self.requests]
+        running = len(self.requests)
+        try:
+            while running:
+                try:
+                    index, kind, value = self._events.get_nowait()
+                except queue.Empty:
+                    wakeup.clear()
+                    if self._events.empty():
+                        await wakeup.wait()
+                    continue
+
+                if kind != 'token':
+                    running -= 1
+                for event in self._handle(detokenizers, index, kind, value):
+                    yield event
+        finally:
+            self.cancel()
+
+
+class _SnapshotJob:
+    """Calcolo della KV cache del system prompt di un esperto"""
+
+    def __init__(self, model_id, adapter_path, system_tokens):
+        self.model_id = model_id
+        self.adapter_path = adapter_path
+        self.system_tokens = system_tokens
+
+
+class _Sequence:
+    """Stato di una conversazione attiva nel batch di decoding"""
+
+    def __init__(self, request):
+        self.request = request
+        self.last_token = None
+        self.generated = 0
+        # Token già presenti nella KV cache (prompt + token generati e processati)
+        self.tokens = list(request.prompt_tokens)
+        # Solo decoding speculativo: KV cache proprie del modello e del draft
+        self.cache = None
+        self.draft_cache = None
+
+
+class _Cohort:
+    """
+    Richieste dello stesso esperto: condividono adapter e cache batch.
+
+    Una coorte di gruppo (experts) ha invece più adapter attivi insieme, uno
+    per riga; model_id è solo un'etichetta con gli id degli esperti.
+    """
+
+    def __init__(self, model_id, adapter_path, draft_model=None, num_draft_tokens=3, experts=None):
+        self.model_id = model_id
+        self.adapter_path = adapter_path
+        self.experts = experts
+        self.key = ('group', experts) if experts else (model_id, adapter_path)
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.pending = deque()
+        self.sequences = []
+        self.cache = None
+        # Tempo di worker ricevuto (virtuale): lo scheduler serve per primo chi ne ha avuto meno
+        self.service = 0.0
+
+    def has_work(self):
+        return bool(self.pending or self.sequences)
+
+
+class InferenceScheduler:
+    """Worker unico con coda di richieste e batching continuo del decoding"""
+
+    def __init__(self, manager, max_batch_size=8, prefill_step_size=512, cohort_quantum=16, prompt_cache=None):
+        self.manager = manager
+        self.backend = manager.backend
+        self.prompt_cache = prompt_cache
+        self.max_batch_size = max_batch_size
+        self.prefill_step_size = prefill_step_size
+        # Passi consecutivi concessi a un esperto prima di passare al successivo:
+        # ammortizza il costo dello swap dell'adapter; tra un quanto e l'altro
+        # tocca all'esperto che ha ricevuto meno tempo di worker
+        self.cohort_quantum = cohort_quantum
+        self._queue = queue.Queue()
+        self._cohorts = OrderedDict()
+        self._current = None
+        self._quantum_left = 0
+        self._stop_tokens = None
+        self._snapshot_keys = set()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+        self.decode_steps = 0
+        self.decoded_rows = 0
+        self.generated_tokens = 0
+        self.busy_seconds = 0.0
+        self.speculative_steps = 0
+        self.speculative_tokens = 0
+        self.speculative_seconds = 0.0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+
+    def start(self):
+        """Avvia il worker (una sola volta)"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='inference-worker', daemon=True)
+                self._thread.start()
+
+    def submit(self, model_id, adapter_path, prompt_tokens, max_tokens=500, temperature=0.7,
+               draft_model=None, num_draft_tokens=3, on_done=None):
+        """
+        Mette in coda una richiesta e la ritorna subito.
+
+        on_done viene chiamata una volta quando la richiesta termina, per
+        qualunque motivo (fine, errore, cancellazione).
+        """
+        self.start()
+        request = GenerationRequest(
+            model_id, adapter_path, prompt_tokens, max_tokens, temperature,
+            draft_model=draft_model, num_draft_tokens=num_draft_tokens, on_done=on_done
+        )
+        self._queue.put(request)
+        return request
+
+    def submit_group(self, experts, prompts, max_tokens, temperature=0.7, on_done=None):
+        """
+        Stessa domanda a più esperti in un unico batch multi-LoRA.
+
+        experts è la lista di (model_id, adapter_path); prompts, max_tokens e
+        on_done hanno un elemento per esperto. Ritorna un GenerationGroup.
+        Gli esperti del gruppo non usano il decoding speculativo.
+        """
+        self.start()
+        group = tuple(experts)
+        on_done = on_done or [None] * len(group)
+        requests = []
+        for row, ((model_id, adapter_path), prompt_tokens, limit, callback) in enumerate(
+                zip(group, prompts, max_tokens, on_done)):
+            request = GenerationRequest(model_id, adapter_path, prompt_tokens, limit, temperature, on_done=callback)
+            request.group = group
+            request.adapter_row = row
+            requests.append(request)
+        # Eventi già collegati alla coda comune prima che il worker li veda
+        generation = GenerationGroup(requests)
+        for request in requests:
+            self._queue.put(request)
+        return generation
+
+    def precompute_system_prompt(self, model_id, adapter_path, system_tokens):
+        """
+        Chiede al worker lo snapshot della KV cache del system prompt.
+
+        Le nuove conversazioni sull'esperto partono da una copia dello
+        snapshot invece di rifare il prefill del blocco di sistema.
+        """
+        if self.prompt_cache is None or len(system_tokens) < 2:
+            return
+        key = (model_id, adapter_path, tuple(system_tokens))
+        if key in self._snapshot_keys:
+            return
+        self._snapshot_keys.add(key)
+        self.start()
+        self._queue.put(_SnapshotJob(model_id, adapter_path, list(system_tokens)))
+
+    def forget_snapshots(self, model_id):
+        """Permette di ricalcolare gli snapshot di un esperto (es. adapter riaddestrato)"""
+        self._snapshot_keys = {key for key in self._snapshot_keys if key[0] != model_id}
+
+    # --- Worker ---
+
+    def _run(self):
+        while True:
+            self._admit(block=not any(c.has_work() for c in self._cohorts.values()))
+            cohort = self._next_cohort()
+            if cohort is None:
+                continue
+
+            start = time.perf_counter()
+            try:
+                with self.manager.lock:
+                    if cohort.experts:
+                        self.manager.activate_group(cohort.experts)
+                    else:
+                        self.manager.activate(cohort.model_id, cohort.adapter_path)
+                    if self._stop_tokens is None:
+                        self._stop_tokens = stop_token_ids(self.manager.tokenizer)
+                    self._step(cohort)
+            except Exception as e:
+                print(f"❌ Errore nello scheduler ({cohort.model_id}): {e}")
+                self._fail(cohort, e)
+            elapsed = time.perf_counter() - start
+            cohort.service += elapsed
+            self.busy_seconds += elapsed
+            if cohort.draft_model:
+                self.speculative_seconds += elapsed
+
+            if not cohort.has_work():
+                self._cohorts.pop(cohort.key, None)
+
+    def _admit(self, block):
+        """Sposta le richieste dalla coda condivisa alle coorti per esperto"""
+        try:
+            request = self._queue.get() if block else self._queue.get_nowait()
+        except queue.Empty:
+            return
+
+        while request is not None:
+            if isinstance(request, _SnapshotJob):
+                self._run_snapshot(request)
+                request = self._next_queued()
+                continue
+
+            if request.group:
+                key = ('group', request.group)
+            else:
+                key = (request.model_id, request.adapter_path)
+            cohort = self._cohorts.get(key)
+            if cohort is None:
+                if request.group:
+                    label = '+'.join(model_id for model_id, _ in request.group)
+                    cohort = _Cohort(label, None, experts=request.group)
+                else:
+                    cohort = _Cohort(
+                        request.model_id, request.adapter_path,
+                        draft_model=request.draft_model, num_draft_tokens=request.num_draft_tokens
+                    )
+                # Parte alla pari con gli esperti attivi: né precedenza né attesa
+                active = [c.service for c in self._cohorts.values() if c.has_work()]
+                cohort.service = min(active) if active else 0.0
+                self._cohorts[key] = cohort
+            cohort.pending.append(request)
+            request = self._next_queued()
+
+    def _next_queued(self):
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _run_snapshot(self, job):
+        """Prefill del solo system prompt con l'adapter dell'esperto attivo"""
+        model_key = (job.model_id, job.adapter_path)
+        if self.prompt_cache.has_snapshot(model_key, job.system_tokens):
+            return
+        try:
+            with self.manager.lock:
+                self.manager.activate(job.model_id, job.adapter_path)
+                start = time.perf_counter()
+                _, cache = self.backend.prefill(self.manager.model, job.system_tokens, self.prefill_step_size)
+                self.backend.eval_cache(cache)
+            self.prompt_cache.store_snapshot(model_key, job.system_tokens, cache)
+            print(
+                f"📌 Snapshot system prompt pronto: {job.model_id} "
+                f"({len(job.system_tokens)} token, {(time.perf_counter() - start) * 1000:.0f} ms)"
+            )
+        except Exception as e:
+            print(f"⚠️  Snapshot system prompt fallito ({job.model_id}): {e}")
+            self._snapshot_keys.discard((job.model_id, job.adapter_path, tuple(job.system_tokens)))
+
+    def _next_cohort(self):
+        """Esperto da servire: a quanti di passi, poi chi ha avuto meno tempo di worker"""
+        current = self._cohorts.get(self._current)
+        if current is not None and current.has_work() and self._quantum_left > 0:
+            self._quantum_left -= 1
+            return current
+
+        candidates = [key for key, c in self._cohorts.items() if c.has_work()]
+        if not candidates:
+            return None
+        # A parità di tempo ricevuto passa un altro esperto
+        key = min(candidates, key=lambda k: (self._cohorts[k].service, k == self._current))
+
+        self._current = key
+        self._quantum_left = self.cohort_quantum - 1
+        return self._cohorts[key]
+
+    def _step(self, cohort):
+        """Ammette al più una richiesta e avanza di un token tutto il batch"""
+        self._drop_cancelled(cohort)
+
+        if cohort.pending and len(cohort.sequences) < self.max_batch_size:
+            request = cohort.pending.popleft()
+            if not request.cancelled:
+                try:
+                    self._prefill(cohort, request)
+                except Exception:
+                    # Errore sul batch (extend_batch): se la richiesta non è entrata
+                    # torna in coda, così _fail le manda l'errore come alle altre
+                    if all(s.request is not request for s in cohort.sequences):
+                        cohort.pending.appendleft(request)
+                    raise
+            else:
+                self._finish(request, 'cancelled')
+
+        if not cohort.sequences:
+            return
+        if cohort.draft_model:
+            self._speculate(cohort)
+        else:
+            self._decode(cohort)
+
+    def _prefill(self, cohort, request):
+        request.stats.queue_wait = time.perf_counter() - request.submitted_at
+        prefill_start = time.perf_counter()
+
+        # Riparte dalla KV cache della conversazione, se c'è: prefill solo del nuovo turno.
+        # Le chiavi sono per esperto: nei gruppi ogni riga ha il proprio adapter
+        cache, reused = None, 0
+        if self.prompt_cache is not None:
+            cache, reused = self.prompt_cache.fetch((request.model_id, request.adapter_path), request.prompt_tokens)
+        request.stats.cached_tokens = reused
+
+        # Un errore qui riguarda solo questa richiesta: il batch non è ancora
+        # stato toccato e le altre sequenze continuano
+        try:
+            self._route_rows(cohort, [request])
+            logits, cache = self.backend.prefill(
+                self.manager.model,
+                request.prompt_tokens[reused:],
+                self.prefill_step_size,
+                cache=cache
+            )
+            token = self.backend.sample(logits, [request.temperature])[0]
+            sequence = _Sequence(request)
+
+            if cohort.draft_model:
+                # Il draft è piccolo: prefill dell'intero prompt, senza prompt cache
+                sequence.cache = cache
+                _, sequence.draft_cache = self.backend.prefill(
+                    self.manager.load_draft(cohort.draft_model),
+                    request.prompt_tokens,
+                    self.prefill_step_size
+                )
+            else:
+                row_cache = self.backend.merge_caches([cache])
+        except Exception as e:
+            print(f"❌ Prefill fallito ({request.model_id}): {e}")
+            request._emit('error', str(e))
+            return
+
+        if not cohort.draft_model:
+            if cohort.cache is None:
+                cohort.cache = row_cache
+            else:
+                self.backend.extend_batch(cohort.cache, row_cache)
+        request.stats.prefill_time = time.perf_counter() - prefill_start
+        cohort.sequences.append(sequence)
+
+        metrics.QUEUE_WAIT.observe(request.stats.queue_wait, request.model_id)
+        metrics.PREFILL.observe(request.stats.prefill_time, request.model_id)
+        metrics.PROMPT_TOKENS.inc(request.model_id, 'cached', amount=reused)
+        metrics.PROMPT_TOKENS.inc(request.model_id, 'computed', amount=len(request.prompt_tokens) - reused)
+
+        if not self._accept(sequence, token):
+            self._keep(cohort, list(range(len(cohort.sequences) - 1)))
+
+    def _decode(self, cohort):
+        sequences = cohort.sequences
+        for s in sequences:
+            s.tokens.append(s.last_token)
+        self._route_rows(cohort, [s.request for s in sequences])
+        logits = self.backend.decode_step(self.manager.model, cohort.cache, [s.last_token for s in sequences])
+        tokens = self.backend.sample(logits, [s.request.temperature for s in sequences])
+
+        self.decode_steps += 1
+        self.decoded_rows += len(sequences)
+        keep = [i for i, (s, t) in enumerate(zip(sequences, tokens)) if self._accept(s, t)]
+        self._keep(cohort, keep)
+
+    def _route_rows(self, cohort, requests):
+        """Nei gruppi: adapter di ogni riga del prossimo forward pass"""
+        if cohort.experts:
+            self.backend.set_adapter_rows(self.manager.model, [r.adapter_row for r in requests])
+
+    def _speculate(self, cohort):
+        """Un passo di decoding speculativo per ogni sequenza dell'esperto"""
+        draft = self.manager.load_draft(cohort.draft_model)
+        keep = []
+        for i, sequence in enumerate(cohort.sequences):
+            if self._speculate_sequence(cohort, draft, sequence):
+                keep.append(i)
+        self._keep(cohort, keep)
+
+    def _speculate_sequence(self, cohort, draft, sequence):
+        request = sequence.request
+        last = sequence.last_token
+        # Non proporre più token di quanti ne restano da generare
+        remaining = request.max_tokens - sequence.generated
+        num_draft = max(0, min(cohort.num_draft_tokens, remaining - 1))
+
+        proposed = self.backend.draft_tokens(draft, sequence.draft_cache, last, num_draft, request.temperature)
+        sampled = self.backend.verify_draft(self.manager.model, sequence.cache, last, proposed, request.temperature)
+        accepted = accepted_prefix(proposed, sampled)
+        self.backend.rewind_caches(sequence.cache, draft, sequence.draft_cache, proposed, accepted)
+        sequence.tokens.append(last)
+        sequence.tokens.extend(proposed[:accepted])
+
+        request.stats.draft_tokens += len(proposed)
+        request.stats.accepted_tokens += accepted
+        self.speculative_steps += 1
+        self.draft_tokens += len(proposed)
+        self.accepted_tokens += accepted
+
+        generated = sequence.generated
+        alive = True
+        for token in sampled[:accepted + 1]:
+            if not self._accept(sequence, token):
+                alive = False
+                break
+        self.speculative_tokens += sequence.generated - generated
+        return alive
+
+    def _accept(self, sequence, token):
+        """Registra un token campionato; False se la sequenza è terminata"""
+        request = sequence.request
+        if request.stats.ttft is None:
+            request.stats.ttft = time.perf_counter() - request.submitted_at
+            metrics.TTFT.observe(request.stats.ttft, request.model_id)
+
+        if token in self._stop_tokens:
+            self._finish(request, 'stop')
+            return False
+
+        request._emit('token', token)
+        sequence.generated += 1
+        sequence.last_token = token
+        request.stats.generated_tokens = sequence.generated
+        self.generated_tokens += 1
+
+        if sequence.generated >= request.max_tokens:
+            self._finish(request, 'length')
+            return False
+        return True
+
+    def _keep(self, cohort, keep):
+        """Rimuove dal batch le sequenze terminate"""
+        if len(keep) == len(cohort.sequences):
+            return
+        if self.prompt_cache is not None:
+            kept = set(keep)
+            for i, sequence in enumerate(cohort.sequences):
+                if i not in kept:
+                    self._save_session(cohort, i, sequence)
+        if not keep:
+            cohort.sequences = []
+            cohort.cache = None
+            return
+        if cohort.cache is not None:
+            self.backend.filter_batch(cohort.cache, keep)
+        cohort.sequences = [cohort.sequences[i] for i in keep]
+
+    def _save_session(self, cohort, index, sequence):
+        """Conserva la KV cache della conversazione per il turno successivo"""
+        if sequence.cache is not None:
+            cache = sequence.cache
+        else:
+            cache = self.backend.extract_row(cohort.cache, index)
+        request = sequence.request
+        self.prompt_cache.store((request.model_id, request.adapter_path), sequence.tokens, cache)
+
+    def _drop_cancelled(self, cohort):
+        keep = []
+        for i, sequence in enumerate(cohort.sequences):
+            if sequence.request.cancelled:
+                self._finish(sequence.request, 'cancelled')
+            else:
+                keep.append(i)
+        self._keep(cohort, keep)
+
+    def _finish(self, request, reason):
+        request.stats.finish_reason = reason
+        request.stats.total_time = time.perf_counter() - request.submitted_at
+        request._emit('done', reason)
+
+        metrics.REQUESTS.inc(request.model_id, reason)
+        metrics.GENERATED_TOKENS.inc(request.model_id, amount=request.stats.generated_tokens)
+        tps = request.stats.tokens_per_sec()
+        if tps is not None:
+            metrics.DECODE_TPS.observe(tps, request.model_id)
+
+    def _fail(self, cohort, error):
+        for request in [s.request for s in cohort.sequences] + list(cohort.pending):
+            request._emit('error', str(error))
+        cohort.sequences = []
+        cohort.pending.clear()
+        cohort.cache = None
+
+    def active_by_model(self):
+        """Conversazioni nel batch per esperto (per /metrics)"""
+        active = {}
+        for cohort in list(self._cohorts.values()):
+            for sequence in list(cohort.sequences):
+                model_id = sequence.request.model_id
+                active[model_id] = active.get(model_id, 0) + 1
+        return active
+
+    def queued(self):
+        """Richieste in attesa del prefill"""
+        return self._queue.qsize() + sum(len(c.pending) for c in list(self._cohorts.values()))
+
+    def stats(self):
+        """Statistiche aggregate per /api/health"""
+        cohorts = list(self._cohorts.values())
+        return {
+            'queued': self.queued(),
+            'active': sum(len(c.sequences) for c in cohorts),
+            'experts_active': [c.model_id for c in cohorts if c.has_work()],
+            'decode_steps': self.decode_steps,
+            'generated_tokens': self.generated_tokens,
+            'avg_batch_size': round(self.decoded_rows / self.decode_steps, 2) if self.decode_steps else None,
+            'tokens_per_sec': round(self.generated_tokens / self.busy_seconds, 2) if self.busy_seconds else None,
+            'speculative': {
+                'steps': self.speculative_steps,
+                'draft_tokens': self.draft_tokens,
+                'accepted_tokens': self.accepted_tokens,
+                'acceptance_rate': round(self.accepted_tokens / self.draft_tokens, 3) if self.draft_tokens else None,
+                'tokens_per_step': round(self.speculative_tokens / self.speculative_steps, 2) if self.speculative_steps else None,
+                'tokens_per_sec': (
+                    round(self.speculative_tokens / self.speculative_seconds, 2) if self.speculative_seconds else None
+                )
+            }
+        }
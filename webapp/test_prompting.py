@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Test del budget di contesto con il tokenizer del backend finto.
+
+    cd webapp && python -m pytest -q test_prompting.py
+"""
+
+import pytest
+
+from fake_backend import FakeBackend
+from prompting import ContextWindow, PromptBuilder, valid_max_tokens
+
+
+@pytest.fixture
+def builder():
+    _, tokenizer = FakeBackend(token_ms=0, swap_ms=0).load_base('fake-base')
+    return PromptBuilder(tokenizer)
+
+
+def test_max_tokens_capped_by_context(builder):
+    window = ContextWindow(max_context_tokens=200)
+    prompt_tokens, dropped, max_tokens = window.fit(builder, "ciao", [], None, 10_000)
+    assert max_tokens == 200 - len(prompt_tokens)
+    assert dropped == 0
+
+
+@pytest.mark.parametrize('value', [-5, 0, "10", 1.5, None, True])
+def test_invalid_max_tokens_rejected(builder, value):
+    assert not valid_max_tokens(value)
+    with pytest.raises(ValueError, match="max_tokens"):
+        ContextWindow(max_context_tokens=200).fit(builder, "ciao", [], None, value)
+
+
+def test_valid_max_tokens():
+    assert valid_max_tokens(1)
+    assert valid_max_tokens(500)
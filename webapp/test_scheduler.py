@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Test dello scheduler con il backend finto (nessun modello né MLX).
+
+    cd webapp && python -m pytest -q test_scheduler.py
+"""
+
+import threading
+import time
+
+import pytest
+
+from fake_backend import FakeBackend
+from model_manager import ModelManager
+from scheduler import InferenceScheduler
+
+
+class FailingPrefillBackend(FakeBackend):
+    """Backend finto il cui prefill fallisce sempre"""
+
+    def prefill(self, model, prompt_tokens, prefill_step_size=512, cache=None):
+        raise RuntimeError("prefill fallito")
+
+
+class OnePromptFailingBackend(FakeBackend):
+    """Backend finto il cui prefill fallisce solo per un prompt"""
+
+    bad_prompt = None
+
+    def prefill(self, model, prompt_tokens, prefill_step_size=512, cache=None):
+        if list(prompt_tokens) == self.bad_prompt:
+            raise RuntimeError("prefill fallito")
+        return super().prefill(model, prompt_tokens, prefill_step_size, cache)
+
+
+def make_scheduler(backend, tmp_path):
+    manager = ModelManager('fake-base', tmp_path, 64 * 1024 * 1024, backend)
+    return manager, InferenceScheduler(manager)
+
+
+def run_with_timeout(target, seconds=5.0):
+    result = {}
+
+    def run():
+        try:
+            result['value'] = target()
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    assert not thread.is_alive(), "la richiesta non è mai terminata"
+    return result
+
+
+def test_generation(tmp_path):
+    manager, scheduler = make_scheduler(FakeBackend(token_ms=0, swap_ms=0), tmp_path)
+    handle = manager.acquire('base', None)
+    request = scheduler.submit('base', None, manager.tokenizer.encode("ciao"), max_tokens=8,
+                               temperature=0, on_done=handle.release)
+
+    result = run_with_timeout(lambda: request.text(manager.tokenizer))
+    assert 'error' not in result
+    assert request.stats.finish_reason in ('stop', 'length')
+    assert manager.adapters.stats()['in_use'] == {}
+
+
+def test_prefill_error_reaches_request(tmp_path):
+    manager, scheduler = make_scheduler(FailingPrefillBackend(token_ms=0, swap_ms=0), tmp_path)
+    manager.ensure_base()
+    handle = manager.acquire('base', None)
+    request = scheduler.submit('base', None, manager.tokenizer.encode("ciao"), max_tokens=8,
+                               temperature=0, on_done=handle.release)
+
+    result = run_with_timeout(lambda: request.text(manager.tokenizer))
+    with pytest.raises(RuntimeError, match="prefill fallito"):
+        raise result['error']
+    # on_done è stata chiamata: l'adapter non resta fissato in cache
+    assert manager.adapters.stats()['in_use'] == {}
+
+
+def test_prefill_error_fails_pending_requests(tmp_path):
+    manager, scheduler = make_scheduler(FailingPrefillBackend(token_ms=0, swap_ms=0), tmp_path)
+    manager.ensure_base()
+    requests = [
+        scheduler.submit('base', None, manager.tokenizer.encode(f"domanda {i}"), max_tokens=8, temperature=0)
+        for i in range(3)
+    ]
+    for request in requests:
+        result = run_with_timeout(lambda: request.text(manager.tokenizer))
+        assert isinstance(result.get('error'), RuntimeError)
+
+
+def test_prefill_error_spares_other_sequences(tmp_path):
+    backend = OnePromptFailingBackend(token_ms=5, swap_ms=0)
+    manager, scheduler = make_scheduler(backend, tmp_path)
+    manager.ensure_base()
+    bad_prompt = manager.tokenizer.encode("domanda sbagliata")
+    backend.bad_prompt = bad_prompt
+    good = [
+        scheduler.submit('base', None, manager.tokenizer.encode(f"domanda {i}"), max_tokens=8, temperature=0)
+        for i in range(2)
+    ]
+    bad = scheduler.submit('base', None, bad_prompt, max_tokens=8, temperature=0)
+    good.append(scheduler.submit('base', None, manager.tokenizer.encode("domanda 2"), max_tokens=8, temperature=0))
+
+    result = run_with_timeout(lambda: bad.text(manager.tokenizer))
+    assert isinstance(result.get('error'), RuntimeError)
+    for request in good:
+        result = run_with_timeout(lambda: request.text(manager.tokenizer))
+        assert 'error' not in result
+        assert request.stats.finish_reason in ('stop', 'length')
+
+
+def test_embedding_does_not_wait_for_decoding(tmp_path):
+    manager, scheduler = make_scheduler(FakeBackend(token_ms=200, swap_ms=0, eos_every=10 ** 9), tmp_path)
+    manager.ensure_base()
+    request = scheduler.submit('base', None, manager.tokenizer.encode("ciao"), max_tokens=20, temperature=0)
+    # Il worker è nel mezzo dei passi di decoding (lock del modello preso)
+    next(request.stream(manager.tokenizer))
+
+    start = time.perf_counter()
+    manager.embed_text("Come si fa un loop in Python?")
+    assert time.perf_counter() - start < 0.1
+    request.cancel()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Warm-up degli esperti in background, dopo l'avvio del server.
+
+Il server accetta richieste subito; un thread prepara poi gli esperti in
+ordine di priorità (adapter in cache, snapshot del system prompt e una
+generazione di pochi token, che compila i kernel della prima inferenza).
+Lo stato di ogni esperto (pending, warming, ready, cold, failed) è in
+/api/health e /api/models, così la UI può mostrare "in preparazione"
+invece di restare appesa.
+"""
+
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+PENDING = 'pending'
+WARMING = 'warming'
+READY = 'ready'
+# Non preparato perché la cache degli adapter è piena: verrà caricato alla prima richiesta
+COLD = 'cold'
+FAILED = 'failed'
+
+
+def wait_for_port(port, host='127.0.0.1', timeout=120.0):
+    """Attende che il server sia in ascolto sulla porta; ritorna False allo scadere"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1.0):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+class Warmup:
+    """Stato del warm-up per esperto e thread che lo esegue"""
+
+    def __init__(self):
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self, model_ids, warm, wait=None, should_stop=None):
+        """
+        Avvia il warm-up in background (una sola volta).
+
+        warm(model_id) prepara un esperto; wait() viene chiamata prima di
+        iniziare (es. attesa della porta del server); should_stop() ferma il
+        prefetch degli esperti restanti, che restano "cold".
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            for model_id in model_ids:
+                self._models[model_id] = {'state': PENDING}
+            self._thread = threading.Thread(
+                target=self._run, args=(list(model_ids), warm, wait, should_stop),
+                name='warmup', daemon=True
+            )
+            self._thread.start()
+
+    def _run(self, model_ids, warm, wait, should_stop):
+        if wait is not None:
+            wait()
+        self.started_at = time.time()
+        for i, model_id in enumerate(model_ids):
+            if should_stop is not None and should_stop():
+                for rest in model_ids[i:]:
+                    self._set(rest, state=COLD)
+                print(f"⏸️  Warm-up interrotto (cache adapter piena): {', '.join(model_ids[i:])}")
+                break
+
+            self._set(model_id, state=WARMING)
+            start = time.perf_counter()
+            try:
+                warm(model_id)
+            except Exception as e:
+                self._set(model_id, state=FAILED, error=str(e))
+                print(f"⚠️  Warm-up fallito ({model_id}): {e}")
+                continue
+            elapsed = time.perf_counter() - start
+            self._set(model_id, state=READY, seconds=round(elapsed, 2))
+            print(f"🔥 Esperto pronto: {model_id} ({elapsed:.1f}s)")
+        self.finished_at = time.time()
+
+    def _set(self, model_id, **values):
+        with self._lock:
+            self._models[model_id] = values
+
+    def model_state(self, model_id):
+        """Stato del warm-up di un esperto (None se non previsto)"""
+        with self._lock:
+            entry = self._models.get(model_id)
+            return entry['state'] if entry else None
+
+    def stats(self):
+        """Stato per /api/health"""
+        with self._lock:
+            if self._thread is None:
+                state = 'idle'
+            elif self.finished_at is None:
+                state = 'running'
+            else:
+                state = 'done'
+            return {
+                'state': state,
+                'models': {model_id: dict(entry) for model_id, entry in self._models.items()}
+            }